@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import time
+import unittest
+from tool.cache import LRUCache, FileCache, make_cache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache(size=2)
+
+    def test_get_set(self):
+        "items can be stored and retrieved"
+        self.cache.set('foo', 123)
+        self.assertEquals(self.cache.get('foo'), 123)
+        self.assertEquals(self.cache.get('bar'), None)
+        self.assertEquals(self.cache.get('bar', 'x'), 'x')
+
+    def test_size(self):
+        "least recently used items are discarded"
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEquals(len(self.cache), 2)
+        self.assertEquals(self.cache.get('a'), 1)
+        self.assertEquals(self.cache.get('b'), None)
+
+    def test_ttl(self):
+        "expired items are not returned"
+        self.cache.set('foo', 123, ttl=0.01)
+        time.sleep(0.02)
+        self.assertEquals(self.cache.get('foo'), None)
+
+    def test_ttl_zero(self):
+        "ttl=0 means the item is not stored; default_ttl=None means forever"
+        self.cache.set('foo', 123)
+        self.cache.set('foo', 456, ttl=0)
+        self.assertEquals(self.cache.get('foo'), None)
+        cache = LRUCache(default_ttl=0)
+        cache.set('foo', 123)
+        self.assertEquals(cache.get('foo'), None)
+        self.assertEquals(cache.get_or_set('bar', lambda: 1), 1)
+        self.assertEquals(len(cache), 0)
+
+    def test_delete_prefix(self):
+        "items can be removed by key prefix"
+        self.cache.set('nav:a', 1)
+        self.cache.set('foo', 2)
+        self.cache.delete_prefix('nav:')
+        self.assertEquals(self.cache.get('nav:a'), None)
+        self.assertEquals(self.cache.get('foo'), 2)
+
+    def test_get_or_set(self):
+        "factory is only called on cache miss"
+        calls = []
+        factory = lambda: calls.append(1) or len(calls)
+        self.assertEquals(self.cache.get_or_set('x', factory), 1)
+        self.assertEquals(self.cache.get_or_set('x', factory), 1)
+
+
+class FileCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = make_cache('file', path=self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_backend(self):
+        assert isinstance(self.cache, FileCache)
+
+    def test_get_set(self):
+        "items survive between cache instances"
+        self.cache.set(u'foo', {'a': 1})
+        other = FileCache(self.path)
+        self.assertEquals(other.get(u'foo'), {'a': 1})
+        self.cache.delete(u'foo')
+        self.assertEquals(other.get(u'foo'), None)
+
+    def test_delete_prefix(self):
+        "items can be removed by key prefix"
+        self.cache.set('nav:a', 1)
+        self.cache.set('foo', 2)
+        self.cache.delete_prefix('nav:')
+        self.assertEquals(self.cache.get('nav:a'), None)
+        self.assertEquals(self.cache.get('foo'), 2)
+        self.cache.clear()
+        self.assertEquals(self.cache.get('foo'), None)
+
+    def test_ttl_zero(self):
+        "ttl=0 means the item is not stored"
+        self.cache.set('foo', 123)
+        self.cache.set('foo', 456, ttl=0)
+        self.assertEquals(self.cache.get('foo'), None)
+
+    def test_key_type(self):
+        "keys must be strings"
+        self.assertRaises(TypeError, self.cache.set, ('foo', 1), 123)
+        self.assertRaises(TypeError, self.cache.get, 123)
@@ -1,7 +1,525 @@
 # -*- coding: utf-8 -*-
 
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
 import unittest
-from tool.ext import admin
+from doqu import Document, get_db, validators
+from werkzeug import BaseResponse, Client
+from tool import WebApplication
+from tool.ext import admin, documents, pagination
+from tool.ext.documents import PooledStorage
+from tool.ext.admin.search import SearchIndex, SearchResults
+try:
+    from tool.ext.admin import views
+except ImportError:
+    # the views require tool.ext.what
+    views = None
+
+
+class Person(Document):
+    structure = {'name': unicode, 'city': unicode}
+
+
+class Book(Document):
+    structure = {'title': unicode, 'author': Person, 'editor': Person}
+
+
+class SearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = get_db(backend='doqu.ext.shelve_db',
+                         path=os.path.join(self.path, 'test.db'))
+        self.index = SearchIndex(os.path.join(self.path, 'search.db'))
+        self.names = ['name', 'city']
+        self.people = []
+        for name, city in [(u'John Smith', u'London'),
+                           (u'Jane Smith', u'Paris'),
+                           (u'Émile Zola', u'Paris')]:
+            person = Person(name=name, city=city)
+            person.save(self.db)
+            self.people.append(person)
+        self.index.rebuild(Person, Person.objects(self.db), self.names)
+
+    def tearDown(self):
+        self.index.close()
+        self.db.disconnect()
+        shutil.rmtree(self.path)
+
+    def search(self, text):
+        results = SearchResults(self.db, Person,
+                                self.index.search(Person, text))
+        # rebuild() indexes documents in storage order
+        return sorted(x.name for x in results)
+
+    def test_search(self):
+        "all words must match some field by prefix, case-insensitively"
+        self.assertEquals(self.search(u'smi PARIS'), [u'Jane Smith'])
+        self.assertEquals(self.search(u'paris'), [u'Jane Smith', u'Émile Zola'])
+        self.assertEquals(self.search(u'émile'), [u'Émile Zola'])
+        self.assertEquals(self.search(u'"*'), [])
+
+    def test_update(self):
+        "entries are replaced and removed"
+        jane = self.people[1]
+        jane.city = u'Rome'
+        jane.save()
+        self.index.update(jane, self.names)
+        self.assertEquals(self.search(u'paris'), [u'Émile Zola'])
+        self.index.remove(Person, self.people[2].pk)
+        self.assertEquals(self.search(u'paris'), [])
+
+    def test_stale(self):
+        "documents missing from the storage are skipped"
+        self.db.delete(self.people[0].pk)
+        self.assertEquals(self.search(u'smith'), [u'Jane Smith'])
+
+
+class RegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.original = admin.get_registry()
+
+    def tearDown(self):
+        admin._registry = self.original
+
+    def test_register(self):
+        "registration replaces the registry with an updated copy"
+        before = admin.get_registry()
+        admin.register(Person, namespace='people', search_names=['name'])
+        registry = admin.get_registry()
+        assert registry is not before
+        self.assertRaises(NameError, before.get, 'people', 'Person')
+        options = registry.get('people', 'Person')
+        self.assertEquals(options.model, Person)
+        self.assertEquals(options.search_names, ['name'])
+        self.assertEquals(registry.get_for_model(Person), options)
+        self.assertEquals(registry.namespaces['people'], {'Person': Person})
+
+    def test_replace(self):
+        "registering a model again replaces its options"
+        admin.register(Person, namespace='people')
+        admin.register(Person, namespace='people', list_names=['city'])
+        registry = admin.get_registry()
+        self.assertEquals(len(registry), len(self.original) + 1)
+        self.assertEquals(registry.get('people', 'Person').list_names,
+                          ['city'])
+        admin.unregister(Person, namespace='people')
+        self.assertRaises(NameError, admin.get_registry().get, 'people',
+                          'Person')
+
+
+@unittest.skipIf(views is None, 'Admin views cannot be imported')
+class ViewsTestCase(unittest.TestCase):
+    "Base class for tests that make requests to the admin."
+    admin_settings = None
+    db_settings = {}
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        media = os.path.join(self.path, 'media')
+        os.mkdir(media)
+        conf = {'extensions': {
+            'tool.ext.documents.Documents': {'default': dict(
+                self.db_settings, backend='doqu.ext.shelve_db',
+                path=os.path.join(self.path, 'test.db'))},
+            'tool.ext.templating.JinjaPlugin': None,
+            'tool.ext.werkzeug_routing.Routing': {
+                'tool.ext.admin.views': '/admin/'},
+            'tool.ext.breadcrumbs.BreadcrumbsPlugin': None,
+            'tool.ext.staticfiles.StaticFiles': {media: None},
+            'tool.ext.admin.AdminWeb': self.get_admin_settings(),
+        }}
+        self.original = admin.get_registry()
+        self.app = WebApplication(conf)
+        self.db = self.app.get_feature('document_storage').default_db
+        self.client = Client(self.app, BaseResponse)
+
+    def tearDown(self):
+        admin._registry = self.original
+        index = self.app.get_feature('admin').env['search_index']
+        if index:
+            index.close()
+        if isinstance(self.db, PooledStorage):
+            self.db.pool.close()
+        else:
+            self.db.disconnect()
+        shutil.rmtree(self.path)
+
+    def get_admin_settings(self):
+        return self.admin_settings
+
+    def url(self, model, suffix=''):
+        return '/admin/main/{0}/{1}'.format(model.__name__, suffix)
+
+
+class ReferencesTestCase(ViewsTestCase):
+    admin_settings = {'references_limit': 2, 'lazy_references': 2}
+
+    def setUp(self):
+        super(ReferencesTestCase, self).setUp()
+        admin.register(Person)
+        admin.register(Book)
+        # Doqu does not fill this in by itself
+        Person.meta.referenced_by = {Book: ['author', 'editor']}
+        self.author = Person(name=u'John')
+        self.author.save(self.db)
+        for title in u'abc':
+            Book(title=title, author=self.author).save(self.db)
+
+    def tearDown(self):
+        Person.meta.referenced_by = {}
+        super(ReferencesTestCase, self).tearDown()
+
+    def test_lazy(self):
+        "references are loaded by a separate request"
+        url = self.url(Person, self.author.pk)
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        assert 'data-url="{0}/references"'.format(url) in response.data
+
+        response = self.client.get(url + '/references')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data.count('(as author)'), 3)
+        assert '&hellip; and more (as author)' in response.data
+        assert '(as editor)' not in response.data
+
+    def test_inline(self):
+        "references are listed on the object page below the threshold"
+        self.app.get_feature('admin').env['lazy_references'] = False
+        response = self.client.get(self.url(Person, self.author.pk))
+        assert 'data-url=' not in response.data
+        self.assertEquals(response.data.count('(as author)'), 3)
+
+
+class FormTestCase(ViewsTestCase):
+    def setUp(self):
+        super(FormTestCase, self).setUp()
+        admin.register(Person)
+
+    def test_add(self):
+        "objects are created with the generated form"
+        response = self.client.post(self.url(Person, 'add'),
+                                    data={'name': u'John', 'city': u'Paris'})
+        self.assertEquals(response.status_code, 302)
+        person = Person.objects(self.db)[0]
+        self.assertEquals(person.city, u'Paris')
+        assert response.headers['Location'].endswith(
+            self.url(Person, person.pk))
+
+    def test_form_class_cache(self):
+        "the form class is generated once per model and storage"
+        self.client.get(self.url(Person, 'add'))
+        count = len(views._form_classes)
+        self.client.get(self.url(Person, 'add'))
+        self.assertEquals(len(views._form_classes), count)
+
+    def test_schema_version(self):
+        "the version depends on field names and types only"
+        def make_model(datatype):
+            class Person(Document):
+                structure = {'name': datatype}
+                validators = {'name': [validators.Required()]}
+            return Person
+        first, second = make_model(unicode), make_model(unicode)
+        self.assertEquals(views._get_schema_version(first),
+                          views._get_schema_version(second))
+        self.assertNotEquals(views._get_schema_version(first),
+                             views._get_schema_version(make_model(int)))
+
+
+class ListTestCase(ViewsTestCase):
+    def setUp(self):
+        super(ListTestCase, self).setUp()
+        admin.register(Person, list_names=['name'], search_names=['city'],
+                       cursor_key='name')
+        self.people = []
+        for name, city in [(u'Ann', u'Paris'), (u'Bob', u'Rome'),
+                           (u'Cid', u'Paris'), (u'Dan', u'Paris')]:
+            person = Person(name=name, city=city)
+            person.save(self.db)
+            self.people.append(person)
+
+    def get_admin_settings(self):
+        return {'search_index': os.path.join(self.path, 'search.db')}
+
+    def get_next_url(self, **args):
+        response = self.client.get(self.url(Person), query_string=args)
+        self.assertEquals(response.status_code, 200)
+        data = response.data.split('Next &raquo;')[0]
+        return data.rsplit('href="', 1)[1].split('"')[0].replace('&amp;', '&')
+
+    def test_cursor(self):
+        "pages are addressed by key"
+        url = self.get_next_url(per_page=2)
+        assert 'after=Bob' in url, url
+
+    def test_search_args(self):
+        "links to other pages keep the search string"
+        index = self.app.get_feature('admin').env['search_index']
+        for person in self.people:
+            index.update(person, ['city'])
+        url = self.get_next_url(q=u'paris', per_page=1)
+        assert 'q=paris' in url and 'page=2' in url, url
+        url = self.get_next_url(q=u'paris', per_page=1, page=2)
+        assert 'q=paris' in url and 'page=3' in url, url
+
+    def test_update_search_index(self):
+        "the index is updated by the admin and on demand"
+        plugin = self.app.get_feature('admin')
+        index = plugin.env['search_index']
+        person = self.people[1]
+        person.city = u'Oslo'
+        person.save(self.db)
+        self.assertEquals(index.search(Person, u'oslo'), [])
+        plugin.update_search_index(person)
+        self.assertEquals(index.search(Person, u'oslo'), [person.pk])
+        plugin.remove_from_search_index(Person, person.pk)
+        self.assertEquals(index.search(Person, u'oslo'), [])
+
+        self.client.post(self.url(Person, person.pk),
+                         data={'name': u'Bob', 'city': u'Lima'})
+        self.assertEquals(index.search(Person, u'lima'), [person.pk])
+        self.client.post(self.url(Person, person.pk), data={'DELETE': '1'})
+        self.assertEquals(index.search(Person, u'lima'), [])
+
+
+class ExportTestCase(ViewsTestCase):
+    def setUp(self):
+        super(ExportTestCase, self).setUp()
+        admin.register(Person, list_names=['name', 'city'],
+                       ordering={'names': ['name']})
+        self.people = []
+        for name, city in [(u'Bob', None), (u'Ann', u'Zürich')]:
+            person = Person(name=name, city=city)
+            person.save(self.db)
+            self.people.append(person)
+
+    def test_csv(self):
+        "objects are exported as CSV in list order"
+        self.patch_chunk_size()
+        response = self.client.get(self.url(Person, 'export/csv'))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.headers['Content-Type'].split(';')[0],
+                          'text/csv')
+        assert 'Person.csv' in response.headers['Content-Disposition']
+        bob, ann = self.people
+        self.assertEquals(response.data.splitlines(), [
+            'pk,name,city',
+            '{0},Ann,Z\xc3\xbcrich'.format(ann.pk),
+            '{0},Bob,'.format(bob.pk),
+        ])
+
+    def test_ndjson(self):
+        "objects are exported as JSON objects, one per line"
+        self.patch_chunk_size()
+        response = self.client.get(self.url(Person, 'export/ndjson'))
+        self.assertEquals(response.status_code, 200)
+        rows = [json.loads(x) for x in response.data.splitlines()]
+        bob, ann = self.people
+        self.assertEquals(rows, [
+            {'pk': ann.pk, 'name': u'Ann', 'city': u'Zürich'},
+            {'pk': bob.pk, 'name': u'Bob', 'city': None},
+        ])
+
+    def test_unordered(self):
+        "unsorted lists are exported without keeping the objects"
+        admin.register(Person, list_names=['name'])
+        calls = []
+        def iter_all(model, db):
+            calls.append(model)
+            return documents.iter_all_documents(model, db, chunk_size=1)
+        self.addCleanup(setattr, views, 'iter_all_documents',
+                        views.iter_all_documents)
+        views.iter_all_documents = iter_all
+        response = self.client.get(self.url(Person, 'export/csv'))
+        self.assertEquals(sorted(response.data.splitlines()[1:]),
+                          sorted('{0},{1}'.format(x.pk, x.name)
+                                 for x in self.people))
+        self.assertEquals(calls, [Person])
+
+    def patch_chunk_size(self):
+        # rows are sent in several chunks
+        size, views.EXPORT_CHUNK_SIZE = views.EXPORT_CHUNK_SIZE, 1
+        self.addCleanup(setattr, views, 'EXPORT_CHUNK_SIZE', size)
+
+
+class ActionTestCase(ViewsTestCase):
+    def setUp(self):
+        super(ActionTestCase, self).setUp()
+        admin.register(Person)
+        self.people = []
+        for name in u'abc':
+            person = Person(name=name, city=u'Paris')
+            person.save(self.db)
+            self.people.append(person)
+
+    def post(self, **data):
+        return self.client.post(self.url(Person, 'action'), data=data)
+
+    def get_status(self, url):
+        response = self.client.get(url)
+        return response.status_code, json.loads(response.data)
+
+    def test_delete(self):
+        "selected objects are deleted"
+        response = self.post(action='delete', pk=self.people[0].pk)
+        self.assertEquals(response.status_code, 302)
+        assert response.headers['Location'].endswith(self.url(Person))
+        self.assertEquals(sorted(x.name for x in Person.objects(self.db)),
+                          [u'b', u'c'])
+
+    def test_update_all(self):
+        "all objects in the list can be updated"
+        response = self.post(action='update', field='city', value=u'Rome',
+                             all='1')
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals([x.city for x in Person.objects(self.db)],
+                          [u'Rome'] * 3)
+
+    def test_bad_request(self):
+        "unknown actions and fields are rejected"
+        self.assertEquals(self.post(action='drop', all='1').status_code, 400)
+        response = self.post(action='update', field='pk', value=u'x',
+                             all='1')
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(Person.objects(self.db).count(), 3)
+
+    def test_no_action(self):
+        "nothing is done unless an action is chosen"
+        response = self.client.get(self.url(Person))
+        assert '<option value="" selected="selected">' in response.data
+        assert 'name="background"' not in response.data
+        response = self.post(action='', all='1')
+        self.assertEquals(response.status_code, 302)
+        assert response.headers['Location'].endswith(self.url(Person))
+        self.assertEquals(Person.objects(self.db).count(), 3)
+
+    def test_background_not_pooled(self):
+        "background actions are refused if the database has a single handle"
+        response = self.post(action='delete', all='1', background='1')
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(Person.objects(self.db).count(), 3)
+
+    def test_unknown_job(self):
+        "status of an unknown job is not found"
+        status, job = self.get_status(self.url(Person, 'action/foo'))
+        self.assertEquals((status, job['state']), (404, 'unknown'))
+
+
+class BackgroundActionTestCase(ViewsTestCase):
+    db_settings = {'pool_size': 1, 'pool_timeout': 1}
+
+    def setUp(self):
+        super(BackgroundActionTestCase, self).setUp()
+        admin.register(Person)
+        for name in u'abc':
+            Person(name=name, city=u'Paris').save(self.db)
+        # the only handle is needed by the job
+        self.app.get_feature('document_storage').release_handles()
+
+    def post(self, **data):
+        # the handle is released when the response is closed
+        return self.client.post(self.url(Person, 'action'), data=data,
+                                buffered=True)
+
+    def wait(self, response):
+        self.assertEquals(response.status_code, 302)
+        url = response.headers['Location'].replace('http://localhost', '')
+        for i in range(100):
+            response = self.client.get(url)
+            status, job = response.status_code, json.loads(response.data)
+            if job['state'] != 'running':
+                break
+            time.sleep(0.01)
+        self.assertEquals(status, 200)
+        return job
+
+    def test_background(self):
+        "the job runs on a pooled handle and reports its progress"
+        response = self.client.get(self.url(Person), buffered=True)
+        assert 'name="background"' in response.data
+        plugin = self.app.get_feature('document_storage')
+        handles = []
+        checkout = plugin.checkout
+        def record_checkout(*args, **kwargs):
+            handles.append(args)
+            return checkout(*args, **kwargs)
+        plugin.checkout = record_checkout
+
+        job = self.wait(self.post(action='update', field='city',
+                                  value=u'Rome', all='1', background='1'))
+        self.assertEquals(job['state'], 'done')
+        self.assertEquals((job['total'], job['processed'], job['errors']),
+                          (3, 3, 0))
+        self.assertEquals(handles, [()])
+
+    def test_background_delete(self):
+        "objects deleted in background stay deleted when reopened"
+        job = self.wait(self.post(action='delete', all='1', background='1'))
+        self.assertEquals((job['state'], job['processed']), ('done', 3))
+        self.db.pool.close()
+        db = get_db(backend='doqu.ext.shelve_db',
+                    path=os.path.join(self.path, 'test.db'))
+        try:
+            self.assertEquals(len(db), 0)
+        finally:
+            db.disconnect()
+
+
+class PrefetchTestCase(ViewsTestCase):
+    db_settings = {'pool_size': 2}
+
+    def setUp(self):
+        super(PrefetchTestCase, self).setUp()
+        admin.register(Person, list_names=['name'], ordering={'names': ['name']})
+        for name in u'abcde':
+            Person(name=name).save(self.db)
+        pagination._prefetched.clear()
+        pagination._prefetch_jobs.clear()
+
+    def get_admin_settings(self):
+        return {'prefetch_pages': True}
+
+    def get_names(self, response):
+        return re.findall(r'>\s*([a-e])\s*</a>', response.data)
+
+    def test_prefetch(self):
+        "the next page is prefetched for the browser session"
+        self.client.cookie_jar = None
+        args = {'per_page': 2}
+        headers = [('Cookie', 'session=1')]
+        response = self.client.get(self.url(Person), query_string=args,
+                                   headers=headers)
+        self.assertEquals(self.get_names(response), [u'a', u'b'])
+        for i in range(100):
+            if len(pagination._prefetched):
+                break
+            time.sleep(0.01)
+        self.assertEquals(len(pagination._prefetched), 1)
+        response = self.client.get(self.url(Person), headers=headers,
+                                   query_string=dict(args, page=2))
+        self.assertEquals(self.get_names(response), [u'c', u'd'])
+
+    def test_without_cookie(self):
+        "nothing is prefetched if the browser cannot be told apart"
+        self.client.get(self.url(Person), query_string={'per_page': 2})
+        time.sleep(0.05)
+        self.assertEquals(len(pagination._prefetched), 0)
+
+
+class UnpooledPrefetchTestCase(PrefetchTestCase):
+    db_settings = {}
+
+    def test_prefetch(self):
+        "nothing is prefetched if the database has a single handle"
+        response = self.client.get(self.url(Person), buffered=True,
+                                   query_string={'per_page': 2},
+                                   headers=[('Cookie', 'session=1')])
+        self.assertEquals(self.get_names(response), [u'a', u'b'])
+        self.assertEquals(len(pagination._prefetch_jobs), 0)
 
 
 class SomeTestCase(unittest.TestCase):
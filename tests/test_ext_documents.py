@@ -1,9 +1,456 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import decimal
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+from doqu import Document, get_db, validators
+from doqu.ext import shelve_db
+from tool import Application, WebApplication
 from tool.ext import documents
+from tool.ext.documents import (StoragePool, PooledStorage, CachedStorage,
+                                 get_object_or_404, bulk_save, bulk_delete,
+                                 InstrumentedStorage, QueryStats,
+                                 get_query_stats,
+                                 iter_documents)
+from werkzeug import BaseResponse, Client
+from werkzeug.exceptions import NotFound
 
 
-class SomeTestCase(unittest.TestCase):
-    def test_foo(self):
-        pass
+PLUGIN = 'tool.ext.documents.Documents'
+
+
+class Note(Document):
+    structure = {'text': unicode}
+
+
+class Task(Document):
+    structure = {'title': unicode}
+    validators = {'title': [validators.required()]}
+
+
+class PoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings = {'backend': 'doqu.ext.shelve_db',
+                         'path': os.path.join(self.path, 'test.db')}
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        shutil.rmtree(self.path)
+
+    def make_pool(self, **kwargs):
+        pool = StoragePool(self.settings, **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def test_exhausted(self):
+        "checkout fails when no handle is returned within timeout"
+        pool = self.make_pool(size=1, timeout=0.01)
+        db = pool.checkout()
+        self.assertRaises(RuntimeError, pool.checkout)
+        pool.checkin(db)
+        assert pool.checkout() is db
+
+    def test_health_check(self):
+        "broken handles are replaced on checkout"
+        pool = self.make_pool(size=1)
+        db = pool.checkout()
+        db.disconnect()
+        pool.checkin(db)
+        other = pool.checkout()
+        assert other is not db
+        assert other
+
+    def test_fork(self):
+        "handles are not reused in another process"
+        pool = self.make_pool(size=1)
+        db = pool.checkout()
+        pool._pid = -1
+        assert pool.checkout() is not db
+        db.disconnect()
+
+    def test_per_thread(self):
+        "each thread gets its own handle; dead threads return theirs"
+        pool = self.make_pool()
+        storage = PooledStorage(pool, per_thread=True)
+        handles = [storage._get_storage()]
+        thread = threading.Thread(
+            target=lambda: handles.append(storage._get_storage()))
+        thread.start()
+        thread.join()
+        assert handles[0] is not handles[1]
+        assert storage._get_storage() is handles[0]
+        self.assertEquals(len(pool._handles), 2)
+        assert pool.checkout() is handles[1]
+
+    def test_plugin(self):
+        "pooled storages behave like plain ones"
+        conf = {'extensions': {PLUGIN: {
+            'default': dict(self.settings, pool_size=1,
+                                   pool_timeout=0.01)}}}
+        app = Application(conf)
+        plugin = app.get_extension(PLUGIN)
+        db = documents.get_default_storage()
+        assert isinstance(db, PooledStorage)
+        assert plugin.is_pooled()
+        self.pools.append(db.pool)
+
+        note = Note(text=u'foo')
+        pk = note.save(db)
+        note.text = u'bar'
+        self.assertEquals(note.save(db), pk)
+        self.assertEquals(Note.objects(db).count(), 1)
+
+        # the handle is bound to this thread until released
+        self.assertRaises(RuntimeError, db.pool.checkout)
+        plugin.release_handles()
+        with plugin.checkout() as handle:
+            self.assertEquals(handle.get(pk, Note).text, u'bar')
+
+    def test_shared_checkout(self):
+        "the shared handle is lent for a database that is not pooled"
+        app = Application({'extensions': {PLUGIN: {'default': self.settings}}})
+        plugin = app.get_extension(PLUGIN)
+        db = documents.get_default_storage()
+        assert not plugin.is_pooled()
+        with plugin.checkout() as handle:
+            assert handle is db
+        assert db
+        db.disconnect()
+
+    def test_release_after_response(self):
+        "handles are returned to the pool when the response is closed"
+        conf = {'extensions': {PLUGIN: {
+            'default': dict(self.settings, pool_size=1,
+                                   pool_timeout=0.01)}}}
+        app = WebApplication(conf)
+        plugin = app.get_extension(PLUGIN)
+        db = documents.get_default_storage()
+        self.pools.append(db.pool)
+        self.assertEquals([x[0] for x in app.wsgi_stack],
+                          [documents.ReleaseHandlesMiddleware])
+
+        def view(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [str(Note.objects(db).count())]
+        client = Client(documents.ReleaseHandlesMiddleware(view, plugin),
+                        BaseResponse)
+        self.assertEquals(client.get('/', buffered=True).data, '0')
+        # another thread can get the only handle
+        handles = []
+        thread = threading.Thread(
+            target=lambda: handles.append(db.pool.checkout()))
+        thread.start()
+        thread.join()
+        assert handles
+
+    def test_release_with_routing(self):
+        "handles are released if the view does not call inner middleware"
+        conf = {'extensions': {PLUGIN: {
+            'default': dict(self.settings, pool_size=1,
+                                   pool_timeout=0.01)}}}
+        app = WebApplication(conf)
+        db = documents.get_default_storage()
+        self.pools.append(db.pool)
+
+        def view(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [str(Note.objects(db).count())]
+        # like routing, the middleware does not call the inner application
+        app.wrap_in(lambda inner: view)
+        client = Client(app, BaseResponse)
+        self.assertEquals(client.get('/', buffered=True).data, '0')
+        handles = []
+        thread = threading.Thread(
+            target=lambda: handles.append(db.pool.checkout()))
+        thread.start()
+        thread.join()
+        assert handles
+
+    def test_profile_command_stream(self):
+        "the profile command reports calls made by streamed views"
+        conf = {'extensions': {PLUGIN: {
+            'default': dict(self.settings, pool_size=1, pool_timeout=0.01,
+                            instrument=True)}}}
+        app = WebApplication(conf)
+        plugin = app.get_extension(PLUGIN)
+        db = documents.get_default_storage()
+        self.pools.append(documents._unwrap(db).pool)
+
+        def view(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return (str(Note.objects(db).count()) for i in range(2))
+        app._innermost_wsgi_app = view
+        documents.reset_query_stats()
+        class Args:
+            urls = ['/']
+            threshold = 2
+        output = list(documents.make_profile_command(plugin)(Args()))
+        assert output[0].startswith('/ (200 OK): 2 calls'), output[0]
+        self.assertEquals(output[-1],
+                          u'  duplicate (2×): Note.count()')
+        # the response was closed, so another thread can get the only handle
+        handles = []
+        thread = threading.Thread(target=lambda: handles.append(
+            documents._unwrap(db).pool.checkout()))
+        thread.start()
+        thread.join()
+        assert handles
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        settings = {'backend': 'doqu.ext.shelve_db',
+                    'path': os.path.join(self.path, 'test.db')}
+        self.raw = get_db(settings)
+        self.db = CachedStorage(self.raw, size=10, ttl=None)
+        for text in u'foo', u'bar':
+            Note(text=text).save(self.db)
+
+    def tearDown(self):
+        self.raw.disconnect()
+        shutil.rmtree(self.path)
+
+    def test_cached(self):
+        "repeated queries do not hit the backend"
+        query = Note.objects(self.db).where(text=u'foo')
+        self.assertEquals(query.count(), 1)
+        self.assertEquals([x.text for x in query], [u'foo'])
+        Note(text=u'foo').save(self.raw)
+        query = Note.objects(self.db).where(text=u'foo')
+        self.assertEquals(query.count(), 1)
+        self.assertEquals(len(list(query)), 1)
+
+    def test_key(self):
+        "conditions and ordering are part of the key"
+        query = Note.objects(self.db)
+        self.assertEquals(query.where(text=u'bar').count(), 1)
+        self.assertEquals(query.where(text=u'foo').count(), 1)
+        self.assertEquals([x.text for x in query.order_by('text')],
+                          [u'bar', u'foo'])
+        self.assertEquals([x.text for x in query.order_by('text', True)],
+                          [u'foo', u'bar'])
+
+    def test_invalidate(self):
+        "writes through the wrapper clear the cache"
+        query = Note.objects(self.db).where(text=u'foo')
+        note = query[0]
+        note.text = u'quux'
+        note.save()
+        self.assertEquals(query.count(), 0)
+        self.assertEquals(Note.objects(self.db).count(), 2)
+        Note.objects(self.db)[0].delete()
+        self.assertEquals(Note.objects(self.db).count(), 1)
+
+    def test_iter_documents(self):
+        "documents can be streamed without filling the result cache"
+        query = Note.objects(self.db).order_by('text')
+        self.assertEquals([x.text for x in iter_documents(query)],
+                          [u'bar', u'foo'])
+        self.assertEquals(query.query._cache, [])
+
+    def test_copies(self):
+        "cached documents are not shared"
+        Note.objects(self.db)[0].text = u'changed'
+        self.assertNotEquals(Note.objects(self.db)[0].text, u'changed')
+
+
+class GetObjectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = get_db(backend='doqu.ext.shelve_db',
+                         path=os.path.join(self.path, 'test.db'))
+        for text in u'foo', u'bar', u'bar':
+            Note(text=text).save(self.db)
+
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.path)
+
+    def test_conditions(self):
+        "exactly one match is required"
+        self.assertEquals(get_object_or_404(Note, self.db, text=u'foo').text,
+                          u'foo')
+        self.assertRaises(NotFound, get_object_or_404, Note, self.db,
+                          text=u'quux')
+        self.assertRaises(RuntimeError, get_object_or_404, Note, self.db,
+                          text=u'bar')
+
+    def test_pk(self):
+        "records can be fetched by primary key"
+        pk = Note.objects(self.db).where(text=u'foo')[0].pk
+        self.assertEquals(get_object_or_404(Note, self.db, pk).text, u'foo')
+        self.assertRaises(NotFound, get_object_or_404, Note, self.db, 'x')
+        self.assertRaises(TypeError, get_object_or_404, Note, self.db, pk,
+                          text=u'foo')
+
+    def test_field_names(self):
+        "fields named like the arguments can be used as conditions"
+        class Item(Document):
+            structure = {'pk': unicode, 'storage': unicode}
+        Item(pk=u'a', storage=u'b').save(self.db)
+        item = get_object_or_404(Item, self.db, pk=u'a', storage=u'b')
+        self.assertEquals(item.storage, u'b')
+        self.assertRaises(NotFound, get_object_or_404, Item, self.db,
+                          pk=u'b')
+
+
+class BulkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = get_db(backend='doqu.ext.shelve_db',
+                         path=os.path.join(self.path, 'test.db'))
+
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.path)
+
+    def test_save(self):
+        "invalid documents are reported, valid ones are saved"
+        calls = []
+        tasks = (Task(title=x) for x in [u'a', None, u'b', u'c'])
+        result = bulk_save(tasks, self.db, chunk_size=3,
+                           progress=lambda *args: calls.append(args))
+        self.assertEquals(len(result.keys), 3)
+        self.assertEquals([x[0] for x in result.errors], [1])
+        self.assertEquals(calls, [(3, 1), (4, 1)])
+        self.assertEquals(len(self.db), 3)
+
+    def test_delete(self):
+        "documents and keys can be deleted"
+        keys = bulk_save([Task(title=x) for x in u'abc'], self.db).keys
+        first = self.db.get(keys[0], Task)
+        result = bulk_delete([first, keys[1], 'missing'], self.db)
+        self.assertEquals(result.processed, 3)
+        self.assertEquals(len(result.errors), 1)
+        self.assertEquals(list(self.db), [keys[2]])
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        conf = {'extensions': {PLUGIN: {
+            'default': {'backend': 'doqu.ext.shelve_db',
+                        'path': os.path.join(self.path, 'test.db')},
+            'other': {'backend': 'doqu.ext.shelve_db',
+                      'path': os.path.join(self.path, 'other.db')}}}}
+        self.app = Application(conf)
+        self.plugin = self.app.get_extension(PLUGIN)
+        self.db = self.plugin.env['default']
+        self.other = self.plugin.env['other']
+        self.when = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+        Note(text=u'foo').save(self.db)
+        self.db.save('x', {'title': u'bar', 'date': self.when,
+                           'price': decimal.Decimal('1.5')})
+
+    def tearDown(self):
+        self.db.disconnect()
+        self.other.disconnect()
+        shutil.rmtree(self.path)
+
+    def assertCopied(self):
+        self.assertEquals(len(self.other), 2)
+        self.assertEquals(self.other.get('x'),
+                          self.db.get('x'))
+
+    def test_ndjson(self):
+        "all records survive a round trip through compressed JSON"
+        path = os.path.join(self.path, 'dump.ndjson.gz')
+        self.assertEquals(self.plugin.export_records(path,
+                                                     compression='gzip'), 2)
+        result = self.plugin.import_records(path, database='other')
+        self.assertEquals(result.errors, [])
+        self.assertEquals((result.count, result.keys), (2, None))
+        self.assertCopied()
+
+    def test_pickle(self):
+        "all records survive a round trip through pickle"
+        path = os.path.join(self.path, 'dump.pickle.bz2')
+        self.plugin.export_records(path, format='pickle', compression='bz2')
+        self.plugin.import_records(path, database='other')
+        self.assertCopied()
+
+    def test_models(self):
+        "models are exported to separate files in parallel"
+        counts = self.plugin.export_models(os.path.join(self.path, 'dump'),
+                                           [Note, Document], processes=2)
+        self.assertEquals(counts.values(), [2, 2])
+        for path in counts:
+            self.plugin.import_records(path, database='other')
+        self.assertCopied()
+
+    def test_model_query(self):
+        "only records that match the model query are exported"
+        # the shelve backend cannot apply the filter of required fields
+        where_not = shelve_db.QueryAdapter._where_not
+        shelve_db.QueryAdapter._where_not = (lambda query, **conditions:
+            query._QueryAdapter__where(conditions, negate=True))
+        self.addCleanup(setattr, shelve_db.QueryAdapter, '_where_not',
+                        where_not)
+        Task(title=u'baz').save(self.db)
+        path = os.path.join(self.path, 'tasks.ndjson')
+        self.assertEquals(self.plugin.export_records(path, Task), 2)
+        self.plugin.import_records(path, database='other')
+        self.assertEquals(sorted(x.title for x in Task.objects(self.other)),
+                          [u'bar', u'baz'])
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.raw = get_db(backend='doqu.ext.shelve_db',
+                          path=os.path.join(self.path, 'test.db'))
+        self.db = InstrumentedStorage(self.raw)
+        self.keys = [Note(text=x).save(self.raw) for x in u'abc']
+        documents.reset_query_stats()
+
+    def tearDown(self):
+        self.raw.disconnect()
+        shutil.rmtree(self.path)
+
+    def test_record(self):
+        "queries are recorded with their row counts"
+        [x for x in Note.objects(self.db).where(text=u'a')]
+        Note.objects(self.db).count()
+        summary = get_query_stats().summary()
+        self.assertEquals(summary['count'], 2)
+        self.assertEquals(summary['rows'], 2)
+        self.assertEquals(summary['models'][0]['name'], 'Note')
+
+    def test_repeated(self):
+        "identical and same-shaped queries are reported"
+        for key in self.keys:
+            self.db.get(key, Note)
+        for text in u'aab':
+            Note.objects(self.db).where(text=text).count()
+        summary = get_query_stats().summary(threshold=2)
+        self.assertEquals(summary['duplicates'],
+                          [("Note.where(text=u'a').count()", 2)])
+        self.assertEquals(summary['repeated'],
+                          [('Note.get(?)', 3), ('Note.where(text=?).count()', 2)])
+
+    def test_cached(self):
+        "cache hits are not recorded"
+        db = CachedStorage(self.db)
+        for i in range(3):
+            Note.objects(db).count()
+        self.assertEquals(get_query_stats().summary()['count'], 1)
+
+    def test_size(self):
+        "only the last calls are kept; the totals include all of them"
+        stats = QueryStats(size=2)
+        for i in range(5):
+            stats.record('Note', 'Note.get(1)', 'Note.get(?)', 0.5, 1)
+        summary = stats.summary()
+        self.assertEquals(len(stats.calls), 2)
+        self.assertEquals(summary['count'], 5)
+        self.assertEquals(summary['time'], 2.5)
+        self.assertEquals(summary['dropped'], 3)
+        self.assertEquals(summary['duplicates'], [('Note.get(1)', 2)])
@@ -1,7 +1,206 @@
 # -*- coding: utf-8 -*-
 
+from contextlib import contextmanager
+import datetime
+import os
+import shutil
+import tempfile
+import time
 import unittest
+from doqu import Document, get_db
 from tool.ext import pagination
+from tool.ext.pagination import Pagination
+
+
+class Event(Document):
+    structure = {'date': datetime.date}
+
+
+class Alarm(Document):
+    structure = {'time': datetime.time}
+
+
+class CursorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = get_db(backend='doqu.ext.shelve_db',
+                         path=os.path.join(self.path, 'test.db'))
+        self.dates = [datetime.date(2010, 1, x) for x in range(1, 6)]
+        for date in self.dates:
+            Event(date=date).save(self.db)
+        self.query = Event.objects(self.db)
+
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.path)
+
+    def paginate(self, **kwargs):
+        return Pagination(self.query, 2, 1, 'foo', key='date',
+                          with_count=False, **kwargs)
+
+    def get_dates(self, pagination):
+        return [x.date.day for x in pagination.entries]
+
+    def test_first(self):
+        "first page is fetched without a cursor"
+        pagination = self.paginate()
+        self.assertEquals(self.get_dates(pagination), [1, 2])
+        assert pagination.has_next
+        assert not pagination.has_previous
+        self.assertEquals(pagination.count, None)
+
+    def test_after(self):
+        "pages after given key"
+        pagination = self.paginate(after='2010-01-02')
+        self.assertEquals(self.get_dates(pagination), [3, 4])
+        assert pagination.has_next and pagination.has_previous
+        pagination = self.paginate(after='2010-01-04')
+        self.assertEquals(self.get_dates(pagination), [5])
+        assert not pagination.has_next
+
+    def test_before(self):
+        "pages before given key"
+        pagination = self.paginate(before='2010-01-04')
+        self.assertEquals(self.get_dates(pagination), [2, 3])
+        assert pagination.has_next and pagination.has_previous
+        pagination = self.paginate(before='2010-01-03')
+        self.assertEquals(self.get_dates(pagination), [1, 2])
+        assert not pagination.has_previous
+
+    def test_reverse(self):
+        "cursor works with descending order"
+        pagination = self.paginate(after='2010-01-04', reverse=True)
+        self.assertEquals(self.get_dates(pagination), [3, 2])
+
+    def test_time(self):
+        "time values can be used as cursors"
+        for hour in range(1, 4):
+            Alarm(time=datetime.time(hour, 30)).save(self.db)
+        pagination = Pagination(Alarm.objects(self.db), 1, 1, 'foo',
+                                key='time', after='01:30:00', with_count=False)
+        self.assertEquals(pagination.after, datetime.time(1, 30))
+        self.assertEquals([x.time.hour for x in pagination.entries], [2])
+        self.assertEquals(pagination._format_cursor(pagination.entries[0]),
+                          '02:30:00')
+
+    def test_offset(self):
+        "numbered pages still work"
+        pagination = Pagination(self.query.order_by('date'), 2, 3, 'foo')
+        self.assertEquals(self.get_dates(pagination), [5])
+        self.assertEquals(pagination.pages, 3)
+        assert not pagination.has_next
+
+
+class CountTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = get_db(backend='doqu.ext.shelve_db',
+                         path=os.path.join(self.path, 'test.db'))
+        for day in range(1, 6):
+            Event(date=datetime.date(2010, 1, day)).save(self.db)
+        self.db.save('x', {'foo': 'bar'})
+        self.query = Event.objects(self.db).where(date__gt=datetime.date(2009,
+                                                                         1, 1))
+
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.path)
+
+    def test_cached(self):
+        "cached counts survive between requests"
+        key = object()
+        pagination = Pagination(self.query, 2, 1, 'foo',
+                                count_strategy='cached', count_key=key)
+        self.assertEquals(pagination.count, 5)
+        for day in 1, 2:
+            Event(date=datetime.date(2010, 2, day)).save(self.db)
+        pagination = Pagination(self.query, 2, 3, 'foo',
+                                count_strategy='cached', count_key=key)
+        self.assertEquals(pagination.count, 5)
+        self.assertEquals(pagination.pages, 3)
+        # the next page is detected by looking ahead
+        assert pagination.has_next
+        self.assertEquals(len(pagination.entries), 2)
+
+    def test_estimated(self):
+        "estimated count is an upper bound"
+        pagination = Pagination(self.query, 2, 3, 'foo',
+                                count_strategy='estimated')
+        self.assertEquals(pagination.count, 6)
+        assert pagination.count_is_estimate
+        assert not pagination.has_next
+        self.assertEquals(pagination.last, None)
+        self.assertEquals(len(pagination.entries), 1)
+
+
+class PrefetchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings = dict(backend='doqu.ext.shelve_db',
+                             path=os.path.join(self.path, 'test.db'))
+        self.db = get_db(**self.settings)
+        for day in range(1, 6):
+            Event(date=datetime.date(2010, 1, day)).save(self.db)
+        self.query = Event.objects(self.db).order_by('date')
+        self.handles = []
+
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.path)
+
+    @contextmanager
+    def open_query(self):
+        db = get_db(**self.settings)
+        self.handles.append(db)
+        try:
+            yield Event.objects(db).order_by('date')
+        finally:
+            db.disconnect()
+
+    def paginate(self, page, session='s'):
+        return Pagination(self.query, 2, page, 'foo', prefetch_session=session,
+                          prefetch_key='events', prefetch_query=self.open_query)
+
+    def wait(self, key):
+        for i in range(100):
+            if pagination._prefetched.get(key):
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_prefetch(self):
+        "next page is fetched in advance on another handle and served once"
+        first = self.paginate(1)
+        self.assertEquals(len(first.entries), 2)
+        key = self.paginate(2)._cache_key
+        assert self.wait(key)
+        assert self.handles and self.handles[0] is not self.db
+        second = self.paginate(2)
+        self.assertEquals([x.date.day for x in second.entries], [3, 4])
+        self.assertEquals(pagination._prefetched.get(key), None)
+
+    def test_cancel(self):
+        "prefetched page is discarded when the user goes elsewhere"
+        self.paginate(1).entries
+        key = self.paginate(2)._cache_key
+        assert self.wait(key)
+        self.paginate(3).entries
+        self.assertEquals(pagination._prefetched.get(key), None)
+
+    def test_sessions(self):
+        "sessions do not cancel each other's prefetches"
+        self.paginate(1, session='a').entries
+        self.paginate(1, session='b').entries
+        assert self.wait(self.paginate(2, session='a')._cache_key)
+        assert self.wait(self.paginate(2, session='b')._cache_key)
+
+    def test_without_query(self):
+        "nothing is prefetched without a separate query"
+        paginated = Pagination(self.query, 2, 1, 'foo', prefetch_session='s',
+                               prefetch_key='events')
+        self.assertEquals(len(paginated.entries), 2)
+        self.assertEquals(paginated._cache_key, None)
+        self.assertEquals(self.handles, [])
 
 
 class SomeTestCase(unittest.TestCase):
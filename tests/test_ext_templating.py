@@ -1,16 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import os
+import shutil
+import tempfile
 import jinja2
+try:
+    import mako.exceptions
+except ImportError:
+    mako = None
 import pydispatch#.errors import DispatcherKeyError
 import unittest
 import werkzeug
-from tool import Application
+from tool import Application, WebApplication
 #from tool.application import app_manager_ready, request_ready
 #from tool import signals
-from tool.ext.templating import render_response, as_html
+from tool.ext.templating import (render_response, stream_response, as_html,
+                                 cache_fragment, invalidate_fragments,
+                                 templates_changed, make_stats_command,
+                                 _buffer_chunks)
 
 
 PLUGIN = 'tool.ext.templating.JinjaPlugin'
+MAKO_PLUGIN = 'tool.ext.templating.MakoPlugin'
 
 
 class FunctionsTestCase(unittest.TestCase):
@@ -37,6 +48,33 @@ class FunctionsTestCase(unittest.TestCase):
         assert isinstance(result, werkzeug.Response)
         self.assertEquals(result.data, 'foo is "bar".')
 
+    def test_stream_template(self):
+        "file + context = chunks of html"
+        result = self.ext.stream_template('tmpl.html', dict(foo='bar'))
+        self.assertEquals(list(result), ['foo is "bar".'])
+
+    def test_buffer_chunks(self):
+        "small chunks are joined until the buffer is full"
+        chunks = iter(['a', 'bc', 'd', 'efgh', 'i'])
+        self.assertEquals(list(_buffer_chunks(chunks, 3)),
+                          ['abc', 'defgh', 'i'])
+
+    def test_stream_response(self):
+        "file + context = streamed response object"
+        result = stream_response('tmpl.html', foo='bar')
+        assert isinstance(result, werkzeug.Response)
+        assert result.is_streamed
+        self.assertEquals(result.data, 'foo is "bar".')
+
+    def test_as_html_stream(self):
+        @as_html('tmpl.html', stream=True)
+        def my_view(foo=None):
+            return {'foo': foo}
+
+        result = my_view(foo='bar')
+        assert result.is_streamed
+        self.assertEquals(result.data, 'foo is "bar".')
+
     def test_as_html_dictionary(self):
         @as_html('tmpl.html')
         def my_view(foo=None):
@@ -63,6 +101,57 @@ class FunctionsTestCase(unittest.TestCase):
         # consider these cases not valuable and not worth even being
         # documented so `as_html` can change the implementation freely.
 
+    def test_list_templates(self):
+        "all templates in searchpaths are listed"
+        self.assertEquals(self.ext.list_templates(),
+                          ['broken.html', 'tmpl.html'])
+        self.assertEquals(self.ext.list_templates(extensions=['txt']), [])
+
+    def test_compile_templates(self):
+        "syntax errors are reported by template path"
+        errors = self.ext.compile_templates()
+        self.assertEquals(list(errors), ['broken.html'])
+        assert errors['broken.html'].startswith('line 1: ')
+
+    def test_compile_templates_processes(self):
+        "templates can be compiled by a pool of processes"
+        errors = self.ext.compile_templates(processes=2)
+        self.assertEquals(list(errors), ['broken.html'])
+
+    def test_compile_other_files(self):
+        "non-template files are skipped and undecodable files reported"
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        files = [('ok.html', '{{ foo }}'), ('logo.png', '\x89PNG\xff'),
+                 ('latin.txt', 'caf\xe9'), ('.hidden.html', '')]
+        for name, data in files:
+            with open(os.path.join(path, name), 'wb') as f:
+                f.write(data)
+        app = Application({'extensions': {PLUGIN: {'searchpaths': [path]}}})
+        ext = app.get_extension(PLUGIN)
+        self.assertEquals(ext.list_templates(), ['latin.txt', 'ok.html'])
+        errors = ext.compile_templates()
+        self.assertEquals(list(errors), ['latin.txt'])
+
+    def test_fragment_cache_tag(self):
+        "fragments are rendered once and reused until invalidated"
+        jinja_env = self.ext.env['templating_env']
+        tmpl = jinja_env.from_string('{% cache "nav:" ~ ns, 60 %}'
+                                     '{{ foo }}{% endcache %}')
+        self.assertEquals(tmpl.render(ns='a', foo=1), '1')
+        self.assertEquals(tmpl.render(ns='a', foo=2), '1')
+        self.assertEquals(tmpl.render(ns='b', foo=2), '2')
+        self.ext.invalidate_fragments('nav:a')
+        self.assertEquals(tmpl.render(ns='a', foo=3), '3')
+        self.assertEquals(tmpl.render(ns='b', foo=3), '2')
+
+    def test_cache_fragment(self):
+        "fragments can be cached from Python code"
+        self.assertEquals(cache_fragment('foo', lambda: 'bar'), 'bar')
+        self.assertEquals(cache_fragment('foo', lambda: 'quux'), 'bar')
+        invalidate_fragments()
+        self.assertEquals(cache_fragment('foo', lambda: 'quux'), 'quux')
+
     def test_templating_env(self):
         "Jinja environment is updated when Request object is ready"
         #assert hasattr(context, 'templating_env')
@@ -86,3 +175,160 @@ class FunctionsTestCase(unittest.TestCase):
         self.assertEquals(tmpl.render(), expected)
 
         """
+
+
+class MemoizedTemplatesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.write('tmpl.html', 'one')
+        conf = {
+            'extensions': {
+                PLUGIN: {
+                    'searchpaths': [self.path],
+                    'memoize_templates': True}}}
+        self.app = Application(conf)
+        self.ext = self.app.get_extension(PLUGIN)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, text):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(text)
+
+    def test_memoized(self):
+        "templates are not reloaded from disk until told so"
+        self.assertEquals(self.ext.render_template('tmpl.html', {}), 'one')
+        self.write('tmpl.html', 'two')
+        self.ext.env['templating_env'].cache.clear()
+        self.assertEquals(self.ext.render_template('tmpl.html', {}), 'one')
+        templates_changed.send()
+        self.assertEquals(self.ext.render_template('tmpl.html', {}), 'two')
+
+    def test_missing_memoized(self):
+        "missing templates are remembered as missing"
+        render = lambda: self.ext.render_template('new.html', {})
+        self.assertRaises(jinja2.TemplateNotFound, render)
+        self.write('new.html', 'new')
+        self.assertRaises(jinja2.TemplateNotFound, render)
+        templates_changed.send()
+        self.assertEquals(render(), 'new')
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name, text in [
+            ('base.html', '<{% block content %}{% endblock %}>'),
+            ('child.html', '{% extends "base.html" %}'
+                           '{% block content %}{{ foo }}{% endblock %}')]:
+            with open(os.path.join(self.path, name), 'w') as f:
+                f.write(text)
+        conf = {
+            'extensions': {
+                PLUGIN: {
+                    'searchpaths': [self.path],
+                    'profile_blocks': True}}}
+        self.app = Application(conf)
+        self.ext = self.app.get_extension(PLUGIN)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_render_stats(self):
+        "render count, time and size are recorded per template and block"
+        for i in range(3):
+            result = self.ext.render_template('child.html', {'foo': 'bar'})
+        self.assertEquals(result, '<bar>')
+        stats = dict((x['name'], x)
+                     for x in self.ext.get_render_stats().summary())
+        self.assertEquals(sorted(stats), ['child.html', 'child.html#content'])
+        self.assertEquals(stats['child.html']['count'], 3)
+        self.assertEquals(stats['child.html']['size'], 5)
+        self.assertEquals(stats['child.html#content']['size'], 3)
+        assert stats['child.html']['p95'] <= stats['child.html']['total']
+
+    def test_stream_stats(self):
+        "streamed templates are recorded when the stream is exhausted"
+        chunks = self.ext.stream_template('child.html', {'foo': 'bar'})
+        assert not self.ext.get_render_stats().summary()
+        self.assertEquals(''.join(chunks), '<bar>')
+        names = [x['name'] for x in self.ext.get_render_stats().summary()]
+        assert 'child.html' in names
+
+    def test_stats_command_stream(self):
+        "the stats command reads streamed responses to the end"
+        app = WebApplication({'extensions': {
+            PLUGIN: {'searchpaths': [self.path], 'profile': True}}})
+        ext = app.get_extension(PLUGIN)
+        def view(environ, start_response):
+            response = stream_response('child.html', foo='bar')
+            return response(environ, start_response)
+        app.wrap_in(lambda inner: view)
+        class Args:
+            urls = ['/']
+            number = 2
+        output = list(make_stats_command(ext)(Args()))
+        self.assertEquals(len(output), 2)
+        self.assertEquals(output[1].split()[0], '2')
+        assert output[1].endswith(' child.html')
+
+
+@unittest.skipIf(mako is None, 'Mako is not installed')
+class MakoTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, 'sub'))
+        with open(os.path.join(self.path, 'sub', 'tmpl.html'), 'w') as f:
+            f.write('foo is "${foo}".')
+        conf = {
+            'extensions': {
+                MAKO_PLUGIN: {
+                    'searchpaths': [self.path],
+                    'cache_dir': os.path.join(self.path, 'cache'),
+                    'collection_size': 10}}}
+        self.app = Application(conf)
+        self.ext = self.app.get_extension(MAKO_PLUGIN)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_render_template(self):
+        "templates are found by the index"
+        self.assertEquals(self.ext.list_templates(), ['sub/tmpl.html'])
+        result = self.ext.render_template('/sub/tmpl.html', dict(foo='bar'))
+        self.assertEquals(result, 'foo is "bar".')
+        assert os.listdir(os.path.join(self.path, 'cache'))
+
+    def test_list_templates(self):
+        "compiled modules in a cache_dir inside a search path are not listed"
+        self.ext.render_template('sub/tmpl.html', dict(foo='bar'))
+        with open(os.path.join(self.path, 'sub', '.tmpl.html.swp'), 'w'):
+            pass
+        self.ext.reload_templates()
+        self.assertEquals(self.ext.list_templates(), ['sub/tmpl.html'])
+
+    def test_new_template(self):
+        "templates added after indexing are found if filesystem_checks is on"
+        with open(os.path.join(self.path, 'new.html'), 'w') as f:
+            f.write('new')
+        self.assertEquals(self.ext.render_template('new.html', {}), 'new')
+
+    def test_reindex(self):
+        "templates can be looked up while the index is rebuilt"
+        lookup = self.ext.env['templating_env']
+        lookup.filesystem_checks = False
+        found = []
+        index_directory = lookup._index_directory
+        def index_and_look_up(directory, index):
+            # as if another thread rendered the template meanwhile
+            found.append(lookup.get_template('sub/tmpl.html'))
+            index_directory(directory, index)
+        lookup._index_directory = index_and_look_up
+        self.ext.reload_templates()
+        self.assertEquals(len(found), 1)
+        self.assertEquals(lookup.index.keys(), ['sub/tmpl.html'])
+
+    def test_missing_template(self):
+        self.assertRaises(mako.exceptions.TopLevelLookupException,
+                          lambda: self.ext.render_template('nope.html', {}))
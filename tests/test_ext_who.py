@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from doqu import Document, get_db
+from doqu.ext import shelve_db
+from paste.auth import auth_tkt
+from tool.ext.who import hashing, who_plugins
+from tool.ext.who.schema import User
+from tool.ext.who.hashing import (PasswordHasher, make_password_hash,
+                                  verify_password_hash)
+from tool.ext.who.who_plugins import CachedAuthTktCookiePlugin, DoquPlugin
+from werkzeug import generate_password_hash
+
+
+class FakeInstance(object):
+    def __init__(self, pk):
+        self.pk = pk
+
+
+class FakeFeature(object):
+    def __init__(self, db):
+        self.env = {'database': db}
+
+
+def _where_not(query, **conditions):
+    # the shelve backend passes the conditions to _where() positionally, so
+    # User.objects() fails on the filter added by required fields
+    return query._QueryAdapter__where(conditions, negate=True)
+
+
+class UsersTestCase(unittest.TestCase):
+    "Base class for tests with users in a shelve storage."
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = get_db(backend='doqu.ext.shelve_db',
+                         path=os.path.join(self.path, 'test.db'))
+        where_not = shelve_db.QueryAdapter._where_not
+        shelve_db.QueryAdapter._where_not = _where_not
+        self.addCleanup(setattr, shelve_db.QueryAdapter, '_where_not',
+                        where_not)
+        hashing.configure_hasher(iterations=1000)
+        self.addCleanup(hashing.configure_hasher)
+
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.path)
+
+    def make_user(self, username, password=u'secret'):
+        user = User(username=username)
+        user.set_password(password)
+        user.save(self.db)
+        return user
+
+
+class DoquPluginTestCase(UsersTestCase):
+    def setUp(self):
+        super(DoquPluginTestCase, self).setUp()
+        # the plugin reads the storage from the authentication extension
+        get_feature = who_plugins.get_feature
+        who_plugins.get_feature = lambda name: FakeFeature(self.db)
+        self.addCleanup(setattr, who_plugins, 'get_feature', get_feature)
+        self.user = self.make_user(u'john')
+        self.plugin = DoquPlugin()
+
+        self.checks = []
+        check_password = User.__dict__['check_password']
+        def count_checks(user, raw_password):
+            self.checks.append(user.username)
+            return check_password(user, raw_password)
+        User.check_password = count_checks
+        self.addCleanup(setattr, User, 'check_password', check_password)
+
+    def authenticate(self, username=u'john', password=u'secret'):
+        return self.plugin.authenticate({}, {'login': username,
+                                             'password': password})
+
+    def test_authenticate(self):
+        "only valid credentials are accepted"
+        self.assertEquals(self.authenticate(), self.user.pk)
+        self.assertEquals(self.authenticate(password=u'wrong'), None)
+        self.assertEquals(self.authenticate(username=u'jane'), None)
+        self.assertEquals(self.plugin.authenticate({}, {}), None)
+
+    def test_cache_hit(self):
+        "a repeated login does not check the password again"
+        self.authenticate()
+        self.assertEquals(self.authenticate(), self.user.pk)
+        self.assertEquals(self.checks, [u'john'])
+        identity = {'repoze.who.userid': self.user.pk}
+        self.plugin.add_metadata({}, identity)
+        self.assertEquals(identity['instance'].username, u'john')
+
+    def test_save(self):
+        "a changed password invalidates the cached login"
+        self.authenticate()
+        self.user.set_password(u'changed')
+        self.user.save(self.db)
+        self.assertEquals(self.authenticate(), None)
+        self.assertEquals(self.authenticate(password=u'changed'),
+                          self.user.pk)
+
+    def test_rename(self):
+        "the old username is not accepted after a rename"
+        self.authenticate()
+        self.user.username = u'johnny'
+        self.user.save(self.db)
+        self.assertEquals(self.authenticate(), None)
+        self.assertEquals(self.authenticate(username=u'johnny'),
+                          self.user.pk)
+
+    def test_delete(self):
+        "a deleted user cannot log in with a cached login"
+        self.authenticate()
+        self.user.delete()
+        self.assertEquals(self.authenticate(), None)
+
+    def test_ttl(self):
+        "cached logins and users expire"
+        self.plugin = DoquPlugin(cache_ttl=0.01)
+        self.authenticate()
+        time.sleep(0.02)
+        self.authenticate()
+        self.assertEquals(self.checks, [u'john', u'john'])
+
+    def test_no_cache(self):
+        "nothing is cached if the cache size is 0"
+        self.plugin = DoquPlugin(cache_size=0)
+        self.authenticate()
+        self.authenticate()
+        self.assertEquals(self.checks, [u'john', u'john'])
+
+
+class UsernameIndexTestCase(UsersTestCase):
+    def setUp(self):
+        super(UsernameIndexTestCase, self).setUp()
+        self.user = self.make_user(u'john')
+        self.plugin = DoquPlugin()
+        self.index = self.plugin._index
+
+    def save_quietly(self, user, db=None):
+        # as if the user was saved by another process
+        Document.save(user, db or self.db)
+
+    def test_build(self):
+        "the index is built from the storage on first use"
+        self.assertEquals(self.index.get(self.db, u'john'), self.user.pk)
+        self.assertEquals(self.index.get(self.db, u'jane'), None)
+
+    def test_update(self):
+        "users saved or deleted in the storage are updated in the index"
+        self.index.get(self.db, u'john')
+        jane = self.make_user(u'jane')
+        self.assertEquals(self.index._keys,
+                          {u'john': self.user.pk, u'jane': jane.pk})
+        self.user.username = u'johnny'
+        self.user.save()
+        self.assertEquals(self.index.get(self.db, u'johnny'), self.user.pk)
+        self.assertEquals(self.index.get(self.db, u'john'), None)
+        jane.delete()
+        self.assertEquals(self.index._keys, {u'johnny': self.user.pk})
+
+    def test_other_storage(self):
+        "changes in another storage do not reach the index"
+        self.index.get(self.db, u'john')
+        other = get_db(backend='doqu.ext.shelve_db',
+                       path=os.path.join(self.path, 'other.db'))
+        user = User(username=u'jane', password=u'x$y')
+        user.save(other)
+        self.assertEquals(self.index.get(self.db, u'jane'), None)
+        user.delete()
+        other.disconnect()
+        self.assertEquals(self.index.get(self.db, u'john'), self.user.pk)
+
+    def test_stale_key(self):
+        "a key is only trusted if the user still has the username"
+        self.index.get(self.db, u'john')
+        self.user.username = u'johnny'
+        self.save_quietly(self.user)
+        self.assertEquals(self.plugin._find_user(self.db, u'john'), None)
+        self.assertEquals(self.plugin._find_user(self.db, u'johnny').pk,
+                          self.user.pk)
+        self.assertEquals(self.index.get(self.db, u'johnny'), self.user.pk)
+
+    def test_fallback(self):
+        "users unknown to the index are found with a query"
+        self.index.get(self.db, u'john')
+        jane = User(username=u'jane', password=u'x$y')
+        self.save_quietly(jane)
+        self.assertEquals(self.index.get(self.db, u'jane'), None)
+        self.assertEquals(self.plugin._find_user(self.db, u'jane').pk,
+                          jane.pk)
+        self.assertEquals(self.index.get(self.db, u'jane'), jane.pk)
+        self.assertEquals(self.plugin._find_user(self.db, u'nobody'), None)
+
+
+class TicketPluginTestCase(unittest.TestCase):
+    def setUp(self):
+        self.plugin = CachedAuthTktCookiePlugin('secret')
+        self.parsed = []
+        parse_ticket = auth_tkt.parse_ticket
+        def count_parses(*args, **kwargs):
+            self.parsed.append(args[1])
+            return parse_ticket(*args, **kwargs)
+        auth_tkt.parse_ticket = count_parses
+        self.addCleanup(setattr, auth_tkt, 'parse_ticket', parse_ticket)
+
+    def make_environ(self, userid='john', timestamp=None):
+        ticket = auth_tkt.AuthTicket('secret', userid, '0.0.0.0',
+                                     time=timestamp)
+        return {'HTTP_COOKIE': 'auth_tkt="{0}"'.format(ticket.cookie_value()),
+                'HTTP_HOST': 'localhost'}
+
+    def test_identify(self):
+        "a ticket is parsed once and then taken from the cache"
+        environ = self.make_environ()
+        identity = self.plugin.identify(environ)
+        self.assertEquals(identity['repoze.who.userid'], 'john')
+        environ = self.make_environ()
+        self.assertEquals(self.plugin.identify(environ), identity)
+        self.assertEquals(environ['AUTH_TYPE'], 'cookie')
+        self.assertEquals(len(self.parsed), 1)
+
+    def test_remember(self):
+        "the cookie is not parsed again to remember the same identity"
+        environ = self.make_environ()
+        identity = self.plugin.identify(environ)
+        identity['instance'] = object()
+        self.assertEquals(self.plugin.remember(environ, identity), None)
+        self.assertEquals(len(self.parsed), 1)
+
+        headers = self.plugin.remember(environ, {'repoze.who.userid': 'jane'})
+        assert headers and headers[0][0] == 'Set-Cookie', headers
+        self.assertEquals(len(self.parsed), 2)
+
+    def test_reissue(self):
+        "an old ticket is reissued"
+        self.plugin.reissue_time = 10
+        environ = self.make_environ(timestamp=time.time() - 20)
+        identity = self.plugin.identify(environ)
+        headers = self.plugin.remember(environ, identity)
+        assert headers and headers[0][0] == 'Set-Cookie', headers
+
+    def test_forget_user(self):
+        "tickets of a changed user are parsed again"
+        self.plugin.identify(self.make_environ())
+        self.plugin.forget_user(instance=FakeInstance('john'))
+        self.plugin.identify(self.make_environ())
+        self.assertEquals(len(self.parsed), 2)
+
+    def test_forget(self):
+        "a logout evicts the ticket"
+        environ = self.make_environ()
+        identity = self.plugin.identify(environ)
+        self.plugin.forget(environ, identity)
+        self.plugin.identify(self.make_environ())
+        self.assertEquals(len(self.parsed), 2)
+
+    def test_changes(self):
+        "changes are only kept while tickets cached before them may exist"
+        self.plugin.cache_ttl = 0.01
+        self.plugin.forget_user(instance=FakeInstance('a'))
+        time.sleep(0.02)
+        self.plugin.forget_user(instance=FakeInstance('b'))
+        self.assertEquals(list(self.plugin._changes), ['b'])
+
+        self.plugin.cache_size = 1
+        self.plugin.identify(self.make_environ())
+        self.plugin.forget_user(instance=FakeInstance('c'))
+        self.assertEquals(list(self.plugin._changes), [])
+        self.assertEquals(len(self.plugin._tickets), 0)
+
+
+class HashingTestCase(unittest.TestCase):
+    def test_verify(self):
+        "passwords are checked against PBKDF2 and Werkzeug hashes"
+        pwhash = make_password_hash(u'sécret', iterations=1000)
+        assert pwhash.startswith('pbkdf2:sha256:1000$')
+        assert verify_password_hash(pwhash, u'sécret')
+        assert verify_password_hash(unicode(pwhash), u'sécret')
+        assert not verify_password_hash(pwhash, u'secret')
+        assert verify_password_hash(generate_password_hash('x'), 'x')
+
+    def test_bad_hash(self):
+        "malformed hashes do not match any password"
+        pwhash = make_password_hash(u'secret', iterations=1000)
+        assert not verify_password_hash(pwhash + u'é', u'secret')
+        assert not verify_password_hash(u'pbkdf2:sha256:x$a$b', u'secret')
+        assert not verify_password_hash(u'pbkdf2:sha256$a', u'secret')
+        self.assertRaises(ValueError, make_password_hash, u'x', 'md5')
+
+
+class PasswordHasherTestCase(unittest.TestCase):
+    def make_hasher(self, **kwargs):
+        hasher = PasswordHasher(iterations=1000, **kwargs)
+        self.addCleanup(hasher.close)
+        return hasher
+
+    def test_inline(self):
+        "hashes are computed in the calling thread by default"
+        hasher = self.make_hasher()
+        assert hasher.check(hasher.make(u'secret'), u'secret')
+        self.assertEquals(hasher._pool, None)
+
+    def test_pool(self):
+        "hashes are computed in worker processes"
+        hasher = self.make_hasher(processes=1)
+        pwhash = hasher.make(u'secret')
+        assert hasher.check(pwhash, u'secret')
+        assert not hasher.check(pwhash, u'wrong')
+        self.assertEquals(hasher._pending, 0)
+
+    def test_error(self):
+        "errors in workers are raised and free the queue"
+        hasher = self.make_hasher(processes=1, method='md5')
+        self.assertRaises(ValueError, hasher.make, u'secret')
+        self.assertEquals(hasher._pending, 0)
+
+    def test_timeout(self):
+        "a slow computation occupies the queue until it is done"
+        hasher = self.make_hasher(processes=1, queue_size=1, timeout=0.05)
+        hasher.iterations = 10 ** 8
+        self.assertRaises(RuntimeError, hasher.make, u'secret')
+        self.assertEquals(hasher._pending, 1)
+        self.assertRaises(RuntimeError, hasher.make, u'secret')
@@ -356,11 +356,18 @@ class WebApplication(Application):
         See, what we get is the last application in the list -- or the
         *outermost middleware*. This is the real WSGI application.
 
+        Middleware with a true `outermost` attribute is wrapped around the
+        rest of the stack regardless of the order of extensions, so that it
+        is called even if inner middleware (e.g. routing) does not call the
+        application it wraps.
+
         Result is cached.
         """
         logger.debug('Compiling WSGI application')
         outermost = self._innermost_wsgi_app
-        for factory, args, kwargs in self.wsgi_stack:
+        stack = sorted(self.wsgi_stack,
+                       key=lambda x: bool(getattr(x[0], 'outermost', False)))
+        for factory, args, kwargs in stack:
             _tmp_get_name=lambda x: getattr(x, '__name__', type(x).__name__)
             logger.debug('Wrapping WSGI application in {0}'.format(
                                 _tmp_get_name(factory)))
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Caching
+=======
+
+Simple cache backends for Tool extensions. They are used e.g. for fragment
+caching in :doc:`ext_templating`.
+
+All backends share the same API::
+
+    cache = LRUCache(size=100, default_ttl=60)
+    cache.set('nav:main', html)
+    cache.get('nav:main')              # --> html
+    cache.delete_prefix('nav:')        # removes all navigation fragments
+    cache.get('nav:main', 'nothing')   # --> 'nothing'
+
+Available backends:
+
+* :class:`LRUCache` — in-process, bounded, thread-safe;
+* :class:`FileCache` — pickled values in a directory; can be shared by
+  processes. Point it to a memory-backed filesystem (e.g. ``/dev/shm``) to
+  share data between processes without touching the disk.
+
+Extensions usually let the user choose the backend in the configuration. Such
+settings are processed by :func:`make_cache`.
+
+API reference
+-------------
+"""
+from collections import OrderedDict
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from tool.importing import import_attribute
+
+
+__all__ = ['BaseCache', 'LRUCache', 'FileCache', 'make_cache']
+
+
+BACKENDS = {
+    'lru': 'tool.cache.LRUCache',
+    'file': 'tool.cache.FileCache',
+}
+
+
+class BaseCache(object):
+    """Abstract cache backend.
+
+    :param default_ttl:
+        Number of seconds after which an item expires unless another value is
+        given to :meth:`set`. If `None`, items do not expire. Note that ``0``
+        means "expire at once", i.e. the item is not stored at all.
+
+    """
+    def __init__(self, default_ttl=None):
+        self.default_ttl = default_ttl
+
+    def _get_expiry(self, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        return None if ttl is None else time.time() + ttl
+
+    def _is_expired(self, expires):
+        return expires is not None and expires <= time.time()
+
+    def get(self, key, default=None):
+        "Returns the value for given key or `default` if there is no value."
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Stores given value under given key for `ttl` seconds. If `ttl` is
+        `None`, `default_ttl` is used. If it is zero or negative, the value is
+        not stored (and an older value is removed).
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        "Removes given key from the cache (if it is there)."
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix):
+        "Removes all string keys that start with given prefix."
+        raise NotImplementedError
+
+    def clear(self):
+        "Removes all items from the cache."
+        raise NotImplementedError
+
+    def get_or_set(self, key, factory, ttl=None):
+        """Returns the value for given key. If there is no value, calls
+        `factory` without arguments, stores the result and returns it.
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = factory()
+            self.set(key, value, ttl)
+        return value
+
+
+class LRUCache(BaseCache):
+    """In-process cache that holds at most `size` items. The least recently
+    used items are discarded first.
+    """
+    def __init__(self, size=1000, default_ttl=None):
+        super(LRUCache, self).__init__(default_ttl)
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return default
+            if self._is_expired(expires):
+                return default
+            self._items[key] = expires, value
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = self._get_expiry(ttl)
+        with self._lock:
+            self._items.pop(key, None)
+            if self._is_expired(expires):
+                return
+            self._items[key] = expires, value
+            while self.size < len(self._items):
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in list(self._items):
+                if isinstance(key, basestring) and key.startswith(prefix):
+                    del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class FileCache(BaseCache):
+    """Stores pickled items in files within given directory. The directory is
+    created if it does not exist. Keys must be strings (a `TypeError` is
+    raised otherwise) because the file name is derived from the key.
+    """
+    def __init__(self, path, default_ttl=None):
+        super(FileCache, self).__init__(default_ttl)
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _get_filename(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        elif not isinstance(key, str):
+            raise TypeError('FileCache keys must be strings, got {0!r}'
+                            .format(key))
+        return os.path.join(self.path, hashlib.md5(key).hexdigest())
+
+    def _load(self, filename):
+        "Returns a tuple of key, expiry time and value or `None`."
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def _iter_files(self):
+        for name in os.listdir(self.path):
+            if not name.startswith('.'):
+                yield os.path.join(self.path, name)
+
+    def get(self, key, default=None):
+        filename = self._get_filename(key)
+        item = self._load(filename)
+        if item is None or item[0] != key:
+            return default
+        stored_key, expires, value = item
+        if self._is_expired(expires):
+            self._remove(filename)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        item = key, self._get_expiry(ttl), value
+        if self._is_expired(item[1]):
+            self.delete(key)
+            return
+        # write to a temporary file and rename it so that concurrent readers
+        # never see a half-written item
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self._get_filename(key))
+
+    def delete(self, key):
+        self._remove(self._get_filename(key))
+
+    def delete_prefix(self, prefix):
+        for filename in self._iter_files():
+            item = self._load(filename)
+            if item is None:
+                continue
+            key = item[0]
+            if isinstance(key, basestring) and key.startswith(prefix):
+                self._remove(filename)
+
+    def clear(self):
+        for filename in self._iter_files():
+            self._remove(filename)
+
+
+def make_cache(backend='lru', **options):
+    """Returns a cache instance for given backend name and options. Usage::
+
+        make_cache()                                   # LRUCache()
+        make_cache('lru', size=50, default_ttl=10)
+        make_cache('file', path='/dev/shm/myapp')
+        make_cache('myproject.cache.RedisCache', host='localhost')
+
+    :param backend:
+        Either a short name (``lru`` or ``file``) or a dotted path to a class
+        that implements the :class:`BaseCache` API.
+
+    """
+    cls = import_attribute(BACKENDS.get(backend, backend))
+    return cls(**options)
+
+
+_missing = object()
@@ -16,21 +16,161 @@ Complete configuration example (see :doc:`application` for details)::
         tool.ext.werkzeug_routing.Routing:
             tool.ext.admin.views: /admin/
 
+Settings:
+
+* `references_limit` — how many referencing objects are listed per attribute
+  on the object page (default is 10);
+* `lazy_references` — if `True`, the list of referencing objects is loaded by
+  the object page in a separate request; if a number, this happens for models
+  that are referenced by at least that many attributes. Default is `False`;
+* `prefetch_pages` — if `True`, the next page of an object list is fetched in
+  advance for the same browser (identified by its cookies) on a handle
+  borrowed from the pool. Only works if the default database is pooled (see
+  :mod:`tool.ext.documents`). Default is `False`;
+* `search_index` — path to an SQLite file with the full-text index of fields
+  listed in `search_names` (see :mod:`tool.ext.admin.search`). Without it the
+  admin searches by scanning the collection and only supports one search
+  field per model.
+
+The index is updated when objects are saved or deleted through the admin.
+Doqu does not announce changes made elsewhere, so code that saves or deletes
+searchable objects outside of the admin must update the index itself::
+
+    admin_plugin = app.get_feature('admin')
+    item.save(db)
+    admin_plugin.update_search_index(item)
+    ...
+    item.delete()
+    admin_plugin.remove_from_search_index(Item, pk)
+
+or the index must be rebuilt from the storage after such changes::
+
+    $ ./manage.py admin reindex
+
+Models are registered with :func:`register` or :func:`register_for` at any
+time, also after the application has started. The admin options of all models
+are kept in an immutable :class:`AdminRegistry`; each registration replaces
+it with an updated copy, so views always see a consistent set of models
+(see :func:`get_registry`).
+
 .. _Doqu: http://pypi.python.org/pypi/doqu
 
 """
+from collections import namedtuple
 import os
+import threading
 
 from doqu import Document
 from tool import dist
 dist.check_dependencies(__name__)
-from copy import deepcopy
 from functools import wraps
+from werkzeug import cached_property
 from tool import app
+from tool.cli import arg, CommandError
 from tool.plugins import BasePlugin
+from tool.ext.admin.search import SearchIndex
 
 
 DEFAULT_NAMESPACE = 'main'
+DEFAULT_REFERENCES_LIMIT = 10
+
+
+def make_reindex_command(plugin):
+    """Factory that expects an admin plugin instance and returns the CLI
+    command `reindex` bound to that plugin.
+    """
+    @arg('-m', '--model', dest='models', action='append',
+         help='name of a registered model (repeatable); by default all '
+              'searchable models are reindexed')
+    def reindex(args):
+        """ Rebuilds the full-text search index from the storage.
+        """
+        index = plugin.env['search_index']
+        if index is None:
+            raise CommandError('The search_index setting is not defined.')
+        db = plugin.app.get_feature('document_storage').default_db
+        for options in get_registry():
+            if args.models and options.name not in args.models:
+                continue
+            if not options.search_names:
+                continue
+            count = index.rebuild(options.model, options.model.objects(db),
+                                  options.search_names)
+            yield u'{0}.{1}: indexed {2} objects.'.format(options.namespace,
+                                                          options.name, count)
+    return reindex
+
+
+class AdminOptions(namedtuple('AdminOptions', 'model namespace name url '
+                               'exclude ordering list_names search_names '
+                               'cursor_key count_strategy')):
+    """Admin options of a registered model (see :func:`register` for details).
+    Fields `model`, `namespace` and `name` identify the model.
+    """
+    __slots__ = ()
+
+
+class AdminRegistry(object):
+    """An immutable collection of :class:`AdminOptions` indexed by namespace
+    and model name. Iteration yields the options sorted by namespace and name.
+    """
+    def __init__(self, options=()):
+        self._by_name = dict(((x.namespace, x.name), x) for x in options)
+        # if a model is registered in several namespaces, the last
+        # registration wins
+        self._by_model = dict((x.model, x) for x in options)
+        self._namespaces = {}
+        for x in options:
+            self._namespaces.setdefault(x.namespace, {})[x.name] = x.model
+
+    def __iter__(self):
+        return (self._by_name[k] for k in sorted(self._by_name))
+
+    def __len__(self):
+        return len(self._by_name)
+
+    @property
+    def namespaces(self):
+        "Returns a dictionary of models by name in a dictionary by namespace."
+        return dict((k, dict(v)) for k, v in self._namespaces.iteritems())
+
+    def get(self, namespace, name):
+        "Returns options for given model name; raises `NameError` if unknown."
+        try:
+            return self._by_name[namespace, name]
+        except KeyError:
+            if namespace not in self._namespaces:
+                raise NameError('There is no registered namespace '
+                                '"{0}"'.format(namespace))
+            raise NameError('"{0}" is not a registered model in namespace '
+                            '{1}.'.format(name, namespace))
+
+    def get_for_model(self, model):
+        "Returns options for given document class or `None`."
+        return self._by_model.get(model)
+
+    def add(self, options):
+        "Returns a copy of the registry with given options added or replaced."
+        key = options.namespace, options.name
+        return AdminRegistry([x for x in self if (x.namespace, x.name) != key]
+                             + [options])
+
+    def remove(self, namespace, name):
+        "Returns a copy of the registry without given model."
+        return AdminRegistry([x for x in self
+                              if (x.namespace, x.name) != (namespace, name)])
+
+
+# replaced (not modified) on registration; see get_registry()
+_registry = AdminRegistry()
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Returns the current :class:`AdminRegistry`. Views should get it once per
+    request and use the same instance throughout.
+    """
+    return _registry
 
 
 class AdminWeb(BasePlugin):
@@ -39,18 +179,11 @@ class AdminWeb(BasePlugin):
                 '{routing}', '{breadcrumbs}')
 
     features = 'admin'
+    commands = cached_property(lambda self: [make_reindex_command(self)])
 
-    # admin-specific; non thread-local
-    registry = {
-        'registered_models': {},
-        'urls_for_models': {},
-        'excluded_names': {},
-        'ordering': {},
-        'list_names': {},
-        'search_names': {},
-    }
-
-    def make_env(self):
+    def make_env(self, references_limit=DEFAULT_REFERENCES_LIMIT,
+                 lazy_references=False, prefetch_pages=False,
+                 search_index=None):
         templating = self.app.get_feature('templating')
         templating.register_templates(__name__)
 
@@ -63,12 +196,32 @@ class AdminWeb(BasePlugin):
         # register generic Document — can be unregistered later by hand
         register(Document)
 
-        env = deepcopy(self.registry)
-
-        return dict(env,
-            default_namespace=DEFAULT_NAMESPACE
+        return dict(
+            default_namespace=DEFAULT_NAMESPACE,
+            references_limit=references_limit,
+            lazy_references=lazy_references,
+            prefetch_pages=prefetch_pages,
+            search_index=SearchIndex(search_index) if search_index else None,
         )
 
+    def update_search_index(self, obj):
+        """Replaces the search index entry of given saved document. Does
+        nothing if the index is not configured or the document class is not
+        registered with `search_names`.
+        """
+        index = self.env['search_index']
+        options = get_registry().get_for_model(type(obj))
+        if index and options and options.search_names:
+            index.update(obj, options.search_names)
+
+    def remove_from_search_index(self, model, pk):
+        """Removes the document of given class and primary key from the search
+        index (if it is configured).
+        """
+        index = self.env['search_index']
+        if index:
+            index.remove(model, pk)
+
     def admin_url_for_query(self, query, namespace=None):
         """
         Returns admin URL for given document query. Usage (in templates)::
@@ -101,14 +254,15 @@ class AdminWeb(BasePlugin):
             The admin namespace (optional).
 
         """
-        namespace = namespace or plugin.env['default_namespace']
+        namespace = namespace or self.env['default_namespace']
         model_name = obj.__class__.__name__
-        t = app.get_feature('routing')
+        t = self.app.get_feature('routing')
         return t.url_for('tool.ext.admin.views.object_detail',
                          namespace=namespace, model_name=model_name, pk=obj.pk)
 
 def register(model, namespace=DEFAULT_NAMESPACE, url=None, exclude=None,
-             ordering=None, list_names=None, search_names=None):
+             ordering=None, list_names=None, search_names=None,
+             cursor_key=None, count_strategy=None):
     """
     :param model:
         a Doqu document class
@@ -122,7 +276,19 @@ def register(model, namespace=DEFAULT_NAMESPACE, url=None, exclude=None,
     :param list_names:
         a list of field names to be displayed in the list view.
     :param search_names:
-        a list of field names by which to search.
+        a list of field names by which to search. If the `search_index`
+        setting is defined, these fields are indexed; objects saved outside of
+        the admin must be passed to :meth:`AdminWeb.update_search_index` or
+        the index rebuilt with the ``reindex`` command.
+    :param cursor_key:
+        name of a field with unique values. If given, the list view is paged
+        by this field (see :mod:`tool.ext.pagination`) and does not count the
+        objects, so that deep pages of large collections are as fast as the
+        first one. The list is then ordered by this field unless the user
+        sorts it by another column.
+    :param count_strategy:
+        how the list view counts the objects: ``exact`` (default), ``cached``
+        or ``estimated``. See :mod:`tool.ext.pagination`.
 
     Usage::
 
@@ -135,21 +301,30 @@ def register(model, namespace=DEFAULT_NAMESPACE, url=None, exclude=None,
         admin.register(Item)
 
     """
+    global _registry
+
     # TODO: model should provide a slugified version of its name itself
     name = model.__name__ #.lower()
 
-    r = AdminWeb.registry
-
-    r['registered_models'].setdefault(namespace, {})[name] = model
-    r['urls_for_models'][model] = url
-    r['excluded_names'][model] = exclude
-    r['ordering'][model] = ordering
-    r['list_names'][model] = list_names
-    r['search_names'][model] = search_names
+    options = AdminOptions(model=model, namespace=namespace, name=name,
+                           url=url, exclude=exclude, ordering=ordering,
+                           list_names=list_names, search_names=search_names,
+                           cursor_key=cursor_key,
+                           count_strategy=count_strategy)
+    with _registry_lock:
+        _registry = _registry.add(options)
 
     return model
 
 
+def unregister(model, namespace=DEFAULT_NAMESPACE):
+    """Removes given document class from the admin namespace.
+    """
+    global _registry
+    with _registry_lock:
+        _registry = _registry.remove(namespace, model.__name__)
+
+
 class DocAdmin(object):
     """
     Description of admin interface for given Document class.
@@ -161,6 +336,8 @@ class DocAdmin(object):
     ordering_reversed = False
     list_names = None
     search_names = None
+    cursor_key = None
+    count_strategy = None
 
     @classmethod
     def register_for(cls, doc_class):
@@ -175,6 +352,8 @@ class DocAdmin(object):
             ordering = ordering,
             list_names = cls.list_names,
             search_names = cls.search_names,
+            cursor_key = cls.cursor_key,
+            count_strategy = cls.count_strategy,
         )
 
 
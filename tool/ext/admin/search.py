@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search index for the admin
+====================================
+
+An optional inverted index of the fields listed in `search_names` of each
+registered model. It is kept in an SQLite database (FTS4) so that searching
+does not scan the whole collection and several fields can be searched at once.
+
+The admin updates the index when objects are saved or deleted through it.
+Changes made elsewhere are not tracked: pass such objects to
+:meth:`~tool.ext.admin.AdminWeb.update_search_index` (or
+:meth:`~tool.ext.admin.AdminWeb.remove_from_search_index`), or run
+``./manage.py admin reindex`` to rebuild the index from the storage.
+
+Each word of the search string must be present in one of the fields; words are
+matched by prefix and case-insensitively.
+"""
+import re
+import sqlite3
+import threading
+
+
+__all__ = ['SearchIndex', 'SearchResults']
+
+
+# number of documents fetched at once by SearchResults
+CHUNK_SIZE = 100
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, '
+    'model TEXT NOT NULL, pk TEXT NOT NULL, UNIQUE (model, pk))',
+    'CREATE VIRTUAL TABLE IF NOT EXISTS content USING fts4(text, '
+    'tokenize=unicode61)',
+)
+
+
+class SearchIndex(object):
+    """An SQLite full-text index of document fields.
+
+    :param path:
+        path to the database file; it is created if it does not exist.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            with self._connection as c:
+                for statement in SCHEMA:
+                    c.execute(statement)
+
+    def _get_model_name(self, model):
+        return u'{0}.{1}'.format(model.__module__, model.__name__)
+
+    def _get_text(self, obj, names):
+        values = (obj.get(name) for name in names)
+        return u' '.join(unicode(x) for x in values if x is not None)
+
+    def _remove(self, c, model_name, pk):
+        row = c.execute('SELECT id FROM records WHERE model = ? AND pk = ?',
+                        (model_name, pk)).fetchone()
+        if row:
+            c.execute('DELETE FROM content WHERE docid = ?', row)
+            c.execute('DELETE FROM records WHERE id = ?', row)
+
+    def _add(self, c, model_name, obj, names):
+        self._remove(c, model_name, obj.pk)
+        docid = c.execute('INSERT INTO records (model, pk) VALUES (?, ?)',
+                          (model_name, obj.pk)).lastrowid
+        c.execute('INSERT INTO content (docid, text) VALUES (?, ?)',
+                  (docid, self._get_text(obj, names)))
+
+    def update(self, obj, names):
+        "Indexes given fields of a saved document (replaces the old entry)."
+        model_name = self._get_model_name(type(obj))
+        with self._lock:
+            with self._connection as c:
+                self._add(c, model_name, obj, names)
+
+    def remove(self, model, pk):
+        "Removes the document with given primary key from the index."
+        with self._lock:
+            with self._connection as c:
+                self._remove(c, self._get_model_name(model), pk)
+
+    def rebuild(self, model, objects, names):
+        """Replaces all entries for given model with given documents in one
+        transaction. Returns the number of indexed documents.
+        """
+        model_name = self._get_model_name(model)
+        count = 0
+        with self._lock:
+            with self._connection as c:
+                c.execute('DELETE FROM content WHERE docid IN '
+                          '(SELECT id FROM records WHERE model = ?)',
+                          (model_name,))
+                c.execute('DELETE FROM records WHERE model = ?', (model_name,))
+                for obj in objects:
+                    self._add(c, model_name, obj, names)
+                    count += 1
+        return count
+
+    def search(self, model, text):
+        """Returns the list of primary keys of documents of given model that
+        contain all words from `text`.
+        """
+        words = re.findall(r'\w+', text, re.UNICODE)
+        if not words:
+            return []
+        expression = u' '.join(u'{0}*'.format(x) for x in words)
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT records.pk FROM content JOIN records '
+                'ON records.id = content.docid '
+                'WHERE content MATCH ? AND records.model = ? '
+                'ORDER BY records.id', (expression,
+                                        self._get_model_name(model)))
+            return [x[0] for x in rows]
+
+    def close(self):
+        self._connection.close()
+
+
+class SearchResults(object):
+    """A read-only query-like sequence of documents with given primary keys.
+    Documents are fetched from the storage in batches, so it can be passed to
+    :class:`~tool.ext.pagination.Pagination` or iterated in constant memory.
+    Keys that are no longer in the storage are skipped.
+    """
+    def __init__(self, storage, doc_class, keys):
+        self.storage = storage
+        self.doc_class = doc_class
+        self.keys = list(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for start in xrange(0, len(self.keys), CHUNK_SIZE):
+            for document in self[start:start + CHUNK_SIZE]:
+                yield document
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.storage.get(self.keys[index], self.doc_class)
+        keys = self.keys[index]
+        if not keys:
+            return []
+        try:
+            found = dict((x.pk, x) for x in
+                         self.storage.get_many(keys, self.doc_class))
+        except KeyError:
+            found = {}
+            for key in keys:
+                try:
+                    found[key] = self.storage.get(key, self.doc_class)
+                except KeyError:
+                    pass
+        # the backend may return the documents in any order
+        return [found[x] for x in keys if x in found]
+
+    def count(self):
+        return len(self.keys)
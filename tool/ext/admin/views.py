@@ -6,15 +6,30 @@
 # Refactor this module. The environment should be stored in plugin instance.
 #
 
+from contextlib import contextmanager
+import csv
+from cStringIO import StringIO
+from decimal import Decimal
+import hashlib
+from itertools import islice
+import json
+import threading
+import uuid
+
 from werkzeug import Response
+from werkzeug.exceptions import BadRequest
 import wtforms
 from tool import app
 from tool.routing import url, url_for, redirect_to
 from tool.signals import called_on
 from tool.ext.templating import as_html
-from tool.ext.documents import default_storage
+from tool.ext.documents import (get_default_storage, iter_documents,
+                                 iter_all_documents, bulk_save, bulk_delete)
 from tool.ext.pagination import Pagination
+from tool.ext.admin import get_registry
+from tool.ext.admin.search import SearchResults
 from tool.ext.breadcrumbs import entitled
+from tool.cache import LRUCache
 
 
 #from tool.ext.who import requires_auth
@@ -26,35 +41,286 @@ import doqu.validators
 from doqu.ext.forms import document_form_factory
 
 
+# generated form classes; see _get_form_class()
+_form_classes = LRUCache(size=500)
+
+# number of rows sent to the client at once by object_export()
+EXPORT_CHUNK_SIZE = 500
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+BULK_ACTIONS = 'delete', 'update'
+# field types that can be set by the bulk "update" action
+BULK_UPDATE_TYPES = unicode, str, int, long, float, bool, Decimal
+# how many error messages are kept for a bulk action
+BULK_ERRORS_LIMIT = 20
+
+# progress of bulk actions by job id; see object_action_status()
+_jobs = LRUCache(size=100, default_ttl=3600)
+
+
 def env(name):
     "Returns plugin environment variable of given name."
     plugin = app.get_feature('admin')
     return plugin.env[name]
 
-# TODO: use tool.context?
-#_registered_models = {}
-#_urls_for_models = {}
-#_excluded_names = {}
-#_ordering = {}
-#_list_names = {}
-#_search_names = {}
-def _get_model(namespace, name):
-    if namespace not in env('registered_models'):
-        raise NameError('There is no registered namespace "%s"' % namespace)
+def _get_options(namespace, name):
+    # admin options of a registered model (see tool.ext.admin.AdminOptions)
+    return get_registry().get(namespace, name)
+
+def _get_excluded_names(options):
+    return options.exclude or []
+
+def _get_references(db, model, pk):
+    """Returns a dictionary of objects of other models that reference the
+    object with given primary key: ``{model: {attr: group}}`` where the group
+    is a dictionary with keys `objects` (at most `references_limit` items) and
+    `more` (`True` if there are more items). All queries are made here so that
+    the template does not hit the storage.
+    """
+    limit = env('references_limit')
+    references = {}
+    for ref_model, attrs in model.meta.referenced_by.iteritems():
+        base_query = ref_model.objects(db)
+        for attr in attrs:
+            # Doqu has no OR, so each attribute needs its own query; fetching
+            # one extra item replaces a separate count() query
+            objects = list(base_query.where(**{attr: pk})[:limit + 1])
+            if objects:
+                references.setdefault(ref_model, {})[attr] = {
+                    'objects': objects[:limit],
+                    'more': limit < len(objects),
+                }
+    return references
+
+def _has_lazy_references(model):
+    lazy = env('lazy_references')
+    if isinstance(lazy, bool):
+        return lazy
+    pairs = sum(len(x) for x in model.meta.referenced_by.itervalues())
+    return lazy <= pairs
+
+def _get_type_name(value):
+    # classes by dotted name; instances (e.g. validators) by their class name
+    cls = value if isinstance(value, type) else type(value)
+    return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
+def _get_schema_version(model):
+    # changes if the model's schema is redefined (e.g. on code reload); built
+    # from names and types only because reprs may contain object addresses
+    meta = model.meta
+    validators = meta.validators or {}
+    return tuple(sorted(
+        (name, _get_type_name(datatype),
+         tuple(_get_type_name(x) for x in validators.get(name, ())),
+         meta.labels.get(name))
+        for name, datatype in (meta.structure or {}).iteritems()))
+
+def _get_form_class(model, db, extra_names=()):
+    """Returns a cached form class for given model and storage. Schemaless
+    documents have their own fields; they get a subclass with a text field for
+    each name in `extra_names` (also cached) so that the shared class is never
+    modified.
+    """
+    key = model, db, _get_schema_version(model)
+    form_class = _form_classes.get_or_set(
+        key, lambda: document_form_factory(model, db))
+    if not extra_names:
+        return form_class
+    extra_names = tuple(sorted(extra_names))
+    def make_subclass():
+        fields = dict((k, wtforms.fields.TextField(k.title().replace('_', ' ')))
+                      for k in extra_names)
+        return type(form_class.__name__, (form_class,), fields)
+    return _form_classes.get_or_set(key + extra_names, make_subclass)
+
+def _get_list_query(request, db, options, index):
+    """Returns the query for the object list with search and ordering from
+    request arguments applied, the ordering and the name of the cursor key
+    (if the list is paged by key). The search index is given explicitly
+    because this may run outside of the request.
+    """
+    model = options.model
+    query = model.objects(db)
+
+    searching = 'q' in request.values
+    if searching:
+        value = request.values.get('q')
+        # TODO: move defs sanity check elsewhere (admin site function?)
+        field_names = options.search_names
+        if not field_names:
+            raise ValueError('Cannot search {0} objects: search fields are '
+                             'not defined'.format(model.__name__))
+        assert isinstance(field_names, (list, tuple))
+        if index:
+            query = SearchResults(db, model, index.search(model, value))
+        else:
+            # FIXME should be q.where(foo=q).or_where(bar=q)
+            # but Docu doesn't support OR at the moment
+            if 1 < len(field_names):
+                raise NotImplementedError('Multiple search fields require the '
+                                          'search_index setting.')
+            # TODO: pre-convert value?
+            query = query.where(**{'{0}__matches_caseless'.format(field_names[0]): value})
+            searching = False
+
+    ordering = options.ordering
+    cursor_key = options.cursor_key
+    if searching:
+        # indexed search results are neither sorted nor filtered further
+        ordering = cursor_key = None
+    elif 'sort_by' in request.values:
+        sort_field = request.values.get('sort_by')
+        sort_reverse = bool(request.values.get('sort_reverse', False))
+        ordering = dict(ordering or {}, names=[sort_field],
+                        reverse=sort_reverse)
+        # pages can only be addressed by key if the list is sorted by it
+        cursor_key = None
+    if ordering and not cursor_key:
+        query = query.order_by(**ordering)
+    return query, ordering, cursor_key
+
+def _get_session_id(request):
+    # identifies the browser by its cookies: users behind a proxy share the
+    # address and a user may be logged in from several browsers
+    cookie = request.environ.get('HTTP_COOKIE')
+    if cookie:
+        return hashlib.sha1(cookie).hexdigest()
+
+def _make_prefetch_query(request, options):
+    """Returns a function for :class:`~tool.ext.pagination.Pagination` that
+    opens the list query on a handle borrowed from the pool of the default
+    database. The page is fetched by a worker thread outside of the request,
+    so the plugins are looked up here.
+    """
+    storages = app.get_feature('document_storage')
+    index = env('search_index')
+    @contextmanager
+    def prefetch_query():
+        with storages.checkout() as db:
+            yield _get_list_query(request, db, options, index)[0]
+    return prefetch_query
+
+def _get_export_row(obj, names):
+    # values as displayed in the list; empty values are exported as None
+    row = [obj.pk]
+    for name in names:
+        value = unicode(obj) if name == '__unicode__' else obj.get(name)
+        if value is not None and not isinstance(value, (basestring, bool,
+                                                        int, long, float)):
+            value = unicode(value)
+        row.append(value)
+    return row
+
+def _encode_csv(rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([x.encode('utf-8') if isinstance(x, unicode) else
+                         ('' if x is None else x) for x in row])
+    return buf.getvalue()
+
+def _encode_ndjson(rows, header):
+    return ''.join(json.dumps(dict(zip(header, row))) + '\n' for row in rows)
+
+def _iter_export(documents, names, format):
+    # yields encoded chunks of rows
+    header = ['pk'] + names
+    if format == 'csv':
+        yield _encode_csv([header])
+    rows = (_get_export_row(x, names) for x in documents)
+    while True:
+        chunk = list(islice(rows, EXPORT_CHUNK_SIZE))
+        if not chunk:
+            return
+        if format == 'csv':
+            yield _encode_csv(chunk)
+        else:
+            yield _encode_ndjson(chunk, header)
+
+def _get_update_names(options):
+    # fields that can be set by the bulk "update" action
+    excluded = _get_excluded_names(options)
+    return sorted(k for k, v in options.model.meta.structure.iteritems()
+                  if v in BULK_UPDATE_TYPES and k not in excluded)
+
+def _convert_value(options, name, value):
+    if name not in _get_update_names(options):
+        raise ValueError('Cannot update field "{0}" of {1} objects.'.format(
+            name, options.name))
+    datatype = options.model.meta.structure[name]
+    if value == u'':
+        return None
+    if datatype is bool:
+        return value.lower() in (u'1', u'true', u'yes', u'on')
     try:
-        return env('registered_models')[namespace][name]
-    except KeyError:
-        raise NameError('"%s" is not a registered model in namespace %s.' %
-                        (name, namespace))
+        return datatype(value)
+    except (TypeError, ValueError, ArithmeticError):
+        raise ValueError(u'Bad value for field "{0}": {1}'.format(name, value))
+
+def _get_action_keys(request, db, options, index):
+    """Returns the primary keys of selected objects or, if ``all`` is set, an
+    iterator that reads the keys of all objects in the list lazily, and their
+    number. The search index is given explicitly because this may run outside
+    of the request.
+    """
+    if request.form.get('all'):
+        query = _get_list_query(request, db, options, index)[0]
+        return (x.pk for x in iter_documents(query)), query.count()
+    keys = request.form.getlist('pk')
+    return keys, len(keys)
 
-def _get_excluded_names(model):
-    return env('excluded_names')[model] or []
+def _run_action(job, action, db, model, keys, changes, index, names):
+    """Applies the bulk action to objects with given keys and updates the job
+    (a dictionary) as batches are processed. The search index and names are
+    given explicitly because this may run outside of the request.
+    """
+    def progress(processed, errors):
+        job.update(processed=processed, errors=errors)
 
-def _get_url_for_object(obj):
+    if action == 'delete':
+        result = bulk_delete(keys, db, progress=progress)
+    else:
+        def iter_changed():
+            for key in keys:
+                try:
+                    obj = db.get(key, model)
+                except KeyError:
+                    # deleted since the keys were collected
+                    continue
+                for name, value in changes.iteritems():
+                    obj[name] = value
+                yield obj
+        result = bulk_save(iter_changed(), db, progress=progress)
+
+    if index and names:
+        for key in result.keys:
+            if action == 'delete':
+                index.remove(model, key)
+            else:
+                index.update(db.get(key, model), names)
+
+    job.update(state='done', processed=result.processed,
+               errors=len(result.errors),
+               messages=[u'{0}: {1}'.format(getattr(item, 'pk', item), e)
+                         for i, item, e in result.errors[:BULK_ERRORS_LIMIT]])
+
+def _run_job(job, storages, get_keys, action, model, changes, index, names):
+    """Runs the bulk action in a thread on a handle borrowed from the pool;
+    keys are collected by `get_keys(db)`. The failure must be visible in
+    status.
+    """
+    try:
+        with storages.checkout() as db:
+            keys, job['total'] = get_keys(db)
+            _run_action(job, action, db, model, keys, changes, index, names)
+    except Exception as e:
+        job.update(state='failed', messages=[unicode(e)])
+        raise
+
+def _get_url_for_object(obj, options):
     if not obj.pk:
         return
-    model = type(obj)
-    f = env('urls_for_models')[model]
+    f = options.url
     try:
         return f(obj) if f else None
     except:  # FIXME here was BuildError from Werkzeug
@@ -68,7 +334,7 @@ def _get_url_for_object(obj):
 @as_html('admin/index.html')
 def index(request):
     return {
-        'namespaces': env('registered_models'),
+        'namespaces': get_registry().namespaces,
     }
 
 @url('/<string:namespace>/')
@@ -78,53 +344,70 @@ def index(request):
 def namespace(request, namespace):
     return {
         'namespace': namespace,
-        'models': env('registered_models')[namespace],
+        'models': get_registry().namespaces[namespace],
     }
 
 @url('/<string:namespace>/<string:model_name>/')
 @require(is_admin())
-@entitled(lambda **kw: _get_model(kw['namespace'], kw['model_name'])
-                       .meta.get_label_plural())
-@as_html('admin/object_list.html')
+@entitled(lambda **kw: _get_options(kw['namespace'], kw['model_name'])
+                       .model.meta.get_label_plural())
+@as_html('admin/object_list.html', stream=True)
 def object_list(request, namespace, model_name):
-    db = default_storage()
-    model = _get_model(namespace, model_name)
-    query = model.objects(db)
-
-    if 'q' in request.values:
-        value = request.values.get('q')
-        # TODO: move defs sanity check elsewhere (admin site function?)
-        field_names = env('search_names')[model]
-        if not field_names:
-            raise ValueError('Cannot search {0} objects: search fields are '
-                             'not defined'.format(model.__name__))
-        assert isinstance(field_names, (list, tuple))
-        # FIXME should be q.where(foo=q).or_where(bar=q)
-        # but Docu doesn't support OR at the moment
-        if 1 < len(field_names):
-            raise NotImplementedError('Multiple search fields are not yet '
-                                      'supported in this version.')
-        # TODO: pre-convert value?
-        query = query.where(**{'{0}__matches_caseless'.format(field_names[0]): value})
-
-    ordering = env('ordering').get(model)
-    if 'sort_by' in request.values:
-        sort_field = request.values.get('sort_by')
-        sort_reverse = bool(request.values.get('sort_reverse', False))
-        ordering = dict(ordering, names=[sort_field])
-    if ordering:
-        query = query.order_by(**ordering)
+    db = get_default_storage()
+    options = _get_options(namespace, model_name)
+    model = options.model
+    query, ordering, cursor_key = _get_list_query(request, db, options,
+                                                   env('search_index'))
 
     #pagin_args =  {'namespace': namespace, 'model_name': model_name}
     #objects, pagination = paginated(query, req, pagin_args)
     page = request.values.get('page', 1)
     per_page = request.values.get('per_page', 20)
-    pagination = Pagination(query, per_page, page,
-                            'tool.ext.admin.views.object_list',
-                            namespace=namespace,
-                            model_name=model_name)
+    # the count does not depend on ordering
+    count_key = db, model, request.values.get('q')
+    # other pages, exports and bulk actions apply to all objects shown by the
+    # list, not just this page
+    list_args = dict((k, request.values[k]) for k in
+                     ('q', 'sort_by', 'sort_reverse') if k in request.values)
+    prefetch = {}
+    session_id = _get_session_id(request)
+    # a database that is not pooled has a single handle for all threads
+    if (env('prefetch_pages') and session_id and
+        app.get_feature('document_storage').is_pooled()):
+        prefetch = dict(
+            prefetch_session=session_id,
+            prefetch_key=count_key + (repr(ordering),),
+            prefetch_query=_make_prefetch_query(request, options))
+    if cursor_key:
+        pagination = Pagination(query, per_page, 1,
+                                'tool.ext.admin.views.object_list',
+                                key=cursor_key,
+                                after=request.values.get('after'),
+                                before=request.values.get('before'),
+                                reverse=(ordering or {}).get('reverse', False),
+                                with_count=False,
+                                namespace=namespace,
+                                model_name=model_name,
+                                **dict(list_args, **prefetch))
+    else:
+        pagination = Pagination(query, per_page, page,
+                                'tool.ext.admin.views.object_list',
+                                count_strategy=options.count_strategy or
+                                               'exact',
+                                count_key=count_key,
+                                namespace=namespace,
+                                model_name=model_name,
+                                **dict(list_args, **prefetch))
+
+    list_names = options.list_names or ['__unicode__']
 
-    list_names = env('list_names')[model] or ['__unicode__']
+    export_urls = [(x, url_for('tool.ext.admin.views.object_export',
+                               namespace=namespace, model_name=model_name,
+                               format=x, **list_args))
+                   for x in sorted(EXPORT_MIMETYPES)]
+    action_url = url_for('tool.ext.admin.views.object_action',
+                         namespace=namespace, model_name=model_name,
+                         **list_args)
 
     return {
         'namespace': namespace,
@@ -132,25 +415,131 @@ def object_list(request, namespace, model_name):
         #'objects': objects,
         'pagination': pagination,
         'list_names': list_names,
-        'search_enabled': bool(env('search_names')[model]),
+        'search_enabled': bool(options.search_names),
+        'export_urls': export_urls,
+        'action_url': action_url,
+        'actions': BULK_ACTIONS,
+        'update_names': _get_update_names(options),
+        'background': app.get_feature('document_storage').is_pooled(),
     }
 
+@url('/<string:namespace>/<string:model_name>/action', methods=['POST'])
+@require(is_admin())
+def object_action(request, namespace, model_name):
+    """Deletes or updates the selected objects (``pk`` values) or, if ``all``
+    is set, all objects in the list with current search. The objects are
+    written in batches. If ``background`` is set, the action runs in a thread
+    on a handle borrowed from the pool and the client is redirected to
+    :func:`object_action_status`; otherwise it is redirected back to the list
+    (or to the status if there were errors). If no action is chosen, nothing
+    is done. An unknown action, a value that does not fit the field or a
+    background action on a database that is not pooled is a bad request.
+    """
+    options = _get_options(namespace, model_name)
+    action = request.form.get('action')
+    if not action:
+        return redirect_to('tool.ext.admin.views.object_list',
+                           namespace=namespace, model_name=model_name)
+    if action not in BULK_ACTIONS:
+        raise BadRequest(u'Unknown action "{0}"'.format(action))
+    storages = app.get_feature('document_storage')
+    background = request.form.get('background')
+    if background and not storages.is_pooled():
+        # another handle for the same database could undo the changes
+        raise BadRequest(u'Background actions need a pooled database.')
+    changes = {}
+    if action == 'update':
+        name = request.form.get('field')
+        try:
+            changes[name] = _convert_value(options, name,
+                                           request.form.get('value', u''))
+        except ValueError as e:
+            raise BadRequest(unicode(e))
+    index = env('search_index')
+    get_keys = lambda db: _get_action_keys(request, db, options, index)
+
+    job_id = uuid.uuid4().hex
+    job = dict(action=action, state='running', total=None, processed=0,
+               errors=0, messages=[])
+    _jobs.set(job_id, job)
+    if background:
+        thread = threading.Thread(target=_run_job, args=(
+            job, storages, get_keys, action, options.model, changes, index,
+            options.search_names))
+        thread.daemon = True
+        thread.start()
+    else:
+        db = get_default_storage()
+        keys, job['total'] = get_keys(db)
+        _run_action(job, action, db, options.model, keys, changes, index,
+                    options.search_names)
+        if not job['errors']:
+            return redirect_to('tool.ext.admin.views.object_list',
+                               namespace=namespace, model_name=model_name)
+    return redirect_to('tool.ext.admin.views.object_action_status',
+                       namespace=namespace, model_name=model_name,
+                       job_id=job_id)
+
+@url('/<string:namespace>/<string:model_name>/action/<string:job_id>')
+@require(is_admin())
+def object_action_status(request, namespace, model_name, job_id):
+    """Returns the progress of a bulk action as JSON. The `total` is `null`
+    until the job has counted the objects.
+    """
+    job = _jobs.get(job_id)
+    if job is None:
+        return Response(json.dumps({'state': 'unknown'}), status=404,
+                        mimetype='application/json')
+    return Response(json.dumps(job), mimetype='application/json')
+
+@url('/<string:namespace>/<string:model_name>/export/<any(csv, ndjson):format>')
+@require(is_admin())
+def object_export(request, namespace, model_name, format):
+    """Streams all objects from the list (with current search and ordering)
+    as CSV or newline-delimited JSON. Columns are the primary key and the
+    model's `list_names`.
+
+    Without search and ordering the objects are read in chunks. Otherwise the
+    query keeps the objects it has read until the export is done, so large
+    collections are better exported unsorted.
+    """
+    db = get_default_storage()
+    options = _get_options(namespace, model_name)
+    query, ordering, cursor_key = _get_list_query(request, db, options,
+                                                   env('search_index'))
+    if 'q' not in request.values and not ordering and not cursor_key:
+        documents = iter_all_documents(options.model, db)
+    else:
+        if cursor_key:
+            query = query.order_by(cursor_key, reverse=(ordering or {}).get(
+                'reverse', False))
+        documents = iter_documents(query)
+    names = list(options.list_names or ['__unicode__'])
+    response = Response(_iter_export(documents, names, format),
+                        mimetype=EXPORT_MIMETYPES[format])
+    response.headers['Content-Disposition'] = (
+        'attachment; filename={0}.{1}'.format(model_name, format))
+    return response
+
 @url('/<string:namespace>/<string:model_name>/<string:pk>')
 @url('/<string:namespace>/<string:model_name>/add')
 @require(is_admin())
 @entitled(lambda **kw: (u'{0} {1}').format(
           u'Editing' if 'pk' in kw else 'Adding',
-          _get_model(kw['namespace'], kw['model_name']).meta.get_label()))
+          _get_options(kw['namespace'], kw['model_name'])
+          .model.meta.get_label()))
 @as_html('admin/object_detail.html')
 def object_detail(request, namespace, model_name, pk=None):
-    db = default_storage()
-    model = _get_model(namespace, model_name)
+    db = get_default_storage()
+    registry = get_registry()
+    options = registry.get(namespace, model_name)
+    model = options.model
     if pk:
         try:
-            obj = db.get(model, pk)
+            obj = db.get(pk, model)
         except doqu.validators.ValidationError:
             # Whoops, the data doesn't fit the schema. Let's try converting.
-            obj = db.get(Document, pk)
+            obj = db.get(pk, Document)
             obj = obj.convert_to(model)
         creating = False
     else:
@@ -161,19 +550,16 @@ def object_detail(request, namespace, model_name, pk=None):
         # TODO: confirmation screen.
         # List related objects, ask what to do with them (cascade/ignore/..)
         obj.delete()
+        app.get_feature('admin').remove_from_search_index(model, pk)
         return redirect_to('tool.ext.admin.views.object_list', namespace=namespace,
                         model_name=model_name)
 
-    DocumentForm = document_form_factory(model, db)
-
-    if not model.meta.structure:
-        for k in obj:
-            setattr(DocumentForm, k,
-                    wtforms.fields.TextField(k.title().replace('_',' ')))
+    extra_names = () if model.meta.structure else list(obj)
+    DocumentForm = _get_form_class(model, db, extra_names)
 
     form = DocumentForm(request.form, obj)
 
-    for name in _get_excluded_names(model):
+    for name in _get_excluded_names(options):
         del form[name]
 
     message = None
@@ -184,6 +570,7 @@ def object_detail(request, namespace, model_name, pk=None):
         #if not __debug__:
 
         obj.save(db)    # storage can be omitted if not creating obj
+        app.get_feature('admin').update_search_index(obj)
 
         # TODO: move this to request.session['messages'] or smth like that
         message = u'%s has been saved.' % obj.__class__.__name__
@@ -195,15 +582,20 @@ def object_detail(request, namespace, model_name, pk=None):
         return redirect_to('tool.ext.admin.views.object_detail',
                            namespace=namespace, model_name=model_name,
                            pk=obj.pk)
-    obj_url = _get_url_for_object(obj)
+    obj_url = _get_url_for_object(obj, options)
 
-    # objects of other models that are known to reference this one
+    # objects of other models that are known to reference this one; for
+    # heavily referenced models they are loaded by the page in a separate
+    # request so that the form is displayed without waiting for them
     references = {}
-    for model, attrs in model.meta.referenced_by.iteritems():
-        for attr in attrs:
-            qs = model.objects(db).where(**{attr: obj.pk})
-            if qs.count():
-                references.setdefault(model, {})[attr] = qs
+    references_url = None
+    if obj.pk and model.meta.referenced_by:
+        if _has_lazy_references(model):
+            references_url = url_for('tool.ext.admin.views.object_references',
+                                     namespace=namespace,
+                                     model_name=model_name, pk=obj.pk)
+        else:
+            references = _get_references(db, model, obj.pk)
 
     return {
         'namespace': namespace,
@@ -212,5 +604,18 @@ def object_detail(request, namespace, model_name, pk=None):
         'form': form,
         'message': message,
         'references': references,
-        'other_doc_types': env('registered_models'),
+        'references_url': references_url,
+        'other_doc_types': registry.namespaces,
+    }
+
+@url('/<string:namespace>/<string:model_name>/<string:pk>/references')
+@require(is_admin())
+@as_html('admin/_references.html')
+def object_references(request, namespace, model_name, pk):
+    "Renders the list of objects that reference given one (a page fragment)."
+    db = get_default_storage()
+    model = _get_options(namespace, model_name).model
+    return {
+        'namespace': namespace,
+        'references': _get_references(db, model, pk),
     }
@@ -70,7 +70,7 @@ class CastForm(wtforms.Form):
 
 @url('/')
 @login_required
-@as_html('analysis/report.html')
+@as_html('analysis/report.html', stream=True)
 def report(request):
     query = Document.objects(default_storage())  # TODO: only docs registered with admin?
     form = CastForm(request.form)
@@ -80,16 +80,155 @@ More details:
 .. _Doqu documentation: http://packages.python.org/doqu
 .. _Shelve: http://packages.python.org/doqu/ext_shelve.html
 
+Pooling
+-------
+
+By default each configured database is opened once and the handle is shared by
+all threads. This is fine for a single-threaded server but unsafe (or slow) for
+file-based or socket-based backends under a threaded server. Each database can
+instead be served by a :class:`StoragePool`::
+
+    extensions:
+        tool.ext.documents.Documents:
+            default:
+                backend: doqu.ext.tokyo_tyrant
+                port: 1978
+                pool_size: 8        # at most 8 open handles
+                pool_timeout: 5     # wait up to 5 seconds for a free handle
+
+or, to simply give each thread its own handle::
+
+            default:
+                backend: doqu.ext.tokyo_tyrant
+                port: 1978
+                per_thread: yes
+
+The storage objects returned by :data:`storages` and
+:func:`get_default_storage` are then proxies: a handle is checked out of the
+pool on first use within a thread and returned when the response has been sent
+(or when the thread dies). Handles that were disconnected are reopened, and all
+handles are reopened in a forked child process. Scripts and
+worker threads can borrow a handle explicitly::
+
+    with app.get_feature('document_storage').checkout() as db:
+        Person.objects(db).count()
+
+.. note::
+
+    Shelve does not support concurrent writers. Use ``pool_size: 1`` with it
+    to serialize access to the file.
+
+Query cache
+-----------
+
+Pages that issue the same queries over and over can use a query cache::
+
+            default:
+                backend: doqu.ext.tokyo_tyrant
+                cache:
+                    size: 1000      # number of cached results (LRU)
+                    ttl: 60         # seconds
+
+The storage is then wrapped in :class:`CachedStorage`. Results and counts of
+queries made with it are memoized per document class, conditions and ordering.
+Saving or deleting anything through the wrapper clears its cache (documents
+fetched from it are bound to the wrapper, so plain ``doc.save()`` is enough).
+Changes made by other processes or through the raw backend are only picked up
+when the entries expire.
+
+Bulk operations
+---------------
+
+Large sets of documents are saved or deleted with :func:`bulk_save` and
+:func:`bulk_delete`. They consume any iterable (e.g. a generator reading a
+file) in chunks, flush the backend once per chunk if it supports
+:meth:`sync`, and collect per-item errors instead of stopping at the first
+one::
+
+    def report(done, errors):
+        print '{0} saved, {1} failed'.format(done, errors)
+
+    result = bulk_save((Person(name=x) for x in names), db, progress=report)
+    for index, document, error in result.errors:
+        ...
+
+Instrumentation
+---------------
+
+To find out which storage calls a request makes, wrap the database in
+:class:`InstrumentedStorage`::
+
+            default:
+                backend: doqu.ext.shelve_db
+                instrument: yes
+
+Each call to the backend is then recorded in :func:`get_query_stats` for the
+current request, with its duration and number of returned rows. The summary
+also lists identical queries made more than once and queries of the same shape
+made many times with different values (e.g. counting references per object in
+a loop) — typical N+1 patterns. The command ``document-storage profile`` prints
+the summaries for given URLs::
+
+    $ ./manage.py document-storage profile /admin/blog/note/
+
+If the query cache is also configured, only cache misses are recorded.
+
+Outside of a request (scripts, worker threads) the calls are collected per
+thread until :func:`reset_query_stats` is called. Only the last 10000 calls
+are kept for the analysis; the totals include all of them.
+
+Import and export
+-----------------
+
+Records can be moved between storages with the commands ``document-storage
+export`` and ``document-storage import``::
+
+    $ ./manage.py document-storage export backup.ndjson.gz -z gzip
+    $ ./manage.py document-storage export dump/ -m blog.schema.Note \
+                                                -m blog.schema.Tag -w 2
+    $ ./manage.py document-storage import backup.ndjson.gz
+
+Records are written as they are read, so memory usage does not depend on the
+size of the storage. Two formats are supported: ``ndjson`` (one JSON object per
+line; dates and decimals are tagged) and ``pickle`` (a stream of pickled
+records; compact and lossless). Files can be compressed with ``gzip`` or
+``bz2``; on import, format and compression are guessed from the file name.
+
+Without models all records are exported. With several models (or workers),
+each model is exported to its own file within given directory, optionally by
+parallel processes.
+
 API reference
 -------------
 """
+import bz2
+from collections import deque
+from contextlib import contextmanager
+import cPickle as pickle
+import datetime
+import decimal
+import gzip
+from itertools import islice
+import json
 import logging
 logger = logging.getLogger(__name__)
+import multiprocessing
+import os
+import threading
+import time
 
+from werkzeug import BaseResponse, Client, cached_property
+from werkzeug.wsgi import ClosingIterator
 import werkzeug.exceptions
 
 from tool import app
+from tool.cache import LRUCache
+from tool.cli import alias, arg, CommandError
+from tool.context_locals import local
+from tool.importing import import_attribute
 from tool import dist
+from tool.application import request_ready
+from tool.signals import called_on
 import tool.plugins
 
 dist.check_dependencies(__name__)
@@ -97,7 +236,12 @@ dist.check_dependencies(__name__)
 from doqu import get_db
 
 
-__all__ = ['get_object_or_404', 'Documents', 'storages', 'default_storage']
+__all__ = ['get_object_or_404', 'Documents', 'storages', 'default_storage',
+           'StorageProxy', 'StoragePool', 'PooledStorage', 'CachedStorage',
+           'CachedQuery', 'bulk_save', 'bulk_delete', 'BulkResult',
+           'InstrumentedStorage', 'InstrumentedQuery', 'QueryStats',
+           'get_query_stats', 'reset_query_stats', 'iter_documents',
+           'iter_all_documents', 'ReleaseHandlesMiddleware']
 
 
 FEATURE = 'document_storage'
@@ -106,28 +250,1113 @@ DEFAULTS = {
     'backend': 'doqu.ext.shelve_db',
     'path': 'doqu_shelve.db',
 }
+POOL_SETTINGS = 'pool_size', 'pool_timeout', 'per_thread'
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_REPEAT_THRESHOLD = 3
+DEFAULT_STATS_SIZE = 10000
+FORMATS = 'ndjson', 'pickle'
+COMPRESSORS = {'gzip': ('.gz', gzip.open), 'bz2': ('.bz2', bz2.BZ2File)}
+
+
+def make_export_command(plugin):
+    """Factory that expects a documents plugin instance and returns the CLI
+    command `export` bound to that plugin.
+    """
+    @arg('path', help='output file (or directory for several models)')
+    @arg('-m', '--model', dest='models', action='append',
+         help='dotted path to a document class (repeatable); by default all '
+              'records are exported')
+    @arg('-d', '--database', default=DEFAULT_DB_NAME)
+    @arg('-f', '--format', choices=FORMATS, default=FORMATS[0])
+    @arg('-z', '--compress', choices=sorted(COMPRESSORS))
+    @arg('-w', '--workers', type=int, default=1,
+         help='number of processes exporting models in parallel')
+    def export(args):
+        """ Writes records from the storage to a file. Records are streamed so
+        the storage can be larger than available memory.
+        """
+        models = [import_attribute(x) for x in args.models or []]
+        if len(models) < 2 and args.workers < 2:
+            count = plugin.export_records(args.path, models[0] if models else
+                                          None, database=args.database,
+                                          format=args.format,
+                                          compression=args.compress)
+            yield u'Exported {0} records to {1}.'.format(count, args.path)
+            return
+        if not models:
+            raise CommandError('Please specify models to export in parallel.')
+        counts = plugin.export_models(args.path, models, database=args.database,
+                                      format=args.format,
+                                      compression=args.compress,
+                                      processes=args.workers)
+        for path in sorted(counts):
+            yield u'Exported {0} records to {1}.'.format(counts[path], path)
+    return export
+
+def make_import_command(plugin):
+    """Factory that expects a documents plugin instance and returns the CLI
+    command `import` bound to that plugin.
+    """
+    @alias('import')
+    @arg('paths', nargs='+', help='files created by the export command')
+    @arg('-d', '--database', default=DEFAULT_DB_NAME)
+    @arg('-f', '--format', choices=FORMATS,
+         help='file format (guessed from the file name by default)')
+    @arg('-c', '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    def import_(args):
+        """ Loads records from files into the storage. Primary keys are kept,
+        so existing records with the same keys are overwritten.
+        """
+        for path in args.paths:
+            result = plugin.import_records(path, database=args.database,
+                                           format=args.format,
+                                           chunk_size=args.chunk_size)
+            for index, record, error in result.errors:
+                yield u'{0}: record #{1}: {2}'.format(path, index, error)
+            yield u'Imported {0} records from {1}, {2} errors.'.format(
+                result.count, path, len(result.errors))
+    return import_
+
+
+def make_profile_command(plugin):
+    """Factory that expects a documents plugin instance and returns the CLI
+    command `profile` bound to that plugin.
+    """
+    @arg('urls', nargs='+', help='paths to request from the application')
+    @arg('-t', '--threshold', type=int, default=DEFAULT_REPEAT_THRESHOLD,
+         help='report query shapes repeated at least this many times')
+    def profile(args):
+        """ Requests given URLs from the application and prints storage calls
+        made by each request. Only databases configured with `instrument`
+        are observed.
+        """
+        if not hasattr(plugin.app, 'wsgi_app'):
+            raise CommandError('The application must be a WebApplication.')
+        client = Client(plugin.app, BaseResponse)
+        for path in args.urls:
+            # read and close the response so that streamed views are done
+            # and the handles are released before the calls are reported
+            response = client.get(path, buffered=True)
+            summary = get_query_stats().summary(args.threshold)
+            yield (u'{0} ({1}): {count} calls, {time:.4f}s, {rows} rows'
+                   .format(path, response.status, **summary))
+            for row in summary['models']:
+                yield (u'  {count:>6} {time:>10.4f} {rows:>8}  {name}'
+                       .format(**row))
+            for query, count in summary['duplicates']:
+                yield u'  duplicate ({0}×): {1}'.format(count, query)
+            for shape, count in summary['repeated']:
+                yield u'  possible N+1 ({0}×): {1}'.format(count, shape)
+    return profile
 
 
 class Documents(tool.plugins.BasePlugin):
     """A Tool extension that provides support for Doqu_.
     """
     features = FEATURE
+    commands = cached_property(lambda self: [make_export_command(self),
+                                             make_import_command(self),
+                                             make_profile_command(self)])
 
     def make_env(self, **databases):
         logger.debug('Confguring {0} with {1}...'.format(self, databases))
         assert databases
         assert DEFAULT_DB_NAME in databases, (
             'database "{0}" must be configured'.format(DEFAULT_DB_NAME))
+        self.databases = databases
         env = {}
         for name, settings in databases.iteritems():
-            env[name] = get_db(settings)
+            env[name] = self._make_storage(settings)
         return env
 
+    def _make_storage(self, settings):
+        settings = dict(settings)
+        cache = settings.pop('cache', None)
+        instrument = settings.pop('instrument', False)
+        options = dict((k, settings.pop(k)) for k in POOL_SETTINGS
+                       if k in settings)
+        if options:
+            pool = StoragePool(settings, size=options.get('pool_size'),
+                               timeout=options.get('pool_timeout'))
+            storage = PooledStorage(pool,
+                                    per_thread=options.get('per_thread', False))
+        else:
+            storage = get_db(settings)
+        if instrument:
+            storage = InstrumentedStorage(storage)
+        if cache:
+            storage = CachedStorage(storage,
+                                    **(cache if isinstance(cache, dict) else {}))
+        return storage
+
+    def get_middleware(self):
+        # only web applications have a WSGI stack
+        pooled = [x for x in self.env.itervalues()
+                  if isinstance(_unwrap(x), PooledStorage)]
+        if pooled and hasattr(self.app, 'wrap_in'):
+            return [(ReleaseHandlesMiddleware, [self], {})]
+
     @property
     def default_db(self):
         "Returns default storage object."
         return self.env[DEFAULT_DB_NAME]
 
+    def is_pooled(self, name=DEFAULT_DB_NAME):
+        """Returns `True` if given database is pooled, i.e. other threads can
+        borrow handles of their own with :meth:`checkout`.
+        """
+        return isinstance(_unwrap(self.env[name]), PooledStorage)
+
+    @contextmanager
+    def checkout(self, name=DEFAULT_DB_NAME):
+        """Borrows a storage handle for the duration of the `with` block.
+        If the database is not pooled, the shared handle is returned.
+        """
+        storage = _unwrap(self.env[name])
+        if not isinstance(storage, PooledStorage):
+            yield storage
+            return
+        handle = storage.pool.checkout()
+        try:
+            yield handle
+        finally:
+            storage.pool.checkin(handle)
+
+    def open_storage(self, name=DEFAULT_DB_NAME):
+        """Returns a new handle for given database, bypassing the pool and the
+        query cache. The caller is responsible for disconnecting it.
+        """
+        settings = dict(self.databases[name])
+        for key in POOL_SETTINGS + ('cache', 'instrument'):
+            settings.pop(key, None)
+        return get_db(settings)
+
+    def export_records(self, path, model=None, storage=None,
+                       database=DEFAULT_DB_NAME, format=FORMATS[0],
+                       compression=None):
+        """Writes records to given file and returns their number.
+
+        :param model:
+            a document class. If given, only records returned by its query are
+            exported. By default all records are exported.
+        :param storage:
+            the storage to read. Default is the one configured as `database`
+            (without the query cache).
+        :param format:
+            ``ndjson`` or ``pickle``.
+        :param compression:
+            ``gzip``, ``bz2`` or `None`.
+
+        """
+        db = _unwrap(self.env[database]) if storage is None else storage
+        with _open_file(path, 'wb', compression) as f:
+            return _write_records(f, _iter_records(db, model), format)
+
+    def export_models(self, directory, models, database=DEFAULT_DB_NAME,
+                      format=FORMATS[0], compression=None, processes=1):
+        """Exports each of given document classes to a separate file within
+        given directory. Returns a dictionary of record counts keyed by path.
+        If `processes` is greater than 1, the models are exported in parallel,
+        each worker with its own storage handle.
+        """
+        global _exporting_plugin
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        suffix = '.' + format
+        if compression:
+            suffix += COMPRESSORS[compression][0]
+        tasks = [(os.path.join(directory, '{0}.{1}{2}'.format(
+                     model.__module__, model.__name__, suffix)),
+                  model, database, format, compression) for model in models]
+        if processes and 1 < processes:
+            _exporting_plugin = self
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_export_model, tasks)
+            finally:
+                pool.close()
+                pool.join()
+                _exporting_plugin = None
+        else:
+            results = [_export_model(task, self) for task in tasks]
+        return dict(results)
+
+    def import_records(self, path, storage=None, database=DEFAULT_DB_NAME,
+                       format=None, compression=None,
+                       chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+        """Saves records from given file to the storage and returns a
+        :class:`BulkResult` without `keys`. Format and compression are
+        guessed from the file name unless specified. See :func:`bulk_save` for
+        other arguments.
+        """
+        db = self.env[database] if storage is None else storage
+        name = path
+        if compression is None:
+            for compression, (ext, opener) in COMPRESSORS.iteritems():
+                if name.endswith(ext):
+                    name = name[:-len(ext)]
+                    break
+            else:
+                compression = None
+        if format is None:
+            format = 'pickle' if name.endswith('.pickle') else FORMATS[0]
+        with _open_file(path, 'rb', compression) as f:
+            return _bulk(_save_record, _read_records(f, format), db,
+                         chunk_size, progress, keep_keys=False)
+
+    def release_handles(self):
+        """Returns handles bound to current thread to their pools. Handles
+        of `per_thread` storages are kept.
+        """
+        for storage in self.env.itervalues():
+            storage = _unwrap(storage)
+            if isinstance(storage, PooledStorage) and not storage.per_thread:
+                storage.pool.release()
+
+
+class StoragePool(object):
+    """A bounded set of storage handles opened with the same settings.
+
+    :param settings:
+        a dictionary for :func:`doqu.get_db`.
+    :param size:
+        maximum number of open handles. If `None`, the pool is unbounded.
+    :param timeout:
+        number of seconds to wait for a free handle when the pool is
+        exhausted. If `None`, :meth:`checkout` waits forever.
+
+    """
+    def __init__(self, settings, size=None, timeout=None):
+        self.settings = settings
+        self.size = size
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._reset()
+
+    def __contains__(self, handle):
+        return any(x is handle for x in self._handles)
+
+    def __repr__(self):
+        return '<{cls} {backend} size={size}>'.format(
+            cls=self.__class__.__name__, size=self.size,
+            backend=self.settings.get('backend'))
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._handles = []   # all open handles
+        self._idle = []      # handles ready for checkout
+        self._bound = {}     # thread id --> (thread, handle)
+
+    def _check_fork(self):
+        # handles inherited from the parent process share sockets or file
+        # descriptors with it; they are dropped without closing
+        if self._pid != os.getpid():
+            logger.debug('Process forked, reopening {0}'.format(self))
+            self._reset()
+
+    def _is_healthy(self, handle):
+        # adapters are false when their connection has been closed
+        return bool(handle)
+
+    def _open(self):
+        handle = get_db(self.settings)
+        self._handles.append(handle)
+        return handle
+
+    def _discard(self, handle):
+        self._handles = [x for x in self._handles if x is not handle]
+        try:
+            handle.disconnect()
+        except Exception:
+            pass
+
+    def _reclaim(self):
+        # return handles bound to threads that are no longer running
+        for ident, (thread, handle) in self._bound.items():
+            if not thread.is_alive():
+                del self._bound[ident]
+                self._idle.append(handle)
+
+    def checkout(self):
+        """Returns an open storage handle. The handle must be returned with
+        :meth:`checkin`. Raises `RuntimeError` if the pool is exhausted and
+        no handle is freed within `timeout`.
+        """
+        with self._cond:
+            self._check_fork()
+            deadline = None if self.timeout is None else (
+                time.time() + self.timeout)
+            while True:
+                if not self._idle:
+                    self._reclaim()
+                if self._idle:
+                    handle = self._idle.pop()
+                    if self._is_healthy(handle):
+                        return handle
+                    logger.warning('Reopening broken handle in {0}'.format(self))
+                    self._discard(handle)
+                if self.size is None or len(self._handles) < self.size:
+                    return self._open()
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise RuntimeError('{0} is exhausted'.format(self))
+                self._cond.wait(remaining)
+
+    def checkin(self, handle):
+        "Returns given handle to the pool."
+        with self._cond:
+            if handle in self:
+                self._idle.append(handle)
+                self._cond.notify()
+
+    def close(self):
+        "Disconnects all handles and empties the pool."
+        with self._cond:
+            for handle in self._handles:
+                if handle:
+                    handle.disconnect()
+            self._reset()
+
+    def get_bound(self):
+        """Returns the handle bound to current thread. Checks out a handle and
+        binds it if there is none.
+        """
+        thread = threading.current_thread()
+        with self._cond:
+            self._check_fork()
+            bound = self._bound.get(thread.ident)
+            if bound:
+                return bound[1]
+            handle = self.checkout()
+            self._bound[thread.ident] = thread, handle
+            return handle
+
+    def release(self):
+        "Returns the handle bound to current thread (if any) to the pool."
+        with self._cond:
+            bound = self._bound.pop(threading.current_thread().ident, None)
+            if bound:
+                self.checkin(bound[1])
+
+
+class ReleaseHandlesMiddleware(object):
+    """WSGI middleware that returns pooled storage handles bound to current
+    thread (see :meth:`Documents.release_handles`) when the response has been
+    sent, so that idle threads do not hold handles needed by other requests.
+    Added automatically if any database is pooled.
+    """
+    # routing does not call the application it wraps
+    outermost = True
+
+    def __init__(self, app, plugin):
+        self.app = app
+        self.plugin = plugin
+
+    def __call__(self, environ, start_response):
+        try:
+            response = self.app(environ, start_response)
+        except:
+            self.plugin.release_handles()
+            raise
+        return ClosingIterator(response, self.plugin.release_handles)
+
+
+class StorageProxy(object):
+    """Base class for objects that pretend to be a storage adapter and
+    delegate everything to :meth:`_get_storage`.
+    """
+    def __getattr__(self, name):
+        return getattr(self._get_storage(), name)
+
+    def __eq__(self, other):
+        # this is important because otherwise doc.save(db) on existing
+        # documents will always reset the primary key and create duplicates.
+        if isinstance(other, StorageProxy):
+            other = other._get_storage()
+        return self._get_storage() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return id(self)
+
+    def __contains__(self, key):
+        return key in self._get_storage()
+
+    def __iter__(self):
+        return iter(self._get_storage())
+
+    def __len__(self):
+        return len(self._get_storage())
+
+    def __nonzero__(self):
+        return bool(self._get_storage())
+
+    def __repr__(self):
+        return '<{cls} for {storage!r}>'.format(
+            cls=self.__class__.__name__, storage=self._get_storage())
+
+    def _get_storage(self):
+        raise NotImplementedError
+
+
+class PooledStorage(StorageProxy):
+    """Storage proxy that uses the handle bound to current thread.
+
+    :param pool:
+        a :class:`StoragePool` instance.
+    :param per_thread:
+        if `True`, the handle is kept by the thread until the thread dies;
+        otherwise it is returned to the pool at the end of the request.
+
+    """
+    def __init__(self, pool, per_thread=False):
+        self.pool = pool
+        self.per_thread = per_thread
+
+    def __eq__(self, other):
+        # documents remember the handle they were fetched with; any handle
+        # from the same pool refers to the same database
+        if isinstance(other, StorageProxy):
+            return super(PooledStorage, self).__eq__(other)
+        return other in self.pool
+
+    def __repr__(self):
+        return '<{cls} for {pool!r}>'.format(cls=self.__class__.__name__,
+                                             pool=self.pool)
+
+    def _get_storage(self):
+        return self.pool.get_bound()
+
+
+class CachedStorage(StorageProxy):
+    """Storage proxy that memoizes query results and counts.
+
+    :param storage:
+        the storage to wrap (an adapter or another proxy).
+    :param size:
+        maximum number of cached values.
+    :param ttl:
+        number of seconds after which a cached value expires. If `None`,
+        values are only discarded by writes and the LRU bound.
+
+    """
+    def __init__(self, storage, size=1000, ttl=60):
+        self.wrapped = storage
+        self.cache = LRUCache(size=size, default_ttl=ttl)
+
+    def _get_storage(self):
+        return self.wrapped
+
+    def invalidate(self):
+        """Discards all cached results. Called on every write made through
+        this storage.
+        """
+        self.cache.clear()
+
+    def clear(self):
+        self.wrapped.clear()
+        self.invalidate()
+
+    def delete(self, key):
+        self.wrapped.delete(key)
+        self.invalidate()
+
+    def save(self, key, data):
+        # records are schemaless and a document class is just a view, so a
+        # saved record may show up in queries for any class
+        key = self.wrapped.save(key, data)
+        self.invalidate()
+        return key
+
+    def find(self, doc_class=dict, **conditions):
+        query = self.wrapped.find(doc_class)
+        return CachedQuery(self, query, doc_class).where(**conditions)
+
+    def get_or_create(self, doc_class=dict, **conditions):
+        query = self.find(doc_class).where(**conditions)
+        if query.count():
+            return query[0], False
+        obj = doc_class(**conditions)
+        obj.save(self)
+        return obj, True
+
+
+class QueryProxy(object):
+    """Base class for wrappers around backend queries. Keeps track of the
+    operations applied to the query so that subclasses can tell one query
+    from another.
+    """
+    def __init__(self, storage, query, doc_class, operations=()):
+        self.storage = storage
+        self.query = query
+        self.doc_class = doc_class
+        self.operations = operations
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+    def __len__(self):
+        return self.count()
+
+    def __nonzero__(self):
+        return bool(self[:1])
+
+    def __repr__(self):
+        return '<{cls} {doc_class.__name__} {ops!r}>'.format(
+            cls=self.__class__.__name__, doc_class=self.doc_class,
+            ops=self.operations)
+
+    @property
+    def key(self):
+        "Identifies this query among others made with the same storage."
+        # conditions may contain unhashable values such as lists for `__in`
+        return self.doc_class, repr(self.operations)
+
+    def _clone(self, query, operation):
+        return type(self)(self.storage, query, self.doc_class,
+                          self.operations + (operation,))
+
+    def _slice(self, start, stop):
+        if 0 <= (start or 0) and 0 <= (stop or 0) and stop is not None:
+            return list(self.query[start:stop])
+        # backends do not handle open or negative slices consistently
+        return list(self.query)[start:stop]
+
+    def order_by(self, names, reverse=False):
+        if isinstance(names, basestring):
+            names = [names]
+        return self._clone(self.query.order_by(names, reverse=reverse),
+                           ('order_by', tuple(names), reverse))
+
+    def where(self, **conditions):
+        if not conditions:
+            return self
+        return self._clone(self.query.where(**conditions),
+                           ('where', sorted(conditions.items())))
+
+    def where_not(self, **conditions):
+        return self._clone(self.query.where_not(**conditions),
+                           ('where_not', sorted(conditions.items())))
+
+
+class CachedQuery(QueryProxy):
+    """Wraps a backend query and stores its results in the cache of given
+    :class:`CachedStorage`. Documents are rebuilt from cached records on every
+    access, so modifying them does not affect the cache.
+    """
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = index.start, index.stop
+            items = self._fetch(('slice', start, stop),
+                                lambda: self._slice(start, stop))
+            return items[::index.step]
+        items = self[index:index + 1 or None]
+        if not items:
+            raise IndexError('query index out of range')
+        return items[0]
+
+    def __iter__(self):
+        return iter(self._fetch(('all',), lambda: self.query))
+
+    def _fetch(self, what, factory):
+        records = self.storage.cache.get_or_set(
+            self.key + what, lambda: [self._freeze(x) for x in factory()])
+        return [self._thaw(x) for x in records]
+
+    def _freeze(self, item):
+        if hasattr(item, '_saved_state'):
+            return True, item.pk, item._saved_state.data
+        return False, None, item
+
+    def _thaw(self, record):
+        is_document, key, data = record
+        if is_document:
+            # bind the document to the caching storage so that saving it
+            # invalidates the cache
+            return self.doc_class.from_storage(self.storage, key, data)
+        return data
+
+    def count(self):
+        return self.storage.cache.get_or_set(self.key + ('count',),
+                                             self.query.count)
+
+    def delete(self):
+        self.query.delete()
+        self.storage.invalidate()
+
+    def values(self, name):
+        return iter(self.storage.cache.get_or_set(
+            self.key + ('values', name), lambda: list(self.query.values(name))))
+
+
+class QueryStats(object):
+    """Collects storage calls made while processing a request: their number,
+    time and returned rows per document class. Detects repeated identical
+    queries and queries of the same shape repeated with different values
+    (typical for N+1 access patterns).
+
+    :param size:
+        maximum number of calls kept for the analysis. Older calls are only
+        reflected in the totals.
+
+    """
+    def __init__(self, size=DEFAULT_STATS_SIZE):
+        self.calls = deque(maxlen=size)
+        self.count = 0
+        self.time = 0.0
+        self.rows = 0
+
+    def record(self, model, query, shape, duration, rows=0):
+        """Records a single storage call. Writes are recorded with `query` and
+        `shape` set to `None` and are not analyzed for repetitions.
+        """
+        self.calls.append((model, query, shape, duration, rows))
+        self.count += 1
+        self.time += duration
+        self.rows += rows
+
+    def summary(self, threshold=DEFAULT_REPEAT_THRESHOLD):
+        """Returns a dictionary with keys `count`, `time` and `rows` (totals),
+        `dropped` (number of calls not kept for the analysis), `models` (a list
+        of dictionaries with the same keys plus `name`, slowest first),
+        `duplicates` (identical queries made more than once) and `repeated`
+        (shapes of queries made at least `threshold` times with different
+        values).
+        """
+        models = {}
+        queries = {}
+        shapes = {}
+        for model, query, shape, duration, rows in self.calls:
+            item = models.setdefault(model, {'name': model, 'count': 0,
+                                             'time': 0.0, 'rows': 0})
+            item['count'] += 1
+            item['time'] += duration
+            item['rows'] += rows
+            if query is not None:
+                queries[query] = queries.get(query, 0) + 1
+                shapes.setdefault(shape, set()).add(query)
+        return {
+            'count': self.count,
+            'time': self.time,
+            'rows': self.rows,
+            'dropped': self.count - len(self.calls),
+            'models': sorted(models.values(), key=lambda x: x['time'],
+                             reverse=True),
+            'duplicates': sorted((q, n) for q, n in queries.iteritems()
+                                 if 1 < n),
+            'repeated': sorted((shape, len(qs)) for shape, qs
+                               in shapes.iteritems() if threshold <= len(qs)),
+        }
+
+
+class InstrumentedStorage(StorageProxy):
+    """Storage proxy that records every call to the backend in the
+    :class:`QueryStats` of the current request (see :func:`get_query_stats`).
+    """
+    def __init__(self, storage):
+        self.wrapped = storage
+
+    def _get_storage(self):
+        return self.wrapped
+
+    def _record(self, model, query, shape, duration, rows=0):
+        get_query_stats().record(_get_model_name(model), query, shape,
+                                 duration, rows)
+
+    def clear(self):
+        started = time.time()
+        self.wrapped.clear()
+        self._record(None, None, None, time.time() - started)
+
+    def delete(self, key):
+        started = time.time()
+        self.wrapped.delete(key)
+        self._record(None, None, None, time.time() - started)
+
+    def save(self, key, data):
+        started = time.time()
+        key = self.wrapped.save(key, data)
+        self._record(None, None, None, time.time() - started)
+        return key
+
+    def find(self, doc_class=dict, **conditions):
+        query = self.wrapped.find(doc_class)
+        return InstrumentedQuery(self, query, doc_class).where(**conditions)
+
+    def get(self, key, doc_class=dict):
+        started = time.time()
+        try:
+            return self.wrapped.get(key, doc_class)
+        finally:
+            name = _get_model_name(doc_class)
+            self._record(doc_class, '{0}.get({1!r})'.format(name, key),
+                         '{0}.get(?)'.format(name), time.time() - started, 1)
+
+    def get_many(self, keys, doc_class=dict):
+        started = time.time()
+        items = list(self.wrapped.get_many(keys, doc_class))
+        name = _get_model_name(doc_class)
+        self._record(doc_class, '{0}.get_many({1!r})'.format(name, keys),
+                     '{0}.get_many(?)'.format(name), time.time() - started,
+                     len(items))
+        return iter(items)
+
+
+class InstrumentedQuery(QueryProxy):
+    """Wraps a backend query and records its execution in the
+    :class:`QueryStats` of the current request.
+    """
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = index.start, index.stop
+            action = '[{0}:{1}]'.format(start or '', stop or '')
+            items = self._run(action, lambda: self._slice(start, stop))
+            return items[::index.step]
+        return self._run('[{0}]'.format(index), lambda: [self.query[index]])[0]
+
+    def __iter__(self):
+        elapsed = 0.0
+        rows = 0
+        items = iter(self.query)
+        try:
+            while True:
+                # only the time spent in the backend is counted, not the
+                # time the caller spends between iterations
+                started = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.time() - started
+                rows += 1
+                yield item
+        finally:
+            self._report('', elapsed, rows)
+
+    def _describe(self, shape=False):
+        parts = []
+        for operation in self.operations:
+            if operation[0] == 'order_by':
+                parts.append('.order_by({0!r}, {1!r})'.format(*operation[1:]))
+                continue
+            conditions = ('{0}={1}'.format(k, '?' if shape else repr(v))
+                          for k, v in operation[1])
+            parts.append('.{0}({1})'.format(operation[0],
+                                            ', '.join(conditions)))
+        return _get_model_name(self.doc_class) + ''.join(parts)
+
+    def _report(self, action, duration, rows):
+        self.storage._record(self.doc_class, self._describe() + action,
+                             self._describe(shape=True) + action, duration,
+                             rows)
+
+    def _run(self, action, func):
+        started = time.time()
+        result = list(func())
+        self._report(action, time.time() - started, len(result))
+        return result
+
+    def count(self):
+        started = time.time()
+        result = self.query.count()
+        self._report('.count()', time.time() - started, 1)
+        return result
+
+    def delete(self):
+        started = time.time()
+        self.query.delete()
+        self.storage._record(self.doc_class, None, None,
+                             time.time() - started)
+
+    def values(self, name):
+        return iter(self._run('.values({0!r})'.format(name),
+                              lambda: self.query.values(name)))
+
+
+def get_query_stats():
+    """Returns :class:`QueryStats` for the current request (or thread if it is
+    not processing a request). Only filled if the storage is instrumented.
+    """
+    stats = getattr(local, 'storage_stats', None)
+    if stats is None:
+        stats = local.storage_stats = QueryStats()
+    return stats
+
+@called_on(request_ready)
+def reset_query_stats(*args, **kwargs):
+    """Starts collecting :func:`get_query_stats` afresh in current thread.
+    Called when a request is ready to be processed.
+    """
+    local.storage_stats = QueryStats()
+
+def iter_documents(query):
+    """Yields documents matched by given query. A fresh copy of the query is
+    iterated, so the result cache of the given query is not filled and the
+    documents can be released as soon as the iteration is over; callers that
+    process documents in batches can take them with
+    :func:`itertools.islice`. Wrapped queries (see :class:`CachedStorage`)
+    are read directly from the backend.
+
+    .. note::
+
+        Doqu query adapters keep every item they have read, so the copy still
+        holds the documents read so far until the iteration ends. Use
+        :func:`iter_all_documents` to read a whole collection.
+
+    """
+    while isinstance(query, QueryProxy):
+        query = query.query
+    if hasattr(query, 'where'):
+        # a query with the same conditions and an empty result cache
+        query = query.where()
+    for document in query:
+        yield document
+
+def iter_all_documents(model, storage=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields all documents of given class, reading `chunk_size` of them at a
+    time. Unlike the documents of a query (see :func:`iter_documents`), only
+    the primary keys are kept until the iteration ends, so the collection can
+    be larger than available memory.
+
+    :param storage:
+        the storage to read. Default is :func:`get_default_storage`.
+
+    """
+    db = get_default_storage() if storage is None else storage
+    # the query keeps every item it has read, so it only yields the keys;
+    # the query cache is skipped as the keys are read once
+    keys = _unwrap(db).find(_KeyClass(model))
+    for offset, chunk in _iter_chunks(keys, chunk_size):
+        for document in db.get_many(chunk, model):
+            yield document
+
+
+class BulkResult(object):
+    """Outcome of :func:`bulk_save` or :func:`bulk_delete`.
+
+    .. attribute:: count
+
+        number of saved or deleted records.
+
+    .. attribute:: keys
+
+        primary keys of saved or deleted records, or `None` if they are not
+        collected.
+
+    .. attribute:: errors
+
+        list of ``(index, item, exception)`` tuples for failed items.
+
+    """
+    def __init__(self, keep_keys=True):
+        self.count = 0
+        self.keys = [] if keep_keys else None
+        self.errors = []
+
+    def __repr__(self):
+        return '<{cls}: {ok} ok, {failed} failed>'.format(
+            cls=self.__class__.__name__, ok=self.count,
+            failed=len(self.errors))
+
+    @property
+    def processed(self):
+        "Number of items processed so far."
+        return self.count + len(self.errors)
+
+
+def _iter_chunks(items, size):
+    items = iter(items)
+    offset = 0
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield offset, chunk
+        offset += len(chunk)
+
+def _sync(db):
+    try:
+        db.sync()
+    except NotImplementedError:
+        pass
+
+def _bulk(action, items, storage, chunk_size, progress, keep_keys=True):
+    db = get_default_storage() if storage is None else storage
+    result = BulkResult(keep_keys)
+    for offset, chunk in _iter_chunks(items, chunk_size):
+        for index, item in enumerate(chunk, offset):
+            try:
+                key = action(item, db)
+            except Exception as e:
+                logger.debug('Bulk operation failed for item #{0}: '
+                             '{1}'.format(index, e))
+                result.errors.append((index, item, e))
+                continue
+            result.count += 1
+            if keep_keys:
+                result.keys.append(key)
+        _sync(db)
+        if progress:
+            progress(result.processed, len(result.errors))
+    return result
+
+def _save(document, db):
+    return document.save(db)
+
+def _save_record(record, db):
+    key, data = record
+    return db.save(key, data)
+
+def _delete(item, db):
+    key = getattr(item, 'pk', item)
+    db.delete(key)
+    return key
+
+def bulk_save(documents, storage=None, chunk_size=DEFAULT_CHUNK_SIZE,
+              progress=None):
+    """Saves given documents and returns a :class:`BulkResult`. Documents that
+    fail validation or cannot be written are reported in `errors`; the rest
+    are saved anyway.
+
+    :param documents:
+        an iterable of documents; it is consumed lazily, `chunk_size` items at
+        a time.
+    :param storage:
+        the storage to save the documents to. Default is
+        :func:`get_default_storage`.
+    :param chunk_size:
+        number of documents written between backend flushes.
+    :param progress:
+        a callable that is called after each chunk with the number of
+        processed items and the number of errors.
+
+    """
+    return _bulk(_save, documents, storage, chunk_size, progress)
+
+def bulk_delete(items, storage=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                progress=None):
+    """Deletes given documents or primary keys from the storage. Same as
+    :func:`bulk_save` in all other respects.
+
+    .. note::
+
+        When deleting the results of a query, fetch the keys first (e.g.
+        ``[x.pk for x in query]``) because not all backends can iterate a
+        collection while it is being changed. To simply drop all matching
+        records, use ``query.delete()``.
+
+    """
+    return _bulk(_delete, items, storage, chunk_size, progress)
+
+def _get_model_name(model):
+    if model is None:
+        return '(write)'
+    return getattr(model, '__name__', repr(model))
+
+
+_exporting_plugin = None
+
+def _export_model(task, plugin=None):
+    path, model, database, format, compression = task
+    plugin = plugin or _exporting_plugin
+    db = plugin.open_storage(database)
+    try:
+        return path, plugin.export_records(path, model, db, format=format,
+                                           compression=compression)
+    finally:
+        db.disconnect()
+
+def _open_file(path, mode, compression=None):
+    if compression:
+        return COMPRESSORS[compression][1](path, mode)
+    return open(path, mode)
+
+def _iter_records(db, model=None):
+    if model is not None:
+        for document in iter_all_documents(model, db):
+            yield document.pk, document._saved_state.data
+        return
+    # walk the keys so that only one chunk of records is held in memory
+    for offset, keys in _iter_chunks(iter(db), DEFAULT_CHUNK_SIZE):
+        for key, data in db.get_many(keys):
+            yield key, data
+
+
+class _KeyClass(object):
+    "Stands for given document class in a query that only yields the keys."
+    def __init__(self, model):
+        self.model = model
+
+    def __repr__(self):
+        return '<keys of {0}>'.format(_get_model_name(self.model))
+
+    def contribute_to_query(self, query):
+        return self.model.contribute_to_query(query)
+
+    def from_storage(self, storage, key, data):
+        return key
+
+
+def _encode_json(value):
+    for name, type_ in _JSON_TYPES:
+        if isinstance(value, type_):
+            return {'__type__': name, 'value': _JSON_ENCODERS[name](value)}
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
+
+def _decode_json(obj):
+    if '__type__' in obj and obj['__type__'] in _JSON_DECODERS:
+        return _JSON_DECODERS[obj['__type__']](obj['value'])
+    return obj
+
+# datetime must precede date because it is its subclass
+_JSON_TYPES = (('datetime', datetime.datetime), ('date', datetime.date),
+               ('time', datetime.time), ('decimal', decimal.Decimal))
+_JSON_ENCODERS = {
+    'datetime': lambda x: x.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+    'date': lambda x: x.isoformat(),
+    'time': lambda x: x.strftime('%H:%M:%S.%f'),
+    'decimal': unicode,
+}
+_JSON_DECODERS = {
+    'datetime': lambda x: datetime.datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%f'),
+    'date': lambda x: datetime.datetime.strptime(x, '%Y-%m-%d').date(),
+    'time': lambda x: datetime.datetime.strptime(x, '%H:%M:%S.%f').time(),
+    'decimal': decimal.Decimal,
+}
+
+def _write_records(f, records, format):
+    count = 0
+    for key, data in records:
+        if format == 'pickle':
+            pickle.dump((key, data), f, pickle.HIGHEST_PROTOCOL)
+        else:
+            f.write(json.dumps({'pk': key, 'data': data},
+                               default=_encode_json) + '\n')
+        count += 1
+    return count
+
+def _read_records(f, format):
+    if format == 'pickle':
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+    for line in f:
+        if line.strip():
+            record = json.loads(line, object_hook=_decode_json)
+            yield record['pk'], record['data']
+
+
+def _unwrap(storage):
+    # skip caching and instrumentation to reach the pooled (or plain) storage
+    while isinstance(storage, (CachedStorage, InstrumentedStorage)):
+        storage = storage.wrapped
+    return storage
+
 
 # XXX remove the code below? it's harmless but unnecessary
 
@@ -209,17 +1438,49 @@ class DefaultStorageProxy(object):
 db = DefaultStorageProxy()
 '''
 
-def get_object_or_404(model, **conditions):
+def get_object_or_404(model, *args, **conditions):
     """
-    Returns a Docu model instance that ................................................
+    Returns a Doqu model instance that matches given conditions. Raises
+    `NotFound` if there is no such instance and `RuntimeError` if there are
+    several. Usage::
+
+        note = get_object_or_404(Note, slug=u'hello')
+        note = get_object_or_404(Note, db, slug=u'hello')
+        note = get_object_or_404(Note, db, request.args['id'])
+
+    The storage and the primary key can only be passed positionally, so any
+    keyword argument is a condition (even for fields named `storage` or
+    `pk`).
+
+    :param storage:
+        (second argument) the storage to query. Default is
+        :func:`get_default_storage`.
+    :param pk:
+        (third argument) primary key of the record. If given, the record is
+        fetched directly (no query is made) and conditions are not allowed.
+
     """
-    db = default_storage()
-    qs = model.objects(db).where(**conditions)
-    if not qs:
+    if 2 < len(args):
+        raise TypeError('get_object_or_404() takes at most 3 positional '
+                        'arguments ({0} given)'.format(len(args) + 1))
+    storage, pk = args + (None,) * (2 - len(args))
+    db = get_default_storage() if storage is None else storage
+    if pk is not None:
+        if conditions:
+            raise TypeError('get_object_or_404() accepts either the primary '
+                            'key or conditions, not both')
+        try:
+            return db.get(pk, model)
+        except KeyError:
+            raise werkzeug.exceptions.NotFound
+    # fetch at most two items in a single query: one to return and another one
+    # to detect ambiguous conditions
+    found = list(model.objects(db).where(**conditions)[:2])
+    if not found:
         raise werkzeug.exceptions.NotFound
-    if 1 < len(qs):
+    if 1 < len(found):
         raise RuntimeError('multiple objects returned')
-    return qs[0]
+    return found[0]
 
 '''
 #@called_on(app_manager_ready)
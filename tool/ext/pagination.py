@@ -8,33 +8,306 @@ Pagination utilities
 :dependencies: none
 
 Based on the Werkzeug tutorial.
+
+By default pages are addressed by number and each page is fetched by slicing
+the query, which means that the storage has to skip all preceding records. For
+large collections use the *cursor* (keyset) mode: pass the name of a field with
+unique values as `key`, and pages will be addressed by the last (or first) key
+seen on the neighbouring page::
+
+    pagination = Pagination(query, 20, 1, 'myapp.views.note_list',
+                            key='date_time', after=request.args.get('after'),
+                            before=request.args.get('before'), with_count=False)
+
+Each page then costs the same: the query is filtered by the key, ordered by it
+and only ``per_page + 1`` items are fetched (the extra item tells whether there
+is another page). The total count is optional in this mode; if `with_count` is
+`False`, :attr:`Pagination.count` and :attr:`Pagination.pages` are `None` and
+there is no link to the last page.
+
+Counting
+--------
+
+Counting all matching records can be the slowest part of a list page. The
+`count_strategy` argument chooses how :attr:`Pagination.count` is obtained:
+
+* ``exact`` (default) — ``query.count()`` on every request;
+* ``cached`` — the count is kept across requests for `count_ttl` seconds. The
+  cache key is `count_key` or, if the query provides it, ``query.key`` (see
+  :class:`tool.ext.documents.QueryProxy`). Without a key the count is exact;
+* ``estimated`` — the number of records in the whole storage is used as an
+  upper bound (:attr:`Pagination.count_is_estimate` is then `True`, templates
+  should display it as such, e.g. "up to 1000"). There is no link to the last
+  page.
+
+With non-exact counts, the link to the next page depends on one extra item
+fetched with the current page rather than on the count.
+
+Prefetching
+-----------
+
+Most users just click "next". If `prefetch_session` (any hashable value that
+identifies the browser session) and `prefetch_query` are given, the next page
+is fetched in advance as soon as the current one is fetched, and kept in a
+small in-memory cache for a short time. The cache key consists of the session,
+the query (`prefetch_key` or ``query.key``) and the page. When the same session
+requests any other page, the pending prefetch is cancelled and its result is
+discarded.
+
+The pages are fetched by a small fixed set of worker threads; if they are
+busy, nothing is prefetched. A worker must not use the storage handle of the
+request, so `prefetch_query` is a function that returns a context manager
+which yields the same query bound to a handle borrowed from the pool (only
+pooled databases can be used), e.g.::
+
+    @contextmanager
+    def prefetch_query():
+        with app.get_feature('document_storage').checkout() as db:
+            yield Note.objects(db).order_by('date_time')
 """
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+import os
+import Queue
+import threading
 
 from werkzeug import cached_property, Href
+from tool.cache import LRUCache
 from tool.routing import url_for
 
 
+__all__ = ['Pagination']
+
+
+COUNT_STRATEGIES = 'exact', 'cached', 'estimated'
+DEFAULT_COUNT_TTL = 60
+
+DEFAULT_PREFETCH_TTL = 60
+PREFETCH_WORKERS = 2
+PREFETCH_QUEUE_SIZE = 10
+
+# counts shared by requests (for the "cached" strategy)
+_counts = LRUCache(size=1000)
+
+# prefetched pages and cancellation flags of pending prefetches per session
+_prefetched = LRUCache(size=100, default_ttl=DEFAULT_PREFETCH_TTL)
+_prefetch_jobs = LRUCache(size=1000, default_ttl=DEFAULT_PREFETCH_TTL)
+_prefetch_lock = threading.Lock()
+
+# the workers are started on first use (and again in a forked process)
+_prefetch_queue = Queue.Queue(PREFETCH_QUEUE_SIZE)
+_prefetch_pid = None
+
+
+CURSOR_FORMATS = {
+    datetime.datetime: ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'),
+    datetime.date: ('%Y-%m-%d',),
+    datetime.time: ('%H:%M:%S.%f', '%H:%M:%S'),
+}
+
+
 class Pagination(object):
     """
-    TODO
+    Splits query results into pages.
+
+    :param query:
+        a Doqu query.
+    :param per_page:
+        number of items per page.
+    :param page:
+        number of current page (ignored in cursor mode).
+    :param endpoint:
+        the view used to build page URLs; `kwargs` are passed to it. Pass the
+        request arguments that define the list (e.g. the search string) here
+        so that they are kept in the URLs of other pages.
+    :param key:
+        name of a field with unique values. If given, cursor mode is used and
+        the query is ordered by this field.
+    :param after:
+        show the items that follow the item with this key (cursor mode).
+    :param before:
+        show the items that precede the item with this key (cursor mode).
+    :param reverse:
+        if `True`, the items are ordered by `key` descending (cursor mode).
+    :param with_count:
+        if `False`, the total count is not queried (cursor mode).
+    :param count_strategy:
+        one of ``exact``, ``cached`` and ``estimated`` (see above).
+    :param count_key:
+        a hashable value that identifies the query in the count cache.
+    :param count_ttl:
+        number of seconds a cached count is valid.
+    :param prefetch_session:
+        if given with `prefetch_query`, the next page is prefetched for this
+        session (see above).
+    :param prefetch_key:
+        a hashable value that identifies the query in the prefetch cache.
+    :param prefetch_query:
+        a function that returns a context manager yielding the query bound to
+        a storage handle of its own (see above).
+
     """
-    def __init__(self, query, per_page, page, endpoint, **kwargs):
+    def __init__(self, query, per_page, page, endpoint, key=None, after=None,
+                 before=None, reverse=False, with_count=True,
+                 count_strategy=COUNT_STRATEGIES[0], count_key=None,
+                 count_ttl=DEFAULT_COUNT_TTL, prefetch_session=None,
+                 prefetch_key=None, prefetch_query=None, **kwargs):
+        assert count_strategy in COUNT_STRATEGIES, (
+            'count strategy must be one of {0}'.format(COUNT_STRATEGIES))
         self.query = query
         self.per_page = int(per_page)
         self.page = int(page)
         self.endpoint = endpoint
+        self.key = key
+        self.after = self._parse_cursor(after) if after else None
+        self.before = self._parse_cursor(before) if before else None
+        self.reverse = reverse
+        self.with_count = with_count or not key
+        self.count_strategy = count_strategy
+        self.count_key = count_key
+        self.count_ttl = count_ttl
+        self.prefetch_session = prefetch_session
+        self.prefetch_key = prefetch_key
+        self.prefetch_query = prefetch_query
         self.kwargs = kwargs
 
     @cached_property
-    def count(self):
-        return self.query.count()
+    def _count(self):
+        # returns the count and a boolean: whether it is an estimate
+        if not self.with_count:
+            return None, False
+        if self.count_strategy == 'estimated':
+            storage = getattr(self.query, 'storage', None)
+            if storage is not None:
+                return len(storage), True
+        if self.count_strategy == 'cached':
+            key = self.count_key or getattr(self.query, 'key', None)
+            if key is not None:
+                return _counts.get_or_set(('count', key), self.query.count,
+                                          self.count_ttl), False
+        return self.query.count(), False
+
+    count = property(lambda x: x._count[0])
+    count_is_estimate = property(lambda x: x._count[1])
+
+    @property
+    def _lookahead(self):
+        return self.count_strategy != 'exact' or self._cache_key is not None
+
+    @cached_property
+    def _cache_key(self):
+        if self.prefetch_session is None or self.prefetch_query is None:
+            return None
+        query_key = self.prefetch_key or getattr(self.query, 'key', None)
+        if query_key is None:
+            return None
+        return (self.prefetch_session, query_key, self.per_page, self.page,
+                self.key, self.after, self.before, self.reverse)
 
     @cached_property
     def entries(self):
+        if self.key or self._lookahead:
+            return self._window[0]
         offset = self.per_page * (self.page - 1)
         limit = self.per_page + offset
         return self.query[offset:limit]
 
+    @cached_property
+    def _window(self):
+        # returns the items of current page and a boolean: whether there are
+        # more items in the direction of fetching
+        key = self._cache_key
+        if key is None:
+            return self._fetch_window()
+        _cancel_prefetch(self.prefetch_session, key)
+        window = _prefetched.get(key)
+        if window is None:
+            window = self._fetch_window()
+        else:
+            _prefetched.delete(key)
+        if window[1] and self.before is None:
+            self._prefetch_next(window[0])
+        return window
+
+    def _fetch_window(self):
+        if not self.key:
+            offset = self.per_page * (self.page - 1)
+            items = list(self.query[offset:offset + self.per_page + 1])
+            return items[:self.per_page], self.per_page < len(items)
+        backwards = self.before is not None
+        descending = self.reverse != backwards
+        query = self.query
+        if backwards or self.after is not None:
+            lookup = '{0}__{1}'.format(self.key, 'lt' if descending else 'gt')
+            query = query.where(**{lookup: self.before if backwards
+                                            else self.after})
+        query = query.order_by(self.key, reverse=descending)
+        items = list(query[:self.per_page + 1])
+        more = self.per_page < len(items)
+        items = items[:self.per_page]
+        if backwards:
+            items.reverse()
+        return items, more
+
+    def _prefetch_next(self, items):
+        if self.key:
+            following = dict(page=1, after=self._format_cursor(items[-1]))
+        else:
+            following = dict(page=self.page + 1)
+        following = Pagination(self.query, self.per_page,
+                               endpoint=self.endpoint, key=self.key,
+                               reverse=self.reverse,
+                               prefetch_session=self.prefetch_session,
+                               prefetch_key=self.prefetch_key,
+                               prefetch_query=self.prefetch_query,
+                               **following)
+        key = following._cache_key
+        cancelled = threading.Event()
+        with _prefetch_lock:
+            _prefetch_jobs.set(self.prefetch_session, (key, cancelled))
+        _start_prefetch_workers()
+        try:
+            _prefetch_queue.put_nowait((following, key, cancelled))
+        except Queue.Full:
+            logger.debug('Prefetch workers are busy, not prefetching')
+            cancelled.set()
+
+    def _parse_cursor(self, value):
+        structure = getattr(getattr(self.query.doc_class, 'meta', None),
+                            'structure', {})
+        datatype = structure.get(self.key)
+        if datatype in CURSOR_FORMATS:
+            for fmt in CURSOR_FORMATS[datatype]:
+                try:
+                    parsed = datetime.datetime.strptime(value, fmt)
+                except ValueError:
+                    continue
+                if datatype is datetime.date:
+                    return parsed.date()
+                if datatype is datetime.time:
+                    return parsed.time()
+                return parsed
+            raise ValueError('Bad cursor {0!r} for {1}'.format(value, datatype))
+        if datatype in (int, long, float):
+            return datatype(value)
+        if isinstance(value, str):
+            return value.decode('utf-8')
+        return value
+
+    def _format_cursor(self, item):
+        value = item[self.key]
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        return value
+
+    def _get_url(self, **params):
+        url = url_for(self.endpoint, **dict(self.kwargs, **params))
+        if url:
+            return url
+        else:
+            return Href('.')(**params)
+
     def _get_page_url(self, page):
         url = url_for(self.endpoint, page=page, **self.kwargs)
         if url:
@@ -44,10 +317,99 @@ class Pagination(object):
             # page is just a param: /foo?page=x
             return Href('.')(page=page)
 
-    has_previous = property(lambda x: x.page > 1)
-    has_next = property(lambda x: x.page < x.pages)
-    previous = property(lambda x: x._get_page_url(x.page - 1))
-    first = property(lambda x: x._get_page_url(1))
-    next = property(lambda x: x._get_page_url(x.page + 1))
-    last = property(lambda x: x._get_page_url(x.pages))
-    pages = property(lambda x: max(0, x.count - 1) // x.per_page + 1)
+    @property
+    def has_previous(self):
+        if not self.key:
+            return self.page > 1
+        if self.before is not None:
+            return self._window[1]
+        return self.after is not None
+
+    @property
+    def has_next(self):
+        if not self.key:
+            if self._lookahead:
+                return self._window[1]
+            return self.page < self.pages
+        if self.before is not None:
+            return True
+        return self._window[1]
+
+    @property
+    def previous(self):
+        if not self.key:
+            return self._get_page_url(self.page - 1)
+        if self.entries:
+            return self._get_url(before=self._format_cursor(self.entries[0]))
+
+    @property
+    def next(self):
+        if not self.key:
+            return self._get_page_url(self.page + 1)
+        if self.entries:
+            return self._get_url(after=self._format_cursor(self.entries[-1]))
+
+    @property
+    def first(self):
+        if not self.key:
+            return self._get_page_url(1)
+        return self._get_url()
+
+    @property
+    def last(self):
+        if self.key or self.count_is_estimate:
+            return None
+        return self._get_page_url(self.pages)
+
+    @property
+    def pages(self):
+        if self.count is None:
+            return None
+        return max(0, self.count - 1) // self.per_page + 1
+
+
+def _cancel_prefetch(session, key):
+    # called when the session requests a page: the pending prefetch is either
+    # for this very page (and is no longer needed if not ready yet) or for a
+    # page the user did not go to
+    with _prefetch_lock:
+        job = _prefetch_jobs.get(session)
+        _prefetch_jobs.delete(session)
+    if job:
+        # a late result must not be stored
+        job[1].set()
+        if job[0] != key:
+            _prefetched.delete(job[0])
+
+def _prefetch(pagination, key, cancelled):
+    if cancelled.is_set():
+        return
+    try:
+        with pagination.prefetch_query() as query:
+            pagination.query = query
+            window = pagination._fetch_window()
+    except Exception as e:
+        logger.debug('Could not prefetch page: {0}'.format(e))
+        return
+    if not cancelled.is_set():
+        _prefetched.set(key, window)
+
+def _run_prefetch_worker():
+    while True:
+        job = _prefetch_queue.get()
+        try:
+            _prefetch(*job)
+        finally:
+            _prefetch_queue.task_done()
+
+def _start_prefetch_workers():
+    global _prefetch_pid
+    with _prefetch_lock:
+        if _prefetch_pid == os.getpid():
+            return
+        _prefetch_pid = os.getpid()
+        for i in range(PREFETCH_WORKERS):
+            thread = threading.Thread(target=_run_prefetch_worker,
+                                      name='prefetch-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
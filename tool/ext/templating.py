@@ -122,6 +122,138 @@ directory. All other admin templates remain defaults.
 
 This way you can override any bundle's template.
 
+Precompiling templates
+----------------------
+
+By default each worker process compiles templates lazily, i.e. the first request
+that needs a template pays for parsing it. You can tell the plugin to keep
+compiled templates in a directory (Jinja2 bytecode cache or Mako module
+directory)::
+
+    extensions:
+        tool.ext.templating.JinjaPlugin:
+            cache_dir: 'var/templates'
+
+...and then fill that directory before the application is deployed::
+
+    $ ./manage.py templating compile
+
+The command walks all templates reachable through `searchpaths` and registered
+bundles, compiles them (in parallel processes if requested with
+``--processes``) and reports syntax errors. Without `cache_dir` the templates
+are only checked for errors.
+
+Streaming
+---------
+
+Large pages can be sent to the client while they are still being rendered::
+
+    @as_html('admin/object_list.html', stream=True)
+    def object_list(request):
+        ...
+
+The rendered chunks are buffered up to `stream_buffer_size` characters
+(Jinja2 only; default is 4096) before they are passed to the WSGI server. Mako
+templates are rendered in one piece either way.
+
+Fragment caching
+----------------
+
+Parts of pages that look the same for many requests (navigation, sidebars,
+etc.) can be cached. In Jinja2 templates::
+
+    {% cache 'nav:' ~ namespace, 300 %}
+        ...expensive stuff...
+    {% endcache %}
+
+The first argument is the key, the second (optional) one is the timeout in
+seconds. In Mako templates the same is done with a function::
+
+    ${cache_fragment('nav', lambda: capture(navigation), 300)}
+
+The Python API consists of :func:`cache_fragment` and
+:func:`invalidate_fragments`. The latter removes all fragments which keys
+start with given prefix.
+
+The cache backend can be configured (see :func:`tool.cache.make_cache`)::
+
+    extensions:
+        tool.ext.templating.JinjaPlugin:
+            fragment_cache:
+                backend: file
+                path: /dev/shm/myproject-fragments
+                default_ttl: 600
+
+By default an in-process LRU cache is used.
+
+Production mode
+---------------
+
+By default Jinja2 checks on every template lookup whether the template file
+has changed, and each lookup goes through all search paths and bundles until
+the template is found. In production you will want to turn this off::
+
+    extensions:
+        tool.ext.templating.JinjaPlugin:
+            memoize_templates: true
+
+With this setting each template name is resolved once; the source (or the
+fact that the template does not exist) is remembered and the file system is
+not touched again. `auto_reload` is turned off unless explicitly set.
+
+To pick up changed templates without restarting the process, send the
+:data:`templates_changed` signal::
+
+    from tool.ext.templating import templates_changed
+
+    templates_changed.send()
+
+The same setting is understood by :class:`MakoPlugin` where it turns off
+Mako's `filesystem_checks`.
+
+Mako settings
+-------------
+
+:class:`MakoPlugin` indexes all templates in its directories on start and
+looks them up by name instead of probing each directory. Besides `searchpaths`,
+`cache_dir` (the compiled module directory), `fragment_cache` and
+`memoize_templates`, it accepts these settings:
+
+* `collection_size` — maximum number of compiled templates kept in memory.
+  Default is -1 (unlimited).
+* `filesystem_checks` — whether to check template files for changes on each
+  lookup and to look for templates that were added after the index was built.
+  Default is `True` unless `memoize_templates` is enabled.
+
+Profiling
+---------
+
+To find out which templates are worth optimizing, enable instrumentation::
+
+    extensions:
+        tool.ext.templating.JinjaPlugin:
+            profile: true
+            profile_blocks: true    # Jinja2 only
+
+The plugin then records render count, cumulative and 95th percentile time and
+output size per template (and per block as ``template#block``). The figures
+can be obtained from :meth:`BaseTemplatingPlugin.get_render_stats` or, in
+debug mode, through the view :func:`render_stats` (mount this module in the
+routing configuration)::
+
+    extensions:
+        tool.ext.werkzeug_routing.Routing:
+            tool.ext.templating: /_debug/templating/
+
+There is also a command that requests given URLs from the application and
+prints the statistics (profiling is enabled for the command even if it is off
+in the configuration)::
+
+    $ ./manage.py templating stats /admin/main/Note/ -n 10
+
+Block timing includes the time spent by the consumer between chunks, so it is
+only accurate for non-streamed responses.
+
 API reference
 -------------
 
@@ -130,13 +262,22 @@ methods: `register_templates` to declare the template directories, and
 `render_template` to actually use them.
 
 """
+from collections import deque
 from copy import deepcopy
 from functools import wraps
+import json
 import logging
-from werkzeug import Response
+import multiprocessing
+import os
+import threading
+import time
+from werkzeug import BaseResponse, Client, Response, cached_property
+from werkzeug.exceptions import NotFound
 from tool import app
 from tool import dist
-from tool.routing import url_for
+from tool.cache import make_cache
+from tool.cli import arg, CommandError
+from tool.routing import url, url_for
 from tool.signals import called_on, Signal
 from tool.application import request_ready
 from tool.plugins import get_feature
@@ -148,30 +289,361 @@ dist.check_dependencies(__name__)
 
 try:
     import jinja2 #import Environment, ChoiceLoader, FileSystemLoader, PackageLoader, PrefixLoader
+    import jinja2.ext
 except ImportError:
     jinja2 = None
 
 try:
     import mako
+    import mako.exceptions
     import mako.lookup
 except ImportError:
     mako = None
 
 
 __all__ = ['JinjaPlugin', 'MakoPlugin', 'as_html', 'register_templates',
-           'render_template', 'render_response']
+           'render_template', 'render_response', 'stream_template',
+           'stream_response', 'cache_fragment', 'invalidate_fragments',
+           'templates_changed']
 
 
 FEATURE = 'templating'
 DEFAULT_PATH = 'templates'
+DEFAULT_STREAM_BUFFER_SIZE = 4096
+FRAGMENT_KEY_PREFIX = 'fragment:'
+DEFAULT_PROFILE_SAMPLES = 1000
+# files with these extensions are never listed or indexed as templates
+NON_TEMPLATE_EXTENSIONS = ('.py', '.pyc', '.pyo', '.swp', '.png', '.jpg',
+                           '.jpeg', '.gif', '.ico', '.svgz', '.woff', '.ttf',
+                           '.eot', '.pdf', '.zip', '.gz')
 DEFAULT_TEMPLATE_FUNCTIONS = {
     'url_for': url_for,
 }
 
 
+def make_compile_command(plugin):
+    """Factory that expects a templating plugin instance and returns the CLI
+    command `compile` bound to that plugin.
+    """
+    @arg('-e', '--extension', dest='extensions', action='append',
+         help='only compile templates with given extension (repeatable)')
+    @arg('-p', '--processes', type=int, default=1,
+         help='number of worker processes')
+    def compile(args):
+        """ Compiles all known templates ahead of time. If `cache_dir` is
+        configured, the compiled templates are stored there so that the
+        application processes do not have to compile them on first request.
+        Reports syntax errors and files that cannot be decoded.
+        """
+        paths = plugin.list_templates(extensions=args.extensions)
+        errors = plugin.compile_templates(paths, processes=args.processes)
+        for path in sorted(errors):
+            yield u'{0}: {1}'.format(path, errors[path])
+        yield u'Compiled {0} templates, {1} errors.'.format(
+            len(paths) - len(errors), len(errors))
+    return compile
+
+def _is_template(name):
+    # hidden files, editor backups, compiled modules and binary files are
+    # found next to templates but are not templates
+    name = name.rpartition('/')[2]
+    return not (name.startswith('.') or name.endswith('~') or
+                name.lower().endswith(NON_TEMPLATE_EXTENSIONS))
+
+def make_stats_command(plugin):
+    """Factory that expects a templating plugin instance and returns the CLI
+    command `stats` bound to that plugin.
+    """
+    @arg('urls', nargs='+', help='paths to request from the application')
+    @arg('-n', '--number', type=int, default=1,
+         help='how many times each URL should be requested')
+    def stats(args):
+        """ Requests given URLs from the application and prints render
+        statistics per template (and per block if `profile_blocks` is on).
+        """
+        if not hasattr(plugin.app, 'wsgi_app'):
+            raise CommandError('The application must be a WebApplication.')
+        render_stats = plugin.get_render_stats()
+        if render_stats is None:
+            render_stats = plugin.env['render_stats'] = RenderStats()
+        client = Client(plugin.app, BaseResponse)
+        for path in args.urls:
+            for i in range(args.number):
+                # the body must be read for streamed templates to be rendered
+                response = client.get(path, buffered=True)
+                if 400 <= response.status_code:
+                    yield u'{0}: {1}'.format(path, response.status)
+        yield (u'{0:>6} {1:>10} {2:>8} {3:>8} {4:>9}  {5}'.format(
+            'count', 'total, s', 'mean, s', 'p95, s', 'size', 'template'))
+        for row in render_stats.summary():
+            yield (u'{count:>6} {total:>10.4f} {mean:>8.4f} {p95:>8.4f} '
+                   u'{size:>9}  {name}'.format(**row))
+    return stats
+
+# the plugin is passed to the worker processes by forking
+_compiling_plugin = None
+
+def _compile_template(path):
+    return path, _compiling_plugin.compile_template(path)
+
+def _profile_chunks(stats, name, chunks):
+    "Passes given chunks through and records the time they took to generate."
+    start = time.time()
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    stats.record(name, time.time() - start, size)
+
+def _buffer_chunks(chunks, size):
+    "Joins given chunks of text into chunks of at least given size."
+    buf = []
+    length = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        length += len(chunk)
+        if size <= length:
+            yield u''.join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield u''.join(buf)
+
+
+class RenderStats(object):
+    """Collects render count, time and output size per template. Thread-safe.
+
+    :param samples:
+        Number of latest render times per template kept to compute the 95th
+        percentile.
+
+    """
+    def __init__(self, samples=DEFAULT_PROFILE_SAMPLES):
+        self.samples = samples
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, duration, size):
+        "Records a single rendering of given template (or block)."
+        with self._lock:
+            if name not in self._stats:
+                self._stats[name] = {'count': 0, 'total': 0.0, 'size': 0,
+                                     'times': deque(maxlen=self.samples)}
+            item = self._stats[name]
+            item['count'] += 1
+            item['total'] += duration
+            item['size'] += size
+            item['times'].append(duration)
+
+    def reset(self):
+        "Discards all collected data."
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self):
+        """Returns a list of dictionaries with keys `name`, `count`, `total`,
+        `mean`, `p95` (all times in seconds) and `size` (mean output size in
+        characters). Sorted by cumulative time, slowest first.
+        """
+        with self._lock:
+            items = [(name, dict(item, times=sorted(item['times'])))
+                     for name, item in self._stats.iteritems()]
+        rows = []
+        for name, item in items:
+            times = item['times']
+            rows.append({
+                'name': name,
+                'count': item['count'],
+                'total': item['total'],
+                'mean': item['total'] / item['count'],
+                'p95': times[int(len(times) * 0.95)] if times else 0,
+                'size': item['size'] // item['count'],
+            })
+        return sorted(rows, key=lambda x: x['total'], reverse=True)
+
+
+if jinja2:
+    class FragmentCacheExtension(jinja2.ext.Extension):
+        """Adds the ``{% cache key[, timeout] %}...{% endcache %}`` tag to
+        Jinja2. The fragments are stored in the plugin's fragment cache.
+        """
+        tags = set(['cache'])
+
+        def __init__(self, environment):
+            super(FragmentCacheExtension, self).__init__(environment)
+            environment.extend(fragment_cache=None)
+
+        def parse(self, parser):
+            lineno = next(parser.stream).lineno
+            args = [parser.parse_expression()]
+            if parser.stream.skip_if('comma'):
+                args.append(parser.parse_expression())
+            else:
+                args.append(jinja2.nodes.Const(None))
+            body = parser.parse_statements(['name:endcache'],
+                                           drop_needle=True)
+            call = self.call_method('_cache_support', args)
+            return jinja2.nodes.CallBlock(call, [], [], body).set_lineno(
+                lineno)
+
+        def _cache_support(self, key, ttl, caller):
+            cache = self.environment.fragment_cache
+            return cache.get_or_set(FRAGMENT_KEY_PREFIX + key, caller, ttl)
+
+    class MemoizingLoader(jinja2.BaseLoader):
+        """Wraps given loader and remembers the outcome of each lookup: either
+        the source of the template or the fact that it does not exist. The
+        wrapped loader is only asked once per template name until
+        :meth:`reset` is called.
+        """
+        def __init__(self, loader):
+            self.loader = loader
+            self._sources = {}
+            self._lock = threading.Lock()
+
+        def get_source(self, environment, template):
+            try:
+                found = self._sources[template]
+            except KeyError:
+                with self._lock:
+                    try:
+                        source, filename, uptodate = self.loader.get_source(
+                            environment, template)
+                    except jinja2.TemplateNotFound:
+                        found = None
+                    else:
+                        found = source, filename
+                    self._sources[template] = found
+            if found is None:
+                raise jinja2.TemplateNotFound(template)
+            source, filename = found
+            return source, filename, lambda: True
+
+        def list_templates(self):
+            return self.loader.list_templates()
+
+        def reset(self):
+            "Forgets all lookups."
+            self._sources.clear()
+
+    class ProfiledTemplate(jinja2.Template):
+        """Template class that records render time of each block in the
+        environment's `render_stats`.
+        """
+        @classmethod
+        def _from_namespace(cls, environment, namespace, globals):
+            t = super(ProfiledTemplate, cls)._from_namespace(
+                environment, namespace, globals)
+            stats = environment.render_stats
+            t.blocks = dict((name, _make_profiled_block(stats, t.name, name, f))
+                            for name, f in t.blocks.iteritems())
+            return t
+
+    def _make_profiled_block(stats, template_name, block_name, func):
+        name = u'{0}#{1}'.format(template_name, block_name)
+        def inner(*args, **kwargs):
+            return _profile_chunks(stats, name, func(*args, **kwargs))
+        return inner
+
+if mako:
+    class IndexedTemplateLookup(mako.lookup.TemplateLookup):
+        """Mako template lookup that finds templates by a precomputed index of
+        names instead of checking each directory for the file on every cache
+        miss. First directory that contains given name wins, as in Mako.
+
+        Hidden files, compiled modules and editor backups are not indexed, nor
+        is `module_directory` if it is inside a search path. With
+        `filesystem_checks` on, names missing from the index are looked up
+        the usual way, so that templates added on disk are found.
+        """
+        def __init__(self, directories=None, **kwargs):
+            super(IndexedTemplateLookup, self).__init__(directories, **kwargs)
+            self.reindex()
+
+        def _index_directory(self, directory, index):
+            skipped = self.module_directory and os.path.abspath(
+                self.module_directory)
+            for root, dirs, files in os.walk(directory):
+                dirs[:] = [x for x in dirs if not x.startswith('.') and
+                           os.path.abspath(os.path.join(root, x)) != skipped]
+                for name in files:
+                    if not _is_template(name):
+                        continue
+                    filename = os.path.join(root, name)
+                    uri = os.path.relpath(filename, directory)
+                    index.setdefault(uri.replace(os.path.sep, '/'), filename)
+
+        def add_directory(self, directory):
+            "Appends given directory to the search path and indexes it."
+            index = dict(self.index)
+            self._index_directory(directory, index)
+            self.directories.append(directory)
+            self.index = index
+
+        def reindex(self):
+            """Rebuilds the index of template names. The new index replaces
+            the old one at once, so that concurrent lookups never see it
+            half-built.
+            """
+            index = {}
+            for directory in self.directories:
+                self._index_directory(directory, index)
+            self.index = index
+
+        def get_template(self, uri):
+            try:
+                if self.filesystem_checks:
+                    return self._check(uri, self._collection[uri])
+                else:
+                    return self._collection[uri]
+            except KeyError:
+                try:
+                    filename = self.index[uri.lstrip('/')]
+                except KeyError:
+                    if self.filesystem_checks:
+                        # the file may have been added after indexing
+                        return super(IndexedTemplateLookup,
+                                     self).get_template(uri)
+                    raise mako.exceptions.TopLevelLookupException(
+                        'Cant locate template for uri {0!r}'.format(uri))
+                return self._load(filename, uri)
+
+
 class BaseTemplatingPlugin(tool.plugins.BasePlugin):
 
     features = FEATURE
+    commands = cached_property(lambda self: [make_compile_command(self),
+                                             make_stats_command(self)])
+
+    def cache_fragment(self, key, render, ttl=None):
+        """Returns the fragment cached under given key. If there is no such
+        fragment, calls `render` without arguments and caches the result.
+
+        :param key:
+            A string. Keys of related fragments should share a prefix so that
+            they can be invalidated at once (see
+            :meth:`invalidate_fragments`).
+        :param render:
+            A callable that returns the fragment.
+        :param ttl:
+            Number of seconds after which the fragment expires. Default is
+            defined by the cache backend.
+
+        """
+        cache = self.env['fragment_cache']
+        return cache.get_or_set(FRAGMENT_KEY_PREFIX + key, render, ttl)
+
+    def invalidate_fragments(self, prefix=''):
+        """Removes cached fragments which keys start with given prefix. If the
+        prefix is empty, all fragments are removed.
+        """
+        self.env['fragment_cache'].delete_prefix(FRAGMENT_KEY_PREFIX + prefix)
+
+    def reload_templates(self):
+        """Discards loaded templates so that they are read again from disk on
+        next use. Called on :data:`templates_changed`.
+        """
+        raise NotImplementedError
 
     def register_templates(self, module_path, dir_name=DEFAULT_PATH,
                            prefix=None):
@@ -207,9 +679,89 @@ class BaseTemplatingPlugin(tool.plugins.BasePlugin):
             A dictionary.
 
         """
+        stats = self.get_render_stats()
+        if stats is None:
+            return self._render(path, context)
+        start = time.time()
+        result = self._render(path, context)
+        stats.record(path, time.time() - start, len(result))
+        return result
+
+    def _render(self, path, context):
         template = self.env['templating_env'].get_template(path)
         return template.render(context)
 
+    def stream_template(self, path, context, buffer_size=None):
+        """Same as :meth:`render_template` but returns an iterator of rendered
+        chunks. The default implementation renders the whole template at once.
+
+        :param buffer_size:
+            Minimum size of a chunk (in characters). Default is the plugin
+            setting `stream_buffer_size`.
+
+        """
+        stats = self.get_render_stats()
+        chunks = self._stream(path, context, buffer_size)
+        if stats is None:
+            return chunks
+        return _profile_chunks(stats, path, chunks)
+
+    def _stream(self, path, context, buffer_size=None):
+        yield self._render(path, context)
+
+    def get_render_stats(self):
+        """Returns the :class:`RenderStats` instance if profiling is enabled
+        (see setting `profile`), otherwise `None`.
+        """
+        return self.env.get('render_stats')
+
+    def list_templates(self, extensions=None):
+        """Returns a sorted list of paths to all templates that can be found in
+        the search paths and registered directories. Hidden files, editor
+        backups, Python modules and images are not listed.
+
+        :param extensions:
+            A list of file extensions (without the dot). If given, only
+            templates with these extensions are listed.
+
+        """
+        raise NotImplementedError
+
+    def compile_template(self, path):
+        """Compiles given template (storing the result in `cache_dir` if it is
+        configured). Returns `None` on success or the error message if the
+        template contains syntax errors or cannot be decoded.
+        """
+        raise NotImplementedError
+
+    def compile_templates(self, paths=None, processes=1):
+        """Compiles given templates and returns a dictionary of syntax errors
+        keyed by template path.
+
+        :param paths:
+            A list of template paths. By default all templates returned by
+            :meth:`list_templates` are compiled.
+        :param processes:
+            Number of worker processes. If greater than 1, the templates are
+            compiled in parallel.
+
+        """
+        global _compiling_plugin
+        if paths is None:
+            paths = self.list_templates()
+        if processes and 1 < processes:
+            _compiling_plugin = self
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_compile_template, paths)
+            finally:
+                pool.close()
+                pool.join()
+                _compiling_plugin = None
+        else:
+            results = [(path, self.compile_template(path)) for path in paths]
+        return dict((path, error) for path, error in results if error)
+
 
 class JinjaPlugin(BaseTemplatingPlugin):
     """Offers integration with Jinja2_."""
@@ -218,17 +770,45 @@ class JinjaPlugin(BaseTemplatingPlugin):
             raise ImportError('Could not import package jinja2.')
 
         paths = settings.pop('searchpaths', [DEFAULT_PATH])
+        cache_dir = settings.pop('cache_dir', None)
+        buffer_size = settings.pop('stream_buffer_size',
+                                   DEFAULT_STREAM_BUFFER_SIZE)
+        fragment_cache = make_cache(**settings.pop('fragment_cache', {}))
+        memoize = settings.pop('memoize_templates', False)
+        profile = settings.pop('profile', False)
+        profile_blocks = settings.pop('profile_blocks', False)
+        render_stats = RenderStats() if profile or profile_blocks else None
 
         loader = jinja2.ChoiceLoader([
             jinja2.FileSystemLoader(paths),
             jinja2.PrefixLoader({})
         ])
+        if memoize:
+            loader = MemoizingLoader(loader)
+            settings.setdefault('auto_reload', False)
+
+        if cache_dir:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            settings['bytecode_cache'] = jinja2.FileSystemBytecodeCache(
+                cache_dir)
+
+        extensions = list(settings.pop('extensions', []))
+        extensions.append(FragmentCacheExtension)
 
-        jinja_env = jinja2.Environment(loader=loader, **settings)
+        jinja_env = jinja2.Environment(loader=loader, extensions=extensions,
+                                       **settings)
         jinja_env.globals.update(DEFAULT_TEMPLATE_FUNCTIONS)
+        jinja_env.fragment_cache = fragment_cache
+        if profile_blocks:
+            jinja_env.render_stats = render_stats
+            jinja_env.template_class = ProfiledTemplate
 
         return {
             'templating_env': jinja_env,
+            'stream_buffer_size': buffer_size,
+            'fragment_cache': fragment_cache,
+            'render_stats': render_stats,
         }
 
     def register_templates(self, module_path, dir_name=DEFAULT_PATH,
@@ -237,7 +817,12 @@ class JinjaPlugin(BaseTemplatingPlugin):
         _prefix = module_path.split('.')[-1] if prefix is None else prefix
 
         jinja_env = self.env['templating_env']
-        loaders = jinja_env.loader.loaders
+        choice_loader = jinja_env.loader
+        if isinstance(choice_loader, MemoizingLoader):
+            # templates that were missing may be found with the new prefix
+            choice_loader.reset()
+            choice_loader = choice_loader.loader
+        loaders = choice_loader.loaders
         assert len(loaders) == 2
         assert isinstance(loaders[1], jinja2.PrefixLoader)
         loader = jinja2.PackageLoader(module_path, dir_name)
@@ -245,9 +830,40 @@ class JinjaPlugin(BaseTemplatingPlugin):
     register_templates.__doc__ = (
         BaseTemplatingPlugin.register_templates.__doc__)
 
+    def reload_templates(self):
+        jinja_env = self.env['templating_env']
+        if isinstance(jinja_env.loader, MemoizingLoader):
+            jinja_env.loader.reset()
+        if jinja_env.cache is not None:
+            jinja_env.cache.clear()
+    reload_templates.__doc__ = BaseTemplatingPlugin.reload_templates.__doc__
+
     def update_template_context(self, data):
         self.env['templating_env'].globals.update(**data)
 
+    def _stream(self, path, context, buffer_size=None):
+        template = self.env['templating_env'].get_template(path)
+        size = buffer_size or self.env['stream_buffer_size']
+        return _buffer_chunks(template.generate(context), size)
+
+    def list_templates(self, extensions=None):
+        jinja_env = self.env['templating_env']
+        # Jinja ignores filter_func if extensions are given
+        names = jinja_env.list_templates(extensions=extensions)
+        return sorted(x for x in names if _is_template(x))
+    list_templates.__doc__ = BaseTemplatingPlugin.list_templates.__doc__
+
+    def compile_template(self, path):
+        try:
+            self.env['templating_env'].get_template(path)
+        except jinja2.TemplateSyntaxError as e:
+            return u'line {0}: {1}'.format(e.lineno, e.message)
+        except jinja2.TemplateError as e:
+            return unicode(e)
+        except UnicodeDecodeError as e:
+            return u'cannot decode: {0}'.format(e)
+    compile_template.__doc__ = BaseTemplatingPlugin.compile_template.__doc__
+
 
 class MakoPlugin(BaseTemplatingPlugin):
     """Offers integration with Mako_."""
@@ -256,36 +872,69 @@ class MakoPlugin(BaseTemplatingPlugin):
             raise ImportError('Could not import package mako.')
 
         paths = settings.pop('searchpaths', [DEFAULT_PATH])
+        fragment_cache = make_cache(**settings.pop('fragment_cache', {}))
+        memoize = settings.pop('memoize_templates', False)
+        profile = settings.pop('profile', False)
 
-        from mako.lookup import TemplateLookup
-        loader = TemplateLookup(paths, input_encoding='utf-8',
-                                output_encoding='utf-8',
-                                default_filters=['decode.utf8'])
+        loader = IndexedTemplateLookup(
+            paths, input_encoding='utf-8', output_encoding='utf-8',
+            default_filters=['decode.utf8'],
+            module_directory=settings.pop('cache_dir', None),
+            collection_size=settings.pop('collection_size', -1),
+            filesystem_checks=settings.pop('filesystem_checks', not memoize))
+
+        context = dict(DEFAULT_TEMPLATE_FUNCTIONS,
+                       cache_fragment=self.cache_fragment)
 
         return {
             'templating_env': loader,
-            'context': DEFAULT_TEMPLATE_FUNCTIONS.copy(),
+            'context': context,
+            'fragment_cache': fragment_cache,
+            'render_stats': RenderStats() if profile else None,
         }
 
     def register_templates(self, module_path, dir_name=DEFAULT_PATH,
                            prefix=None):
-        import os.path
         from tool.importing import import_module
         mod = import_module(module_path)
         root = mod.__path__[0]
         path = os.path.join(root, dir_name)
-        self.env['templating_env'].directories.append(path)
+        self.env['templating_env'].add_directory(path)
     register_templates.__doc__ = (
         BaseTemplatingPlugin.register_templates.__doc__)
 
     def update_template_context(self, data):
         self.env['context'].update(data)
 
-    def render_template(self, path, context):
+    def reload_templates(self):
+        lookup = self.env['templating_env']
+        lookup.reindex()
+        # Mako changes these under the lock when it loads templates
+        with lookup._mutex:
+            lookup._collection.clear()
+            lookup._uri_cache.clear()
+    reload_templates.__doc__ = BaseTemplatingPlugin.reload_templates.__doc__
+
+    def _render(self, path, context):
         template = self.env['templating_env'].get_template(path)
         combined_context = dict(self.env['context'], **context)
         return template.render_unicode(**combined_context)
-    render_template.__doc__ = BaseTemplatingPlugin.render_template.__doc__
+
+    def list_templates(self, extensions=None):
+        index = self.env['templating_env'].index
+        return sorted(x for x in index
+                      if not extensions or x.rpartition('.')[2] in extensions)
+    list_templates.__doc__ = BaseTemplatingPlugin.list_templates.__doc__
+
+    def compile_template(self, path):
+        try:
+            self.env['templating_env'].get_template(path)
+        except (mako.exceptions.SyntaxException,
+                mako.exceptions.CompileException) as e:
+            return unicode(e)
+        except UnicodeDecodeError as e:
+            return u'cannot decode: {0}'.format(e)
+    compile_template.__doc__ = BaseTemplatingPlugin.compile_template.__doc__
 
 
 
@@ -317,6 +966,25 @@ def register_templates(module_path, dir_name=DEFAULT_PATH, prefix=None):
     """
     app.get_feature(FEATURE).register_templates(module_path, dir_name, prefix)
 
+@url('/stats')
+def render_stats(request):
+    """Returns render statistics (see :meth:`RenderStats.summary`) as JSON.
+    Only available in debug mode and if profiling is enabled.
+    """
+    stats = app.get_feature(FEATURE).get_render_stats()
+    if stats is None or not app.settings.get('debug'):
+        raise NotFound
+    return Response(json.dumps(stats.summary()), mimetype='application/json')
+
+# sent by the application when template files have been changed
+templates_changed = Signal('templates_changed')
+
+@called_on(templates_changed)
+def reload_templates(*args, **kwargs):
+    logger.debug('Reloading templates...')
+
+    app.get_feature(FEATURE).reload_templates()
+
 @called_on(request_ready)
 def add_request_to_templating_env(*args, **kwargs):
     logger.debug('Updating templating environment for the fresh Request object...')
@@ -338,6 +1006,15 @@ def render_template(template_path, **extra_context):
     plugin = app.get_feature(FEATURE)
     return plugin.render_template(template_path, extra_context)
 
+def cache_fragment(key, render, ttl=None):
+    """See :meth:`BaseTemplatingPlugin.cache_fragment`."""
+    plugin = app.get_feature(FEATURE)
+    return plugin.cache_fragment(key, render, ttl)
+
+def invalidate_fragments(prefix=''):
+    """See :meth:`BaseTemplatingPlugin.invalidate_fragments`."""
+    app.get_feature(FEATURE).invalidate_fragments(prefix)
+
 def render_response(template_path, mimetype='text/html', **extra_context):
     """TODO
 
@@ -348,20 +1025,42 @@ def render_response(template_path, mimetype='text/html', **extra_context):
         mimetype=mimetype,
     )
 
-def as_html(template_path):
+def stream_template(template_path, **extra_context):
+    """
+    Same as :func:`render_template` but returns an iterator of rendered
+    chunks instead of a single string.
+    """
+    plugin = app.get_feature(FEATURE)
+    return plugin.stream_template(template_path, extra_context)
+
+def stream_response(template_path, mimetype='text/html', **extra_context):
+    """
+    Same as :func:`render_response` but the response body is rendered while
+    it is being sent to the client.
+
+    Internally calls :func:`stream_template`.
+    """
+    return Response(
+        stream_template(template_path, **extra_context),
+        mimetype=mimetype,
+    )
+
+def as_html(template_path, stream=False):
     """
     Decorator for views. If the view returns a dictionary, given template is
     rendered with that dictionary as the context. If the returned value is not
     a dictionary, it is passed further as is.
 
-    Internally calls :func:`render_response`.
+    Internally calls :func:`render_response` or, if `stream` is `True`,
+    :func:`stream_response`.
     """
+    respond = stream_response if stream else render_response
     def wrapper(f):
         @wraps(f)
         def inner(*args, **kwargs):
             result = f(*args, **kwargs)
             if isinstance(result, dict):
-                return render_response(template_path, **result)
+                return respond(template_path, **result)
             return result
         return inner
     return wrapper
@@ -36,6 +36,19 @@ Bundle configuration:
   the dictionary) with custom configuration for the
   PluggableAuthenticationMiddleware. Note that the callable configurator will
   be called the bundle configuration dictionary.
+* ``identity_cache_size`` — how many authenticated users and logins are kept
+  in memory by the presets (default is 1000; 0 disables the cache). See
+  :class:`~tool.ext.who.who_plugins.DoquPlugin`.
+* ``identity_cache_ttl`` — number of seconds a cached identity is valid
+  (default is 300).
+* ``ticket_cache_size`` — how many verified auth_tkt cookies are remembered
+  by the "form" preset (default is 1000; 0 disables the cache). See
+  :class:`~tool.ext.who.who_plugins.CachedAuthTktCookiePlugin`.
+* ``ticket_cache_ttl`` — number of seconds a verified cookie is trusted
+  without checking its signature again (default is 60).
+* ``password_hashing`` — a dictionary of settings for the password hasher
+  (work factor, worker processes, queue size). See
+  :mod:`tool.ext.who.hashing`.
 
 Available presets:
 
@@ -102,14 +115,15 @@ from tool.plugins import BasePlugin
 from tool.ext.documents import storages, default_storage
 
 # this bundle
-from schema import User
+from schema import User, user_changed
+from hashing import configure_hasher
 from views import render_login_form
 from presets import KNOWN_PRESETS
 from shortcuts import get_user
 from decorators import requires_auth
 
 
-__all__ = ['requires_auth', 'get_user', 'User']
+__all__ = ['requires_auth', 'get_user', 'User', 'user_changed']
 
 
 class AuthenticationPlugin(BasePlugin):
@@ -125,6 +139,8 @@ class AuthenticationPlugin(BasePlugin):
         db_label = settings.pop('database', None)
         database = storages.get(db_label) or default_storage()
 
+        configure_hasher(**settings.pop('password_hashing', None) or {})
+
         if settings.get('config'):
             conf = import_whatever(settings['config'])
             mw_conf = conf(**settings) if hasattr(conf, '__call__') else conf
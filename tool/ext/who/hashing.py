@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Password hashing
+================
+
+Passwords are hashed with PBKDF2 and a configurable number of iterations (the
+work factor). The hash string has the form ``pbkdf2:sha256:50000$salt$hash``;
+older hashes created by :func:`werkzeug.generate_password_hash` are still
+accepted.
+
+A strong hash takes tens of milliseconds of CPU time. To keep the application
+responsive during a burst of logins, the :class:`PasswordHasher` can compute
+hashes in a pool of worker processes. The number of computations submitted to
+the pool and not yet finished is bounded: when the queue is full, callers wait
+up to `timeout` seconds and then get a `RuntimeError`. The same error is raised
+if the result is not ready in time; the computation still occupies its place
+in the queue until the worker is done with it.
+
+Configuration (in the settings of :mod:`tool.ext.who`)::
+
+    tool.ext.who.AuthenticationPlugin:
+        secret: ...
+        password_hashing:
+            processes: 4        # 0 (default) computes hashes in the request
+            queue_size: 32
+            iterations: 50000
+"""
+import binascii
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+
+from werkzeug import check_password_hash
+from werkzeug.security import gen_salt
+
+
+__all__ = ['PasswordHasher', 'make_password_hash', 'verify_password_hash',
+           'configure_hasher', 'get_hasher']
+
+
+DEFAULT_METHOD = 'pbkdf2:sha256'
+DEFAULT_ITERATIONS = 50000
+DEFAULT_SALT_LENGTH = 12
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_TIMEOUT = 10
+
+
+def make_password_hash(password, method=DEFAULT_METHOD,
+                       iterations=DEFAULT_ITERATIONS,
+                       salt_length=DEFAULT_SALT_LENGTH):
+    """Returns a salted PBKDF2 hash of given password. `method` is
+    ``pbkdf2:`` followed by the name of a :mod:`hashlib` algorithm.
+    """
+    if not method.startswith('pbkdf2:'):
+        raise ValueError('Unsupported hash method {0}'.format(method))
+    salt = gen_salt(salt_length)
+    value = _pbkdf2(method.split(':', 1)[1], password, salt, iterations)
+    return '{0}:{1}${2}${3}'.format(method, iterations, salt, value)
+
+def verify_password_hash(pwhash, password):
+    """Returns `True` if given password matches the hash created by
+    :func:`make_password_hash` (or by Werkzeug).
+    """
+    if not pwhash.startswith('pbkdf2:'):
+        return check_password_hash(pwhash, password)
+    try:
+        method, salt, value = pwhash.split('$', 2)
+        prefix, algorithm, iterations = method.split(':')
+        expected = _pbkdf2(algorithm, password, salt, int(iterations))
+        # a hexadecimal digest is ASCII; anything else cannot match
+        value = str(value)
+    except ValueError:
+        # also UnicodeEncodeError
+        return False
+    return _compare(expected, value)
+
+def _pbkdf2(algorithm, password, salt, iterations):
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    if isinstance(salt, unicode):
+        salt = salt.encode('utf-8')
+    # hashes are stored as unicode but hashlib needs a native string
+    return binascii.hexlify(hashlib.pbkdf2_hmac(str(algorithm), password,
+                                                salt, iterations))
+
+def _compare(a, b):
+    # constant time, so that the hash cannot be guessed by timing
+    return hmac.compare_digest(a, b)
+
+def _call(func, args):
+    # runs in a worker process; errors are returned instead of raised so that
+    # the callback of apply_async() is called in any case
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, e
+
+
+class PasswordHasher(object):
+    """Computes and verifies password hashes, optionally in a process pool.
+
+    :param processes:
+        number of worker processes. If 0, hashes are computed in the calling
+        thread. If `None`, the number of CPUs is used.
+    :param queue_size:
+        maximum number of computations submitted to the pool at once.
+    :param timeout:
+        number of seconds to wait for a free place in the queue and then for
+        the result.
+    :param method:
+        see :func:`make_password_hash`.
+    :param iterations:
+        the work factor for new hashes. Existing hashes keep their own.
+
+    """
+    def __init__(self, processes=0, queue_size=DEFAULT_QUEUE_SIZE,
+                 timeout=DEFAULT_TIMEOUT, method=DEFAULT_METHOD,
+                 iterations=DEFAULT_ITERATIONS):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.method = method
+        self.iterations = iterations
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._pool = None
+        self._pid = None
+
+    def _get_pool(self):
+        # the pool is created on first use and again after a fork because
+        # worker processes belong to the process that started them
+        with self._condition:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = multiprocessing.Pool(self.processes)
+                self._pid = os.getpid()
+                self._pending = 0
+            return self._pool
+
+    def _release(self, result=None):
+        # called when a computation is over, so the queue is bounded by the
+        # work actually done by the pool, not by the waiting callers
+        with self._condition:
+            self._pending -= 1
+            self._condition.notify()
+
+    def _run(self, func, *args):
+        if self.processes == 0:
+            return func(*args)
+        pool = self._get_pool()
+        deadline = time.time() + self.timeout
+        with self._condition:
+            while self.queue_size <= self._pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('Too many password hashes are being '
+                                       'computed; try again later.')
+                self._condition.wait(remaining)
+            self._pending += 1
+        try:
+            result = pool.apply_async(_call, (func, args),
+                                      callback=self._release)
+        except Exception:
+            self._release()
+            raise
+        try:
+            # waiting with a timeout releases the GIL and can be interrupted
+            ok, value = result.get(max(0, deadline - time.time()))
+        except multiprocessing.TimeoutError:
+            raise RuntimeError('The password hash was not computed in time; '
+                               'try again later.')
+        if not ok:
+            raise value
+        return value
+
+    def make(self, password):
+        "Returns a new hash of given password."
+        return self._run(make_password_hash, password, self.method,
+                         self.iterations)
+
+    def check(self, pwhash, password):
+        "Returns `True` if given password matches given hash."
+        return self._run(verify_password_hash, pwhash, password)
+
+    def close(self):
+        "Stops the worker processes."
+        with self._condition:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+
+
+_hasher = PasswordHasher()
+
+
+def configure_hasher(**settings):
+    """Replaces the hasher used by :class:`~tool.ext.who.User` with a new
+    :class:`PasswordHasher` created with given settings.
+    """
+    global _hasher
+    previous, _hasher = _hasher, PasswordHasher(**settings)
+    previous.close()
+
+def get_hasher():
+    "Returns the current :class:`PasswordHasher`."
+    return _hasher
@@ -16,15 +16,31 @@ from repoze.who.classifiers import default_challenge_decider
 from views import render_login_form
 
 
-def get_doqu_auth_plugin():
+def get_doqu_auth_plugin(**kwargs):
     # import postponed so this module can be safely imported by admin, etc.
     # without circular imports
-    from who_plugins import DocuPlugin
-    return DocuPlugin()
+    from who_plugins import DoquPlugin
+    options = dict((k[len('identity_'):], kwargs[k]) for k in
+                   ('identity_cache_size', 'identity_cache_ttl') if k in kwargs)
+    return DoquPlugin(**options)
+
+def get_auth_tkt_plugin(**kwargs):
+    # verified tickets are cached unless ticket_cache_size is 0
+    secret = kwargs['secret']
+    options = dict(secure=True, timeout=7*24*60*60, reissue_time=5*24*60*60)
+    cache_size = kwargs.get('ticket_cache_size')
+    if cache_size == 0:
+        return AuthTktCookiePlugin(secret, 'auth_tkt', **options)
+    from who_plugins import CachedAuthTktCookiePlugin
+    if cache_size is not None:
+        options['cache_size'] = cache_size
+    if 'ticket_cache_ttl' in kwargs:
+        options['cache_ttl'] = kwargs['ticket_cache_ttl']
+    return CachedAuthTktCookiePlugin(secret, 'auth_tkt', **options)
 
 def get_basic_auth_config_preset(**kwargs):
     basic_auth = BasicAuthPlugin('repoze.who')
-    doqu_plugin = get_doqu_auth_plugin()
+    doqu_plugin = get_doqu_auth_plugin(**kwargs)
 
     return {
         'identifiers':       [('basic_auth', basic_auth)],
@@ -38,9 +54,7 @@ def get_basic_auth_config_preset(**kwargs):
 def get_form_config_preset(**kwargs):
     secret = kwargs['secret']
     assert secret
-    auth_tkt = AuthTktCookiePlugin(secret, 'auth_tkt', secure=True,
-                                   timeout=7*24*60*60,
-                                   reissue_time=5*24*60*60)
+    auth_tkt = get_auth_tkt_plugin(**kwargs)
     # FIXME: the proper form (with callable) doesn't work
     #form = FormPlugin('__do_login',
     #                  rememberer_name='auth_tkt',
@@ -48,7 +62,7 @@ def get_form_config_preset(**kwargs):
     form = FormPlugin('__do_login', rememberer_name='auth_tkt')
     form.classifications = { IIdentifier:['browser'],
                              IChallenger:['browser'] } # only for browser
-    doqu_plugin = get_doqu_auth_plugin()
+    doqu_plugin = get_doqu_auth_plugin(**kwargs)
 
     return {
         'identifiers':       [('form', form), ('auth_tkt', auth_tkt)],
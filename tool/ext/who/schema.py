@@ -5,13 +5,19 @@ try:
 except ImportError:
     from md5 import md5
 
-from werkzeug import generate_password_hash, check_password_hash
 from doqu import Document, validators
 from doqu.ext.fields import Field
+from tool.signals import Signal
+from hashing import get_hasher
 # FIXME: commented out to avoid circular import; reorganize the code there
 #from tool.ext.admin import with_admin
 
 
+#: Sent with the argument `instance` after a :class:`User` is saved or deleted
+#: (then the argument `deleted` is `True`).
+user_changed = Signal('user_changed')
+
+
 #@with_admin(namespace='auth')
 class User(Document):
     """
@@ -31,8 +37,17 @@ class User(Document):
         return u'{username}'.format(**self)
 
     def set_password(self, raw_password):
-        self.password = unicode(generate_password_hash(raw_password))
+        self.password = unicode(get_hasher().make(raw_password))
 
     def check_password(self, raw_password):
         assert self.password and '$' in self.password, 'bad stored password'
-        return check_password_hash(self.password, raw_password)
+        return get_hasher().check(self.password, raw_password)
+
+    def save(self, *args, **kwargs):
+        pk = super(User, self).save(*args, **kwargs)
+        user_changed.send(sender=type(self), instance=self)
+        return pk
+
+    def delete(self):
+        super(User, self).delete()
+        user_changed.send(sender=type(self), instance=self, deleted=True)
@@ -1,17 +1,163 @@
-__all__ = ['DoquPlugin']
+__all__ = ['DoquPlugin', 'CachedAuthTktCookiePlugin']
 
 
+from collections import OrderedDict
+import hashlib
+import hmac
+from itertools import islice
+import os
+import threading
+import time
+
+from repoze.who.plugins.auth_tkt import AuthTktCookiePlugin
+from werkzeug import parse_cookie
+
 #from tool.ext.documents import storages
+from tool.cache import LRUCache
 from tool.plugins import get_feature
-from schema import User
+from schema import User, user_changed
+
+
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_CACHE_TTL = 300
+DEFAULT_TICKET_CACHE_TTL = 60
+
+# set by AuthTktCookiePlugin.identify() along with the identity
+TICKET_ENVIRON_KEYS = 'REMOTE_USER_TOKENS', 'REMOTE_USER_DATA', 'AUTH_TYPE'
+
+
+class UsernameIndex(object):
+    """Maps usernames to primary keys of :class:`~tool.ext.who.User`
+    documents so that a user can be fetched by key instead of a query. The
+    index is built from the storage on first use and updated when users are
+    saved to or deleted from that storage; changes in other storages are
+    ignored.
+    """
+    def __init__(self):
+        self._keys = {}
+        self._usernames = {}
+        self._storage = None
+        self._lock = threading.Lock()
+
+    def _build(self, db):
+        self._keys.clear()
+        self._usernames.clear()
+        for user in User.objects(db):
+            self._set(user.username, user.pk)
+        self._storage = db
+
+    def _set(self, username, pk):
+        self._discard(pk)
+        self._keys[username] = pk
+        self._usernames[pk] = username
+
+    def _discard(self, pk):
+        username = self._usernames.pop(pk, None)
+        if username is not None and self._keys.get(username) == pk:
+            del self._keys[username]
+
+    def get(self, db, username):
+        "Returns the primary key for given username or `None`."
+        with self._lock:
+            if self._storage is not db:
+                self._build(db)
+            return self._keys.get(username)
+
+    def add(self, db, username, pk):
+        "Maps given username to given key if the index was built from `db`."
+        with self._lock:
+            if self._storage is db:
+                self._set(username, pk)
+
+    def discard(self, db, pk):
+        "Forgets given key if the index was built from `db`."
+        with self._lock:
+            if self._storage is db:
+                self._discard(pk)
 
 
 class DoquPlugin(object):
     """ Doqu-powered authenticator and metadata provider for repoze.who.
+
+    Authenticated identities are cached in memory: the user documents by
+    userid and the result of authentication by a digest of the credentials.
+    Repeated requests with the same credentials then neither query the storage
+    nor hash the password. A cached login is only accepted while the user's
+    stored username and password hash are unchanged. Users saved or deleted via
+    :class:`~tool.ext.who.User` methods are evicted at once; other changes are
+    picked up within `cache_ttl` seconds.
+
+    Users are found by username through a :class:`UsernameIndex`, so the cost
+    of a login does not depend on the number of users. Usernames missing from
+    the index (e.g. users created by another process) are looked up with a
+    query and then added to the index.
+
+    :param cache_size:
+        maximum number of cached users and logins (each). If 0, nothing is
+        cached.
+    :param cache_ttl:
+        number of seconds a cached item is valid.
+
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE,
+                 cache_ttl=DEFAULT_CACHE_TTL):
+        self.cache_size = cache_size
+        self._users = LRUCache(size=cache_size, default_ttl=cache_ttl)
+        self._logins = LRUCache(size=cache_size, default_ttl=cache_ttl)
+        # the digests are only meaningful within this process
+        self._digest_key = os.urandom(32)
+        self._index = UsernameIndex()
+        user_changed.connect(self.forget_user)
+
+    def _get_digest(self, username, password):
+        message = u'{0}\0{1}'.format(username, password).encode('utf-8')
+        return hmac.new(self._digest_key, message, hashlib.sha256).digest()
+
+    def _get_user(self, db, userid):
+        # raises KeyError if there is no such user
+        record = self._users.get(userid)
+        if record is None:
+            user = db.get(userid, User)
+            if self.cache_size:
+                self._users.set(userid, user._saved_state.data)
+            return user
+        # a new instance each time so that requests do not share the object
+        return User.from_storage(db, userid, record)
+
+    def _find_user(self, db, username):
+        # the index may not know users created elsewhere
+        pk = self._index.get(db, username)
+        if pk is not None:
+            try:
+                user = self._get_user(db, pk)
+            except KeyError:
+                self._index.discard(db, pk)
+            else:
+                if user.username == username:
+                    return user
+        users = list(islice(User.objects(db).where(username=username), 2))
+        if not users:
+            return None
+        assert len(users) == 1, ('expected only one user with username {0}, '
+                                 'got more'.format(username))
+        user = users[0]
+        self._index.add(db, username, user.pk)
+        return user
+
+    def forget_user(self, sender=None, instance=None, deleted=False,
+                    **kwargs):
+        """Evicts given user document from the cache and updates the index.
+        Called on :data:`~tool.ext.who.schema.user_changed`.
+        """
+        if instance is None or not instance.pk:
+            return
+        self._users.delete(instance.pk)
+        db = instance._saved_state.storage
+        if deleted:
+            self._index.discard(db, instance.pk)
+        else:
+            self._index.add(db, instance.username, instance.pk)
 
     # IAuthenticatorPlugin
     def authenticate(self, environ, identity):
@@ -23,17 +169,28 @@ class DoquPlugin(object):
 
         db = get_feature('authentication').env['database']
 
-        users = User.objects(db).where(username=username)
+        digest = self._get_digest(username, password)
+        login = self._logins.get(digest)
+        if login:
+            userid, login_username, password_hash = login
+            try:
+                user = self._get_user(db, userid)
+            except KeyError:
+                user = None
+            if (user is not None and user.username == login_username and
+                user.password == password_hash):
+                return userid
+            self._logins.delete(digest)
 
-        if not users:
-            return None
+        user = self._find_user(db, username)
 
-        assert len(users) == 1, ('expected only one user with username {0}, '
-                                 'got {1}'.format(username, len(users)))
-
-        user = users[0]
+        if user is None:
+            return None
 
         if user.check_password(password):
+            if self.cache_size:
+                self._logins.set(digest, (user.pk, user.username,
+                                          user.password))
             return user.pk
 
         return None
@@ -43,9 +200,132 @@ class DoquPlugin(object):
         db = get_feature('authentication').env['database']
         userid = identity.get('repoze.who.userid')
         try:
-            instance = db.get(User, userid)
+            instance = self._get_user(db, userid)
         except KeyError:
             pass
         else:
             identity['instance'] = instance
             #identity.update(info)
+
+
+class CachedAuthTktCookiePlugin(AuthTktCookiePlugin):
+    """ An auth_tkt identifier that remembers verified tickets, so that each
+    ticket is parsed and its signature checked once per `cache_ttl` seconds
+    instead of on every request. The cache is keyed on the cookie value (and
+    the client address if `include_ip` is set). Entries never outlive the
+    ticket's `timeout`; they are evicted when the user logs out and when the
+    user document is saved or deleted.
+
+    repoze.who calls :meth:`remember` on every response; while the cookie
+    holds a cached ticket for the same identity and the ticket is not due for
+    reissue, nothing is parsed there either. Otherwise the ticket is handled
+    by :class:`AuthTktCookiePlugin`.
+
+    :param cache_size:
+        maximum number of cached tickets.
+    :param cache_ttl:
+        number of seconds a verified ticket is trusted without checking.
+
+    Other arguments are passed to :class:`AuthTktCookiePlugin`.
+    """
+    def __init__(self, secret, cookie_name='auth_tkt',
+                 cache_size=DEFAULT_CACHE_SIZE,
+                 cache_ttl=DEFAULT_TICKET_CACHE_TTL, **kwargs):
+        AuthTktCookiePlugin.__init__(self, secret, cookie_name, **kwargs)
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._tickets = LRUCache(size=cache_size, default_ttl=cache_ttl)
+        # userid -> time of the last change, oldest first; tickets cached
+        # before the change are not trusted. Changes older than `cache_ttl`
+        # are dropped because no ticket cached before them is left.
+        self._changes = OrderedDict()
+        self._lock = threading.Lock()
+        user_changed.connect(self.forget_user)
+
+    def _get_cache_key(self, environ):
+        value = parse_cookie(environ).get(self.cookie_name)
+        if not value:
+            return None
+        if self.include_ip:
+            return value, environ.get('REMOTE_ADDR')
+        return value
+
+    def _get_cached(self, key):
+        # returns the cached identity and environ values or `None`
+        cached = self._tickets.get(key)
+        if not cached:
+            return None
+        identity, cached_at, values = cached
+        userid = identity['repoze.who.userid']
+        if cached_at <= self._changes.get(userid, 0):
+            self._tickets.delete(key)
+            return None
+        return identity, values
+
+    # IIdentifier
+    def identify(self, environ):
+        key = self._get_cache_key(environ)
+        if key is None:
+            return None
+        cached = self._get_cached(key)
+        if cached:
+            identity, values = cached
+            environ.update(values)
+            # metadata providers add items to the identity
+            return dict(identity)
+        now = time.time()
+        identity = AuthTktCookiePlugin.identify(self, environ)
+        if identity is None:
+            return None
+        ttl = self.cache_ttl
+        if self.timeout:
+            remaining = identity['timestamp'] + self.timeout - now
+            ttl = remaining if ttl is None else min(ttl, remaining)
+        if ttl is None or 0 < ttl:
+            values = dict((k, environ[k]) for k in TICKET_ENVIRON_KEYS
+                          if k in environ)
+            self._tickets.set(key, (dict(identity), now, values), ttl)
+        return identity
+
+    # IIdentifier
+    def remember(self, environ, identity):
+        key = self._get_cache_key(environ)
+        cached = None if key is None else self._get_cached(key)
+        if cached and self._is_current(cached[0], identity):
+            # the cookie already holds this identity
+            return None
+        return AuthTktCookiePlugin.remember(self, environ, identity)
+
+    def _is_current(self, ticket, identity):
+        # same as AuthTktCookiePlugin.remember() deciding not to reissue
+        if self.reissue_time and (
+            ticket['timestamp'] + self.reissue_time < time.time()):
+            return False
+        return all(ticket.get(k) == identity.get(k)
+                   for k in ('repoze.who.userid', 'tokens', 'userdata'))
+
+    # IIdentifier
+    def forget(self, environ, identity):
+        key = self._get_cache_key(environ)
+        if key is not None:
+            self._tickets.delete(key)
+        return AuthTktCookiePlugin.forget(self, environ, identity)
+
+    def forget_user(self, sender=None, instance=None, **kwargs):
+        """Invalidates cached tickets of given user. Called on
+        :data:`~tool.ext.who.schema.user_changed`.
+        """
+        if instance is None or not instance.pk:
+            return
+        now = time.time()
+        with self._lock:
+            changes = self._changes
+            changes.pop(instance.pk, None)
+            changes[instance.pk] = now
+            if self.cache_ttl is not None:
+                while changes[next(iter(changes))] < now - self.cache_ttl:
+                    changes.popitem(last=False)
+            if self.cache_size < len(changes):
+                # too many changes to track; trust no cached ticket
+                self._tickets.clear()
+                changes.clear()